@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from sweettooth.core.tasks import run_pending
+
+class Command(BaseCommand):
+    help = "Run queued background tasks."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--forever', action='store_true',
+                            help="Keep polling for new tasks instead of exiting when the queue is empty.")
+        parser.add_argument('--interval', type=float, default=5,
+                            help="Seconds to sleep between polls with --forever.")
+
+    def handle(self, *args, **options):
+        while True:
+            count = run_pending()
+            if options['verbosity'] > 1 and count:
+                self.stdout.write("Ran %d tasks" % count)
+
+            if not options['forever']:
+                break
+
+            if not count:
+                time.sleep(options['interval'])
@@ -0,0 +1,30 @@
+# Generated by Django 2.2 on 2026-10-19 04:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackgroundTask',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('function', models.CharField(max_length=200)),
+                ('args_json', models.TextField(default='[]')),
+                ('key', models.CharField(blank=True, db_index=True, max_length=200)),
+                ('status', models.PositiveIntegerField(choices=[(0, 'Pending'), (1, 'Running'), (2, 'Done'), (3, 'Failed')], db_index=True, default=0)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('run_after', models.DateTimeField(db_index=True)),
+                ('claimed', models.DateTimeField(null=True)),
+                ('finished', models.DateTimeField(null=True)),
+            ],
+        ),
+    ]
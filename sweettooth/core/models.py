@@ -0,0 +1,38 @@
+from django.db import models
+
+(TASK_PENDING,
+ TASK_RUNNING,
+ TASK_DONE,
+ TASK_FAILED) = range(4)
+
+TASK_STATUSES = {
+    TASK_PENDING: "Pending",
+    TASK_RUNNING: "Running",
+    TASK_DONE: "Done",
+    TASK_FAILED: "Failed",
+}
+
+class BackgroundTask(models.Model):
+    """
+    A function call deferred to the runtasks command. See
+    sweettooth.core.tasks for queueing and running them.
+    """
+    # Dotted path of a module-level function
+    function = models.CharField(max_length=200)
+    args_json = models.TextField(default="[]")
+
+    # Lets callers find the tasks they queued for an object
+    key = models.CharField(max_length=200, blank=True, db_index=True)
+
+    status = models.PositiveIntegerField(choices=TASK_STATUSES.items(), default=TASK_PENDING, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+
+    created = models.DateTimeField(auto_now_add=True)
+    run_after = models.DateTimeField(db_index=True)
+    # When a runner took it; see sweettooth.core.tasks.requeue_stale
+    claimed = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return "%s (%s)" % (self.function, TASK_STATUSES[self.status])
@@ -0,0 +1,123 @@
+"""
+A small durable task queue on top of the database.
+
+Work that doesn't need to happen before a response is sent (mail,
+expensive checks) is queued with enqueue() and run later by the
+"runtasks" management command, so it survives restarts and failures.
+"""
+
+import datetime
+import json
+import logging
+import traceback
+
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from sweettooth.core.models import (BackgroundTask, TASK_PENDING, TASK_RUNNING,
+                                    TASK_DONE, TASK_FAILED)
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+
+# A task still running this long after it was claimed is taken to have
+# lost its runner (killed, or the machine went away), and is queued again.
+STALE_AFTER = datetime.timedelta(hours=1)
+
+def get_function_path(function):
+    return "%s.%s" % (function.__module__, function.__name__)
+
+def enqueue(function, *args, key=""):
+    """
+    Queue function(*args). function must be a module-level function
+    and args must be JSON-serializable; pass primary keys, not objects.
+
+    The task is only visible to the runner once the current transaction
+    commits.
+    """
+    return BackgroundTask.objects.create(function=get_function_path(function),
+                                         args_json=json.dumps(args),
+                                         key=key,
+                                         run_after=timezone.now())
+
+def get_stale_filter():
+    return Q(status=TASK_RUNNING) & (Q(claimed__lt=timezone.now() - STALE_AFTER) | Q(claimed__isnull=True))
+
+def pending_keys(keys):
+    """Return which of keys still have unfinished tasks."""
+    return set(BackgroundTask.objects.filter(key__in=keys,
+                                             status__in=(TASK_PENDING, TASK_RUNNING))
+                                     .exclude(get_stale_filter())
+                                     .values_list('key', flat=True))
+
+def requeue_stale():
+    """
+    Queue again the tasks whose runner went away while running them.
+    That counts as a failed attempt, so a task that keeps killing its
+    runner is eventually given up on. Returns how many were requeued.
+    """
+    stale = BackgroundTask.objects.filter(get_stale_filter())
+    stale.filter(attempts__gte=MAX_ATTEMPTS - 1).update(status=TASK_FAILED,
+                                                        attempts=F('attempts') + 1,
+                                                        error="Runner went away",
+                                                        finished=timezone.now())
+    return stale.update(status=TASK_PENDING,
+                        attempts=F('attempts') + 1,
+                        error="Runner went away",
+                        run_after=timezone.now())
+
+def claim(task):
+    # A conditional UPDATE, so two runners never pick up the same task,
+    # whatever the database supports for row locking.
+    claimed = timezone.now()
+    if BackgroundTask.objects.filter(pk=task.pk, status=TASK_PENDING).update(status=TASK_RUNNING,
+                                                                             claimed=claimed) != 1:
+        return False
+
+    task.status = TASK_RUNNING
+    task.claimed = claimed
+    return True
+
+def run_task(task):
+    task.attempts += 1
+
+    try:
+        function = import_string(task.function)
+        with transaction.atomic():
+            function(*json.loads(task.args_json))
+    except Exception:
+        logger.exception("Background task %s failed", task.function)
+        task.error = traceback.format_exc()
+
+        if task.attempts >= MAX_ATTEMPTS:
+            task.status = TASK_FAILED
+            task.finished = timezone.now()
+        else:
+            # Back off: 1, 4, 9, 16 minutes
+            task.status = TASK_PENDING
+            task.run_after = timezone.now() + datetime.timedelta(minutes=task.attempts ** 2)
+    else:
+        task.status = TASK_DONE
+        task.finished = timezone.now()
+
+    task.save()
+
+def run_pending(limit=None):
+    """Run the tasks that are due, oldest first. Returns how many ran."""
+    requeue_stale()
+
+    queryset = BackgroundTask.objects.filter(status=TASK_PENDING,
+                                             run_after__lte=timezone.now()).order_by('run_after', 'pk')
+    if limit is not None:
+        queryset = queryset[:limit]
+
+    count = 0
+    for task in queryset:
+        if claim(task):
+            run_task(task)
+            count += 1
+
+    return count
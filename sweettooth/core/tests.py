@@ -0,0 +1,72 @@
+from django.core import mail
+from django.test import TestCase
+
+from sweettooth.core import tasks
+from sweettooth.core.models import BackgroundTask, TASK_DONE, TASK_FAILED, TASK_PENDING, TASK_RUNNING
+
+def send_test_mail(subject):
+    mail.send_mail(subject, "", "noreply@gnome.org", ["someone@gnome.org"])
+
+def fail():
+    raise ValueError("broken")
+
+class BackgroundTaskTest(TestCase):
+    def test_run_pending(self):
+        task = tasks.enqueue(send_test_mail, "hello", key="test:1")
+        self.assertEqual(tasks.pending_keys(["test:1", "test:2"]), {"test:1"})
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(tasks.run_pending(), 1)
+        self.assertEqual(mail.outbox[0].subject, "hello")
+        self.assertEqual(tasks.pending_keys(["test:1"]), set())
+
+        task.refresh_from_db()
+        self.assertEqual(task.status, TASK_DONE)
+
+        # Nothing left to do
+        self.assertEqual(tasks.run_pending(), 0)
+
+    def test_failure_is_retried_later(self):
+        task = tasks.enqueue(fail)
+
+        tasks.run_pending()
+        task.refresh_from_db()
+        self.assertEqual(task.status, TASK_PENDING)
+        self.assertEqual(task.attempts, 1)
+        self.assertIn("ValueError", task.error)
+
+        # Backed off, so not due again yet
+        self.assertEqual(tasks.run_pending(), 0)
+
+        for attempt in range(tasks.MAX_ATTEMPTS - 1):
+            BackgroundTask.objects.filter(pk=task.pk).update(run_after=task.created)
+            tasks.run_pending()
+
+        task.refresh_from_db()
+        self.assertEqual(task.status, TASK_FAILED)
+        self.assertEqual(task.attempts, tasks.MAX_ATTEMPTS)
+
+    def test_stale_task_is_requeued(self):
+        task = tasks.enqueue(send_test_mail, "hello", key="test:1")
+        self.assertTrue(tasks.claim(task))
+
+        # Its runner is still going
+        self.assertEqual(tasks.pending_keys(["test:1"]), {"test:1"})
+        self.assertEqual(tasks.run_pending(), 0)
+
+        # ... until it has been quiet for too long.
+        BackgroundTask.objects.filter(pk=task.pk).update(claimed=task.claimed - tasks.STALE_AFTER)
+        self.assertEqual(tasks.pending_keys(["test:1"]), set())
+        self.assertEqual(tasks.run_pending(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+
+        task.refresh_from_db()
+        self.assertEqual(task.status, TASK_DONE)
+        self.assertEqual(task.attempts, 2)
+
+        # One that keeps losing its runner is given up on.
+        BackgroundTask.objects.filter(pk=task.pk).update(status=TASK_RUNNING, claimed=None,
+                                                         attempts=tasks.MAX_ATTEMPTS - 1)
+        self.assertEqual(tasks.run_pending(), 0)
+        task.refresh_from_db()
+        self.assertEqual(task.status, TASK_FAILED)
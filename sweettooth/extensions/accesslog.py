@@ -0,0 +1,223 @@
+"""
+Download statistics from the web server's access logs.
+
+Rather than writing to the database on every download, importaccesslogs
+reads the nginx logs afterwards, in the "main" format used by
+etc/sweettooth.nginx.conf.example, and adds the downloads up into
+DownloadStat rows: one per extension, version, shell version and day.
+
+Logs are read incrementally. An AccessLogCheckpoint records how far each
+file has been read, keyed by its first line, so a log that has since
+been rotated or compressed is picked up where it was left.
+"""
+
+import datetime
+import gzip
+import hashlib
+import re
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from django.core.files.storage import default_storage
+from django.db import transaction
+
+# $remote_addr - $remote_user [$time_local] "$request" $status ...
+LINE_RE = re.compile(rb'^\S+ \S+ \S+ \[(?P<day>\d\d/\w{3}/\d{4}):[^\]]*\] '
+                     rb'"(?P<method>[A-Z]+) (?P<target>\S+)[^"]*" (?P<status>\d{3}) ')
+
+MONTHS = dict((month, number) for number, month in enumerate(
+    [b'Jan', b'Feb', b'Mar', b'Apr', b'May', b'Jun',
+     b'Jul', b'Aug', b'Sep', b'Oct', b'Nov', b'Dec'], 1))
+
+SHELL_DOWNLOAD_RE = re.compile(r'^/download-extension/(?P<uuid>.+)\.shell-extension\.zip$')
+
+# Sources and published archives (see make_filename and
+# make_published_name) both start with the UUID and version number.
+ARCHIVE_RE = re.compile(r'^/extension-data/(?:download/)?(?P<uuid>.+)\.v(?P<version>\d+)'
+                        r'(?:\.[0-9a-f]{16})?\.shell-extension\.zip$')
+
+# Lines read between writes of the counts and checkpoint.
+FLUSH_LINES = 100000
+
+def parse_day(value):
+    """Parse b'10/Oct/2000' into a date."""
+    return datetime.date(int(value[7:11]), MONTHS[value[3:6]], int(value[0:2]))
+
+def parse_line(line):
+    """
+    Return (kind, match, query, day) for a successful download in a log
+    line, or None. kind is 'download' for /download-extension/ requests,
+    matched by SHELL_DOWNLOAD_RE, and 'fetch' for archives, matched by
+    ARCHIVE_RE.
+    """
+    m = LINE_RE.match(line)
+    if m is None or m.group('method') != b'GET':
+        return None
+
+    status = m.group('status')
+    if status not in (b'200', b'302'):
+        return None
+
+    target = urlsplit(m.group('target').decode('latin-1'))
+    path = unquote(target.path)
+
+    if status == b'302':
+        download = SHELL_DOWNLOAD_RE.match(path)
+        if download is not None:
+            return 'download', download, parse_qs(target.query), parse_day(m.group('day'))
+    else:
+        # Partial responses aren't counted, only whole archives.
+        archive = ARCHIVE_RE.match(path)
+        if archive is not None:
+            return 'fetch', archive, None, parse_day(m.group('day'))
+
+    return None
+
+class DownloadCounter(object):
+    """Turns log lines into counts, keyed like DownloadStat rows."""
+
+    def __init__(self):
+        from sweettooth.extensions.models import ExtensionVersion
+
+        self.extensions = {}
+        self.versions = {}
+        self.version_tags = {}
+
+        for pk, number, extension_pk, uuid in ExtensionVersion.objects.values_list('pk', 'version',
+                                                                                   'extension_id',
+                                                                                   'extension__uuid'):
+            self.extensions[uuid] = extension_pk
+            self.version_tags[pk] = extension_pk
+            self.versions[(uuid, number)] = (extension_pk, pk)
+
+        # Published names go through the storage's get_valid_name, which
+        # drops characters like '@' from the UUID.
+        for (uuid, number), pks in list(self.versions.items()):
+            self.versions.setdefault((default_storage.get_valid_name(uuid), number), pks)
+
+        self.counts = {}
+        self.unknown = 0
+
+    def add_line(self, line):
+        parsed = parse_line(line)
+        if parsed is None:
+            return
+
+        kind, match, query, day = parsed
+        if kind == 'download':
+            extension_pk = self.extensions.get(match.group('uuid'))
+            if extension_pk is None:
+                self.unknown += 1
+                return
+
+            version_pk = None
+            try:
+                version_pk = int(query.get('version_tag', [''])[0])
+            except ValueError:
+                pass
+            if self.version_tags.get(version_pk) != extension_pk:
+                version_pk = None
+
+            shell_version = query.get('shell_version', [''])[0][:16]
+            key = (extension_pk, version_pk, shell_version, day)
+        else:
+            pks = self.versions.get((match.group('uuid'), int(match.group('version'))))
+            if pks is None:
+                self.unknown += 1
+                return
+
+            key = pks + ("", day)
+
+        counts = self.counts.setdefault(key, [0, 0])
+        counts[0 if kind == 'download' else 1] += 1
+
+    def pop_counts(self):
+        counts, self.counts = self.counts, {}
+        return counts
+
+def add_download_stats(counts):
+    """
+    Add counts, {(extension pk, version pk, shell version, day):
+    [downloads, fetches]}, to the DownloadStat rows.
+    """
+    from sweettooth.extensions.models import DownloadStat
+
+    if not counts:
+        return
+
+    days = set(key[3] for key in counts)
+    with transaction.atomic():
+        existing = {}
+        for stat in DownloadStat.objects.select_for_update().filter(day__in=days):
+            existing[(stat.extension_id, stat.version_id, stat.shell_version, stat.day)] = stat
+
+        changed = []
+        new = []
+        for key, (downloads, fetches) in counts.items():
+            stat = existing.get(key)
+            if stat is None:
+                extension_pk, version_pk, shell_version, day = key
+                new.append(DownloadStat(extension_id=extension_pk, version_id=version_pk,
+                                        shell_version=shell_version, day=day,
+                                        downloads=downloads, fetches=fetches))
+            else:
+                stat.downloads += downloads
+                stat.fetches += fetches
+                changed.append(stat)
+
+        DownloadStat.objects.bulk_update(changed, ['downloads', 'fetches'], batch_size=500)
+        DownloadStat.objects.bulk_create(new, batch_size=500)
+
+def open_log(path):
+    """Open a log file for reading bytes, decompressing it if gzipped."""
+    f = open(path, 'rb')
+    if f.read(2) == b'\x1f\x8b':
+        f.close()
+        return gzip.open(path, 'rb')
+
+    f.seek(0)
+    return f
+
+def import_log(path, counter):
+    """
+    Count the downloads in the log at path that haven't been counted yet.
+    Returns the number of lines read.
+    """
+    from sweettooth.extensions.models import AccessLogCheckpoint
+
+    with open_log(path) as f:
+        first = f.readline()
+        if not first.endswith(b'\n'):
+            # Nothing complete to read yet.
+            return 0
+
+        fingerprint = hashlib.sha256(first).hexdigest()
+        checkpoint, created = AccessLogCheckpoint.objects.get_or_create(fingerprint=fingerprint,
+                                                                        defaults=dict(filename=path))
+
+        f.seek(checkpoint.offset)
+        offset = checkpoint.offset
+        lines = 0
+
+        for line in f:
+            if not line.endswith(b'\n'):
+                # Still being written; leave it for next time.
+                break
+
+            counter.add_line(line)
+            offset += len(line)
+            lines += 1
+
+            if lines % FLUSH_LINES == 0:
+                save_progress(counter, checkpoint, path, offset)
+
+        save_progress(counter, checkpoint, path, offset)
+
+    return lines
+
+def save_progress(counter, checkpoint, path, offset):
+    # Together, so the counts are never added twice or lost.
+    with transaction.atomic():
+        add_download_stats(counter.pop_counts())
+        checkpoint.filename = path
+        checkpoint.offset = offset
+        checkpoint.save()
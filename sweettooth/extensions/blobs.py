@@ -0,0 +1,290 @@
+"""
+A content-addressed store for the files in extension archives.
+
+Consecutive versions of an extension share most of their files, so each
+file is kept once, under its sha256, however many versions include it.
+The references to a blob are the ExtensionVersionFile rows with its
+hash; counting them needs no bookkeeping of its own that could drift.
+Blobs nothing refers to any more are removed by collect_garbage.
+"""
+
+import datetime
+import hashlib
+import os
+import tempfile
+import time
+
+from zipfile import ZipFile, ZIP_DEFLATED
+
+from django.conf import settings
+from django.db.models import Count, Sum
+
+def get_blob_path(sha256):
+    return os.path.join(settings.EXTENSION_BLOB_ROOT, sha256[:2], sha256[2:])
+
+def has_blob(sha256):
+    return os.path.exists(get_blob_path(sha256))
+
+def open_blob(sha256):
+    return open(get_blob_path(sha256), 'rb')
+
+class BlobWriter(object):
+    """
+    A file being written into the store. It's kept under a temporary
+    name until commit() moves it under its hash.
+    """
+
+    def __init__(self):
+        os.makedirs(settings.EXTENSION_BLOB_ROOT, exist_ok=True)
+        fd, self.temp_path = tempfile.mkstemp(dir=settings.EXTENSION_BLOB_ROOT, suffix='.tmp')
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self.file.write(data)
+
+    def commit(self, sha256):
+        path = get_blob_path(sha256)
+
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+        if os.path.exists(path):
+            # We have it already. Refresh its mtime so a concurrent
+            # collect_garbage doesn't take it before our reference to it
+            # is committed.
+            os.unlink(self.temp_path)
+            os.utime(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.chmod(self.temp_path, 0o644)
+            os.replace(self.temp_path, path)
+
+        self.temp_path = None
+
+    def discard(self):
+        if self.temp_path is not None:
+            self.file.close()
+            os.unlink(self.temp_path)
+            self.temp_path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.discard()
+
+def store_blob(contents):
+    """Store contents, bytes, and return their sha256."""
+    sha256 = hashlib.sha256(contents).hexdigest()
+    try:
+        # Refresh its mtime, as BlobWriter.commit does, so collect_garbage
+        # leaves it be until our reference to it is committed.
+        os.utime(get_blob_path(sha256))
+    except FileNotFoundError:
+        with BlobWriter() as writer:
+            writer.write(contents)
+            writer.commit(sha256)
+    return sha256
+
+def iter_blobs():
+    """Yield (sha256, path) for the blobs in the store."""
+    root = settings.EXTENSION_BLOB_ROOT
+    if not os.path.isdir(root):
+        return
+
+    for prefix in sorted(os.listdir(root)):
+        directory = os.path.join(root, prefix)
+        if len(prefix) != 2 or not os.path.isdir(directory):
+            continue
+
+        for name in sorted(os.listdir(directory)):
+            yield prefix + name, os.path.join(directory, name)
+
+def get_refcounts():
+    """Return {sha256: number of files referring to it}."""
+    from sweettooth.extensions.models import ExtensionVersionFile
+    return dict(ExtensionVersionFile.objects.values('sha256')
+                                            .annotate(count=Count('pk'))
+                                            .values_list('sha256', 'count'))
+
+def store_version_blobs(version):
+    """
+    Store the files of an already uploaded version, decompressing its
+    archive. Returns how many weren't in the store yet.
+    """
+    from sweettooth.extensions.models import hash_zipfile_member
+
+    hashes = version.get_file_hashes()
+    zipfile = version.get_cached_zipfile()
+
+    count = 0
+    for filename, sha256 in hashes.items():
+        if has_blob(sha256):
+            continue
+
+        with BlobWriter() as writer:
+            actual, contents = hash_zipfile_member(zipfile, zipfile.getinfo(filename), output=writer)
+            if actual != sha256:
+                raise ValueError("%s in %s doesn't match its stored hash" % (filename, version))
+            writer.commit(sha256)
+        count += 1
+
+    return count
+
+def build_archive(version, fileobj):
+    """
+    Assemble the archive of version from the store, into fileobj. The
+    contents match the original archive, though the bytes won't.
+    """
+    with ZipFile(fileobj, 'w', ZIP_DEFLATED) as zipfile:
+        for f in version.files.order_by('pk'):
+            with open_blob(f.sha256) as blob, zipfile.open(f.filename, 'w') as member:
+                for block in iter(lambda: blob.read(64 * 1024), b''):
+                    member.write(block)
+
+def check_archive(version):
+    """
+    Check that the store holds everything needed to rebuild the archive
+    of version: build it with build_archive and compare each file's CRC
+    and size with the original's. Returns a list of problems.
+    """
+    hashes = version.get_file_hashes()
+    missing = sorted(filename for filename, sha256 in hashes.items() if not has_blob(sha256))
+    if missing:
+        return ["%s isn't in the store" % (filename,) for filename in missing]
+
+    original = dict((info.filename, info) for info in version.get_cached_zipfile().infolist()
+                    if not info.is_dir())
+
+    with tempfile.TemporaryFile() as f:
+        build_archive(version, f)
+        f.seek(0)
+        with ZipFile(f, 'r') as zipfile:
+            built = dict((info.filename, info) for info in zipfile.infolist())
+
+    problems = []
+    for filename in sorted(set(original) | set(built)):
+        if filename not in built:
+            problems.append("%s isn't in the store" % (filename,))
+        elif filename not in original:
+            problems.append("%s isn't in the archive" % (filename,))
+        elif (original[filename].CRC, original[filename].file_size) != (built[filename].CRC,
+                                                                       built[filename].file_size):
+            problems.append("%s differs from the store" % (filename,))
+
+    return problems
+
+def verify_blobs():
+    """Yield the sha256 of every blob whose contents don't match it."""
+    for sha256, path in iter_blobs():
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(64 * 1024), b''):
+                digest.update(block)
+
+        if digest.hexdigest() != sha256:
+            yield sha256
+
+def collect_garbage(grace=datetime.timedelta(days=1), dry_run=False):
+    """
+    Remove the blobs no file refers to. Blobs written in the last grace
+    period are kept: their references may not be committed yet.
+
+    Returns the number of blobs and bytes removed.
+    """
+    refcounts = get_refcounts()
+    cutoff = time.time() - grace.total_seconds()
+
+    count = size = 0
+    for sha256, path in iter_blobs():
+        if refcounts.get(sha256):
+            continue
+
+        stat = os.stat(path)
+        if stat.st_mtime > cutoff:
+            continue
+
+        if not dry_run:
+            os.unlink(path)
+        count += 1
+        size += stat.st_size
+
+    return count, size
+
+def link_identical_archives(versions, dry_run=False):
+    """
+    Hard link the sources of versions that are byte for byte identical,
+    so each is stored once. Returns the number of archives linked and
+    bytes saved.
+
+    Archives are only ever replaced through a rename (see
+    replace_zipfile_members), so rewriting one never changes the others.
+    """
+    by_hash = {}
+    count = size = 0
+
+    for version in versions:
+        path = version.source.storage.path(version.source.name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(64 * 1024), b''):
+                digest.update(block)
+
+        key = (stat.st_size, digest.hexdigest())
+        original = by_hash.setdefault(key, path)
+        if original == path:
+            continue
+
+        original_stat = os.stat(original)
+        if (original_stat.st_dev, original_stat.st_ino) == (stat.st_dev, stat.st_ino):
+            continue
+
+        if not dry_run:
+            temp_path = path + '.link'
+            os.link(original, temp_path)
+            os.replace(temp_path, path)
+        count += 1
+        size += stat.st_size
+
+    return count, size
+
+def get_usage():
+    """
+    Sizes, in bytes, of the archives, of what the store holds, and of
+    what refers to it. Archives are all kept, so the store's size comes
+    on top of theirs.
+    """
+    from sweettooth.extensions.models import ExtensionVersion, ExtensionVersionFile
+
+    # Identical archives may be hard linked together; count them once.
+    archives = {}
+    for version in ExtensionVersion.objects.exclude(source="").iterator():
+        try:
+            stat = os.stat(version.source.storage.path(version.source.name))
+        except FileNotFoundError:
+            continue
+        archives[(stat.st_dev, stat.st_ino)] = stat.st_size
+
+    refcounts = get_refcounts()
+    stored = referenced = unreferenced = 0
+    for sha256, path in iter_blobs():
+        size = os.stat(path).st_size
+        stored += size
+        if refcounts.get(sha256):
+            referenced += 1
+        else:
+            unreferenced += 1
+
+    logical = ExtensionVersionFile.objects.aggregate(size=Sum('size'))['size'] or 0
+    return dict(archive_bytes=sum(archives.values()),
+                blobs=referenced + unreferenced,
+                unreferenced_blobs=unreferenced,
+                stored_bytes=stored,
+                logical_bytes=logical,
+                missing_blobs=sum(1 for sha256 in refcounts if not has_blob(sha256)))
@@ -0,0 +1,137 @@
+"""
+Scaled down copies of extension icons and screenshots.
+
+Uploads are kept as they are, but pages show copies no larger than they
+are displayed at, in PNG and, where Pillow can write it, WebP. The copies
+are made by a background task after each upload and recorded in
+Extension.image_variants_json along with the name of the image they were
+made from, so a new upload stops the old copies being used straight away.
+"""
+
+import hashlib
+import json
+import os
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.db import transaction
+
+from PIL import Image, features
+
+# (variant, longest side in pixels) for each image field of Extension.
+VARIANT_SIZES = {
+    'icon': (('thumbnail', 32), ('list', 64), ('detail', 128)),
+    'screenshot': (('thumbnail', 240), ('list', 480), ('detail', 960)),
+}
+
+def get_formats():
+    """(format, file extension, save options) to write variants in."""
+    formats = [('PNG', 'png', dict(optimize=True))]
+    if features.check('webp'):
+        formats.append(('WEBP', 'webp', dict(quality=85, method=6)))
+    return formats
+
+def scale_image(image, size):
+    scaled = image.copy()
+    if scaled.mode not in ('RGB', 'RGBA'):
+        scaled = scaled.convert('RGBA')
+    # Only ever shrinks.
+    scaled.thumbnail((size, size), Image.LANCZOS)
+    return scaled
+
+def load_variants(extension):
+    return json.loads(extension.image_variants_json or "{}")
+
+def make_variants(fieldfile, sizes):
+    """
+    Write the variants of the image in fieldfile. Returns
+    {variant: {file extension: storage name}}.
+    """
+    storage = fieldfile.storage
+
+    with fieldfile.open('rb') as f:
+        data = f.read()
+
+    image = Image.open(BytesIO(data))
+    image.load()
+
+    # Names change with the image, so they can be cached for good.
+    base = os.path.splitext(fieldfile.name)[0]
+    token = hashlib.sha256(data).hexdigest()[:12]
+
+    variants = {}
+    for variant, size in sizes:
+        scaled = scale_image(image, size)
+        names = variants[variant] = {}
+
+        for format, ext, options in get_formats():
+            output = BytesIO()
+            scaled.save(output, format, **options)
+
+            name = "%s.%s.%s.%s" % (base, token, variant, ext)
+            if storage.exists(name):
+                storage.delete(name)
+            names[ext] = storage.save(name, ContentFile(output.getvalue()))
+
+    return variants
+
+def update_image_variants(extension, field):
+    """Make the variants of one image of extension, and record them."""
+    from sweettooth.extensions.models import Extension
+
+    fieldfile = getattr(extension, field)
+    variants = None
+    if fieldfile:
+        try:
+            variants = make_variants(fieldfile, VARIANT_SIZES[field])
+        except (IOError, ValueError, Image.DecompressionBombError):
+            # Not an image we can read; pages keep showing it as uploaded.
+            pass
+
+    with transaction.atomic():
+        # Only this field's entry changes; don't lose another task's.
+        current = Extension.objects.select_for_update().get(pk=extension.pk)
+        all_variants = load_variants(current)
+        old = all_variants.pop(field, None)
+
+        if variants is not None:
+            all_variants[field] = dict(source=fieldfile.name, variants=variants)
+
+        extension.image_variants_json = json.dumps(all_variants, sort_keys=True)
+        Extension.objects.filter(pk=extension.pk).update(image_variants_json=extension.image_variants_json)
+
+    if old is not None:
+        new_names = set()
+        if variants is not None:
+            new_names = set(name for names in variants.values() for name in names.values())
+
+        for names in old['variants'].values():
+            for name in names.values():
+                if name not in new_names:
+                    fieldfile.storage.delete(name)
+
+def generate_image_variants(extension_pk, field):
+    """Background task: see update_image_variants."""
+    from sweettooth.extensions.models import Extension
+
+    try:
+        extension = Extension.objects.get(pk=extension_pk)
+    except Extension.DoesNotExist:
+        return
+
+    update_image_variants(extension, field)
+
+def get_variant_name(extension, field, variant, ext='png'):
+    """
+    Return the storage name of a variant of the current image in field,
+    or None if there isn't one (yet).
+    """
+    fieldfile = getattr(extension, field)
+    if not fieldfile:
+        return None
+
+    entry = load_variants(extension).get(field)
+    if entry is None or entry['source'] != fieldfile.name:
+        return None
+
+    return entry['variants'].get(variant, {}).get(ext)
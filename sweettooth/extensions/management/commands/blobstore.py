@@ -0,0 +1,77 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from zipfile import BadZipfile
+
+from sweettooth.extensions import blobs
+from sweettooth.extensions.models import ExtensionVersion
+
+def format_size(size):
+    return "%.1f MiB" % (size / 1024 / 1024,)
+
+class Command(BaseCommand):
+    help = 'Reports on, fills and cleans up the store of extension files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fill', action='store_true',
+                            help='Store the files of versions uploaded before the store existed')
+        parser.add_argument('--link-archives', action='store_true',
+                            help='Hard link identical archives together')
+        parser.add_argument('--gc', action='store_true',
+                            help='Remove the files no version refers to')
+        parser.add_argument('--grace-days', type=float, default=1,
+                            help='Keep unreferenced files younger than this')
+        parser.add_argument('--verify', action='store_true',
+                            help='Check every stored file against its hash')
+        parser.add_argument('--check-archives', action='store_true',
+                            help='Check that every archive can be rebuilt from the store')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        versions = ExtensionVersion.objects.exclude(source="").order_by('pk')
+
+        if options['fill'] and not options['dry_run']:
+            count = 0
+            for version in versions.iterator():
+                try:
+                    count += blobs.store_version_blobs(version)
+                except (BadZipfile, IOError, ValueError) as e:
+                    self.stderr.write("%s: %s" % (version, e))
+            self.stdout.write("Stored %d new files" % (count,))
+
+        if options['link_archives']:
+            count, size = blobs.link_identical_archives(versions.iterator(), dry_run=options['dry_run'])
+            self.stdout.write("Linked %d identical archives, saving %s" % (count, format_size(size)))
+
+        if options['gc']:
+            grace = datetime.timedelta(days=options['grace_days'])
+            count, size = blobs.collect_garbage(grace, dry_run=options['dry_run'])
+            self.stdout.write("Removed %d unreferenced files, %s" % (count, format_size(size)))
+
+        if options['verify']:
+            bad = list(blobs.verify_blobs())
+            for sha256 in bad:
+                self.stderr.write("Corrupt: %s" % (blobs.get_blob_path(sha256),))
+            self.stdout.write("%d corrupt files" % (len(bad),))
+
+        if options['check_archives']:
+            count = 0
+            for version in versions.iterator():
+                try:
+                    problems = blobs.check_archive(version)
+                except (BadZipfile, IOError) as e:
+                    problems = [str(e)]
+
+                for problem in problems:
+                    self.stderr.write("%s: %s" % (version, problem))
+                count += bool(problems)
+            self.stdout.write("%d archives can't be rebuilt from the store" % (count,))
+
+        usage = blobs.get_usage()
+        self.stdout.write("Archives take %s" % (format_size(usage['archive_bytes']),))
+        self.stdout.write("The store takes %s more, in %d files (%d unreferenced)" %
+                          (format_size(usage['stored_bytes']), usage['blobs'], usage['unreferenced_blobs']))
+        self.stdout.write("Without sharing files between versions, it would take %s" %
+                          (format_size(usage['logical_bytes']),))
+        if usage['missing_blobs']:
+            self.stdout.write("%d referenced files are missing; run with --fill" % (usage['missing_blobs'],))
@@ -1,31 +1,121 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from zipfile import BadZipfile, ZipFile
 
+from django.db import connections
 from django.core.management.base import BaseCommand
-from sweettooth.extensions.models import ExtensionVersion, STATUS_REJECTED
-from zipfile import BadZipfile
+from django.utils import timezone
+
+from sweettooth.extensions import search
+from sweettooth.extensions.models import ArchiveCheck, Extension, ExtensionVersion, STATUS_REJECTED
+
+def check_archive(pk, path):
+    """
+    Check the CRCs of every member of the archive at path, and hash it.
+    Runs in the worker processes, so it doesn't touch the database.
+    """
+    result = dict(pk=pk, mtime_ns=None, size=None, sha256="", crc_ok=False, error="")
+
+    try:
+        stat = os.stat(path)
+        result.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(64 * 1024), b''):
+                sha256.update(block)
+        result['sha256'] = sha256.hexdigest()
+
+        with ZipFile(path, 'r') as zipfile:
+            badfile = zipfile.testzip()
+    except IOError as e:
+        result['error'] = "Unable to read zip file: %s" % (e,)
+    except (BadZipfile, EOFError, NotImplementedError, RuntimeError) as e:
+        result['error'] = "Bad zip file: %s" % (e,)
+    else:
+        if badfile:
+            result['error'] = "Bad entry %s in zip file" % (badfile,)
+        else:
+            result['crc_ok'] = True
+
+    return result
+
+def check_archives(jobs):
+    return [check_archive(pk, path) for pk, path in jobs]
 
 class Command(BaseCommand):
     help = "Checks consistency of extension's archives."
 
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--batch', type=int, default=50,
+                            help='Versions handed to a worker at a time')
+        parser.add_argument('--force', action='store_true',
+                            help='Check archives again even if unchanged since they last passed')
+        parser.add_argument('--reject', action='store_true',
+                            help='Reject the versions with bad archives')
+
+    def get_jobs(self, force):
+        versions = ExtensionVersion.objects.exclude(status=STATUS_REJECTED).exclude(source="")
+        versions = versions.select_related('archive_check').order_by('pk')
+
+        skipped = 0
+        jobs = []
+        for version in versions.iterator():
+            path = version.source.storage.path(version.source.name)
+
+            if not force:
+                try:
+                    stat = os.stat(path)
+                    if version.archive_check.is_current(stat):
+                        skipped += 1
+                        continue
+                except (OSError, ArchiveCheck.DoesNotExist):
+                    pass
+
+            jobs.append((version.pk, path))
+
+        return jobs, skipped
+
+    def iter_results(self, jobs, workers, batch):
+        batches = [jobs[i:i + batch] for i in range(0, len(jobs), batch)]
+
+        if workers < 2 or len(batches) < 2:
+            for results in map(check_archives, batches):
+                yield results
+            return
+
+        # The workers are forked; don't let them share our connection.
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for results in executor.map(check_archives, batches):
+                yield results
+
     def handle(self, *args, **options):
-        for version in ExtensionVersion.objects.exclude(status=STATUS_REJECTED):
-            badversion = True
-            try:
-                with version.get_zipfile('r') as zip:
-                    badfile = zip.testzip()
+        jobs, skipped = self.get_jobs(options['force'])
+        self.stdout.write("Checking %d archives, %d unchanged since they passed" % (len(jobs), skipped))
 
-                    if badfile:
-                        self.stderr.write("[%s: %d] Bad entry %s in zip file" % (version.extension.name, version.version, badfile))
-                    else:
-                        badversion = False
+        bad = []
+        for results in self.iter_results(jobs, options['workers'], options['batch']):
+            # Saved batch by batch, so an interrupted run resumes where
+            # it stopped: what passed is unchanged and skipped next time.
+            now = timezone.now()
+            for result in results:
+                pk = result.pop('pk')
+                ArchiveCheck.objects.update_or_create(version_id=pk, defaults=dict(result, checked=now))
 
-            except IOError, e:
-                self.stderr.write("[%s: %d] Unable to find zip file: %s" % (version.extension.name, version.version, str(e)))
-            except BadZipfile, e:
-                self.stderr.write("[%s: %d] Bad zip file: %s" % (version.extension.name, version.version, version.source.name))
+                if not result['crc_ok']:
+                    version = ExtensionVersion.objects.select_related('extension').get(pk=pk)
+                    self.stderr.write("[%s: %d] %s" % (version.extension.name, version.version, result['error']))
+                    bad.append(pk)
 
-            if badversion:
-                self.stdout.write("[%s: %d] Rejecting" % (version.extension.name, version.version))
+        if bad and options['reject']:
+            ExtensionVersion.objects.filter(pk__in=bad).update(status=STATUS_REJECTED)
+            self.stdout.write("Rejected %d versions" % (len(bad),))
 
-            self.stdout.flush()
+            # update() skips the post_save handler that reindexes them.
+            for extension in Extension.objects.filter(versions__pk__in=bad).distinct():
+                search.index_extension(extension)
 
-        self.stdout.write('Done')
+        self.stdout.write("Done: %d bad archives" % (len(bad),))
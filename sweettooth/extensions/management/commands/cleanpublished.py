@@ -0,0 +1,20 @@
+import datetime
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from sweettooth.extensions.models import remove_stale_published_archives
+
+class Command(BaseCommand):
+    help = 'Removes published archives that were superseded by newer copies'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-days', type=float, default=1,
+                            help='Keep archives superseded more recently than this')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        count = remove_stale_published_archives(default_storage,
+                                                datetime.timedelta(days=options['grace_days']),
+                                                dry_run=options['dry_run'])
+        self.stdout.write("Removed %d stale archives" % (count,))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from sweettooth.extensions import images
+from sweettooth.extensions.models import Extension
+
+class Command(BaseCommand):
+    help = 'Makes the scaled down copies of icons and screenshots that are missing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='Make them again even if they are up to date')
+
+    def handle(self, *args, **options):
+        extensions = Extension.objects.filter(~Q(icon="") | ~Q(screenshot="")).order_by('pk')
+
+        count = 0
+        for extension in extensions.iterator():
+            for field in sorted(images.VARIANT_SIZES):
+                if not getattr(extension, field):
+                    continue
+
+                if not options['force'] and images.get_variant_name(extension, field, 'thumbnail'):
+                    continue
+
+                images.update_image_variants(extension, field)
+                count += 1
+
+        self.stdout.write("Made the variants of %d images" % (count,))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from sweettooth.extensions.accesslog import DownloadCounter, import_log
+
+class Command(BaseCommand):
+    help = 'Counts the downloads in nginx access logs, plain or gzipped, into the daily download statistics'
+
+    def add_arguments(self, parser):
+        parser.add_argument('filenames', nargs='+', metavar='access_log',
+                            help='Logs to read; the parts already read are skipped, even if rotated since')
+
+    def handle(self, *args, **options):
+        counter = DownloadCounter()
+
+        for filename in options['filenames']:
+            try:
+                lines = import_log(filename, counter)
+            except (IOError, EOFError) as e:
+                raise CommandError("%s: %s" % (filename, e))
+
+            self.stdout.write("%s: %d new lines" % (filename, lines))
+
+        if counter.unknown:
+            self.stderr.write("Skipped %d downloads of unknown extensions" % (counter.unknown,))
@@ -1,21 +1,121 @@
+import sys
+from collections import OrderedDict
 
 from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
+
 from sweettooth.extensions.models import Extension
 
+def parse_download_data(f):
+    """
+    Yield (uuid, downloads) for each "downloads uuid" line of f, and
+    None for the lines that aren't.
+    """
+    for line in f:
+        fields = line.split()
+        if not fields:
+            continue
+
+        try:
+            downloads, uuid = fields
+            yield uuid, int(downloads, 10)
+        except ValueError:
+            yield None
+
+def iter_chunks(entries, size, merge):
+    """
+    Group entries into OrderedDicts of uuid to downloads, of up to size
+    extensions each. A UUID seen twice adds up when merging, else the
+    last count wins.
+    """
+    chunk = OrderedDict()
+    for uuid, downloads in entries:
+        if merge:
+            chunk[uuid] = chunk.get(uuid, 0) + downloads
+        else:
+            chunk[uuid] = downloads
+
+        if len(chunk) >= size:
+            yield chunk
+            chunk = OrderedDict()
+
+    if chunk:
+        yield chunk
+
 class Command(BaseCommand):
     args = 'downnload_data [download_data ...]'
     help = 'Populates the downloads field from a special whitespace-separated format, easy to generate with some shell scripts'
 
-    def handle(self, *filenames, **options):
+    def add_arguments(self, parser):
+        parser.add_argument('filenames', nargs='+', metavar='download_data',
+                            help='Files of "downloads uuid" lines; - for standard input')
+        parser.add_argument('--merge', action='store_true',
+                            help='Add the counts to the current ones instead of replacing them')
+        parser.add_argument('--chunk', type=int, default=1000,
+                            help='Extensions updated per query')
+
+    def iter_entries(self, filenames):
         for filename in filenames:
-            with open(filename, 'r') as download_data:
-                for line in download_data:
-                    downloads, uuid = line.split()
-
-                    try:
-                        ext = Extension.objects.get(uuid=uuid)
-                    except Extension.DoesNotExist:
-                        print "Skipping", uuid
-                    else:
-                        ext.downloads = int(downloads, 10)
-                        ext.save()
+            if filename == '-':
+                for entry in self.skip_malformed(sys.stdin):
+                    yield entry
+                continue
+
+            try:
+                f = open(filename, 'r')
+            except IOError as e:
+                raise CommandError(str(e))
+
+            with f:
+                for entry in self.skip_malformed(f):
+                    yield entry
+
+    def skip_malformed(self, f):
+        for entry in parse_download_data(f):
+            if entry is None:
+                self.malformed += 1
+            else:
+                yield entry
+
+    def handle(self, *args, **options):
+        if options['chunk'] < 1:
+            raise CommandError("--chunk must be positive")
+
+        self.malformed = 0
+        updated = 0
+        unknown = OrderedDict()
+
+        entries = self.iter_entries(options['filenames'])
+        for chunk in iter_chunks(entries, options['chunk'], options['merge']):
+            pks = dict(Extension.objects.filter(uuid__in=list(chunk)).values_list('uuid', 'pk'))
+
+            extensions = []
+            for uuid, downloads in chunk.items():
+                pk = pks.get(uuid)
+                if pk is None:
+                    unknown[uuid] = unknown.get(uuid, 0) + downloads
+                    continue
+
+                # Only the downloads column is written: no save(), so no
+                # signals and no metadata.json work.
+                extension = Extension(pk=pk)
+                extension.downloads = F('downloads') + downloads if options['merge'] else downloads
+                extensions.append(extension)
+
+            with transaction.atomic():
+                Extension.objects.bulk_update(extensions, ['downloads'])
+            updated += len(extensions)
+
+        self.stdout.write("Updated %d extensions" % (updated,))
+
+        if self.malformed:
+            self.stderr.write("Skipped %d malformed lines" % (self.malformed,))
+
+        if unknown:
+            self.stderr.write("Skipped %d unknown UUIDs, with %d downloads:" %
+                              (len(unknown), sum(unknown.values())))
+            for uuid, downloads in sorted(unknown.items(), key=lambda item: -item[1])[:20]:
+                self.stderr.write("  %8d %s" % (downloads, uuid))
+            if len(unknown) > 20:
+                self.stderr.write("  ...")
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from sweettooth.ratings.models import recompute_ratings
+
+class Command(BaseCommand):
+    help = 'Recounts the ratings of every extension from its comments'
+
+    def handle(self, *args, **options):
+        count = recompute_ratings()
+        self.stdout.write("Fixed the ratings of %d extensions" % (count,))
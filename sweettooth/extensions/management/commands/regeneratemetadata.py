@@ -1,12 +1,162 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from zipfile import BadZipfile, ZipFile
+
 from django.core.management.base import BaseCommand, CommandError
-from sweettooth.extensions.models import ExtensionVersion
+from django.db import connections
+
+from sweettooth.extensions.models import (ExtensionVersion, STATUSES, hash_metadata_json,
+                                          replace_zipfile_members)
+
+def rewrite_metadata_json(pk, path, contents):
+    """
+    Replace metadata.json in the archive at path, unless it already has
+    contents. Runs in the worker processes, so it doesn't touch the
+    database. Returns (pk, 'unchanged', 'rewritten' or 'error', message,
+    the sha256 of the rewritten archive).
+    """
+    try:
+        with ZipFile(path, 'r') as zipfile:
+            try:
+                current = zipfile.read("metadata.json")
+            except KeyError:
+                current = None
+
+        if current is not None and hash_metadata_json(current) == hash_metadata_json(contents):
+            return pk, 'unchanged', "", None
+
+        sha256 = replace_zipfile_members(path, {"metadata.json": contents})
+    except (IOError, BadZipfile) as e:
+        return pk, 'error', str(e), None
+
+    return pk, 'rewritten', "", sha256
+
+def rewrite_batch(jobs):
+    return [rewrite_metadata_json(*job) for job in jobs]
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
 
 class Command(BaseCommand):
     args = ''
     help = 'Regenerates all metadata.json files and replaces them in the zipfile'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--extension', action='append', metavar='UUID',
+                            help='Only the versions of this extension')
+        parser.add_argument('--status', action='append', choices=[s.lower() for s in STATUSES.values()],
+                            help='Only versions with this status')
+        parser.add_argument('--force', action='store_true',
+                            help="Look into every archive, even if the stored hash says it's up to date")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--batch', type=int, default=100,
+                            help='Versions loaded, and handed to a worker, at a time')
+
+    def get_versions(self, options):
+        versions = ExtensionVersion.objects.exclude(source="")
+
+        if options['extension']:
+            versions = versions.filter(extension__uuid__in=options['extension'])
+        if options['status']:
+            by_name = dict((name.lower(), status) for status, name in STATUSES.items())
+            versions = versions.filter(status__in=[by_name[name] for name in options['status']])
+
+        return versions.order_by('pk')
+
+    def iter_batches(self, versions, size, force):
+        """
+        Yield (versions by pk, jobs) for batches of versions whose
+        metadata.json may need rewriting.
+        """
+        pks = list(versions.values_list('pk', flat=True))
+        for i in range(0, len(pks), size):
+            batch = (ExtensionVersion.objects.filter(pk__in=pks[i:i + size])
+                                             .select_related('extension')
+                                             .prefetch_related('shell_versions'))
+
+            by_pk = {}
+            jobs = []
+            for version in batch:
+                contents = version.make_metadata_json_string()
+                if not force and version.metadata_hash == hash_metadata_json(contents):
+                    continue
+
+                by_pk[version.pk] = (version, contents)
+                jobs.append((version.pk, version.source.storage.path(version.source.name), contents))
+
+            yield len(pks), len(batch), by_pk, jobs
+
     def handle(self, *args, **options):
-        versions = ExtensionVersion.objects.all()
-        for ver in versions:
-            ver.replace_metadata_json()
-        self.stdout.write('Successfully regenerated all metadata.json files\n')
+        if options['batch'] < 1:
+            raise CommandError("--batch must be positive")
+
+        versions = self.get_versions(options)
+        batches = self.iter_batches(versions, options['batch'], options['force'])
+
+        executor = None
+        counts = dict(skipped=0, unchanged=0, rewritten=0, error=0)
+        done = 0
+        start = time.time()
+
+        try:
+            # Keep the workers busy: submit each batch as soon as it's
+            # loaded, and collect results in order.
+            pending = []
+            for total, loaded, by_pk, jobs in batches:
+                counts['skipped'] += loaded - len(jobs)
+                done += loaded - len(jobs)
+
+                if options['workers'] > 1:
+                    if executor is None:
+                        # The workers are forked on the first submit, and
+                        # loading the batch reconnected to the database;
+                        # don't let them share the connection.
+                        connections.close_all()
+                        executor = ProcessPoolExecutor(max_workers=options['workers'])
+
+                    pending.append((by_pk, executor.submit(rewrite_batch, jobs)))
+                    if len(pending) <= options['workers']:
+                        continue
+                    by_pk, future = pending.pop(0)
+                    results = future.result()
+                else:
+                    results = rewrite_batch(jobs)
+
+                done += self.record(by_pk, results, counts)
+                self.progress(done, total, counts, start)
+
+            for by_pk, future in pending:
+                done += self.record(by_pk, future.result(), counts)
+                self.progress(done, total, counts, start)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        self.stdout.write("Done in %s: %d rewritten, %d already up to date, %d errors" %
+                          (format_duration(time.time() - start), counts['rewritten'],
+                           counts['skipped'] + counts['unchanged'], counts['error']))
+
+    def record(self, by_pk, results, counts):
+        for pk, result, message, sha256 in results:
+            version, contents = by_pk[pk]
+            counts[result] += 1
+
+            if result == 'rewritten':
+                version.metadata_json_replaced(contents, sha256)
+            elif result == 'unchanged':
+                version.set_metadata_hash(hash_metadata_json(contents))
+            else:
+                self.stderr.write("[%s: %d] %s" % (version.extension.uuid, version.version, message))
+
+        return len(results)
+
+    def progress(self, done, total, counts, start):
+        elapsed = time.time() - start
+        eta = elapsed / done * (total - done) if done else 0
+        self.stdout.write("%d/%d (%d%%) %d rewritten, %d up to date, %d errors, ETA %s" %
+                          (done, total, 100 * done // max(total, 1), counts['rewritten'],
+                           counts['skipped'] + counts['unchanged'], counts['error'],
+                           format_duration(eta)))
@@ -0,0 +1,27 @@
+# Generated by Django 2.2 on 2026-10-19 04:28
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('extensions', '0005_auto_20190112_1733'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExtensionVersionFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('filename', models.CharField(max_length=255)),
+                ('size', models.PositiveIntegerField()),
+                ('sha256', models.CharField(max_length=64)),
+                ('version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='files', to='extensions.ExtensionVersion')),
+            ],
+            options={
+                'unique_together': {('version', 'filename')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2 on 2026-10-19 04:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('extensions', '0006_extensionversionfile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='extensionversion',
+            name='changelog',
+            field=models.TextField(blank=True),
+        ),
+    ]
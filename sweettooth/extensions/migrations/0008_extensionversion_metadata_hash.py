@@ -0,0 +1,18 @@
+# Generated by Django 2.2 on 2026-10-19 04:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('extensions', '0007_extensionversion_changelog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='extensionversion',
+            name='metadata_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.2 on 2026-10-19 04:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('extensions', '0008_extensionversion_metadata_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='extensionversion',
+            name='published_name',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.CreateModel(
+            name='SupersededArchive',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('superseded', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2 on 2026-10-19 04:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('extensions', '0009_extensionversion_published_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='extension',
+            name='image_variants_json',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.2 on 2026-10-19 04:46
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('extensions', '0010_extension_image_variants_json'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveCheck',
+            fields=[
+                ('version', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='archive_check', serialize=False, to='extensions.ExtensionVersion')),
+                ('checked', models.DateTimeField()),
+                ('mtime_ns', models.BigIntegerField(null=True)),
+                ('size', models.BigIntegerField(null=True)),
+                ('sha256', models.CharField(blank=True, max_length=64)),
+                ('crc_ok', models.BooleanField(default=False)),
+                ('error', models.TextField(blank=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 2.2 on 2026-10-19 04:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('extensions', '0011_archivecheck'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccessLogCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(max_length=64, unique=True)),
+                ('filename', models.TextField()),
+                ('offset', models.BigIntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DownloadStat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shell_version', models.CharField(blank=True, max_length=16)),
+                ('day', models.DateField(db_index=True)),
+                ('downloads', models.PositiveIntegerField(default=0)),
+                ('fetches', models.PositiveIntegerField(default=0)),
+                ('extension', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='download_stats', to='extensions.Extension')),
+                ('version', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='download_stats', to='extensions.ExtensionVersion')),
+            ],
+            options={
+                'unique_together': {('extension', 'version', 'shell_version', 'day')},
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='downloadstat',
+            constraint=models.UniqueConstraint(condition=models.Q(version__isnull=True), fields=('extension', 'shell_version', 'day'), name='downloadstat_unique_without_version'),
+        ),
+    ]
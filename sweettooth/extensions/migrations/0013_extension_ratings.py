@@ -0,0 +1,37 @@
+# Generated by Django 2.2 on 2026-10-19 04:57
+
+from django.db import migrations, models
+import sweettooth.extensions.models
+from sweettooth.ratings.models import recompute_ratings
+
+
+def compute_ratings(apps, schema_editor):
+    recompute_ratings(apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('extensions', '0012_downloadstats'),
+        ('ratings', '0001_initial'),
+        ('contenttypes', '0002_remove_content_type_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='extension',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='extension',
+            name='rating_score',
+            field=models.FloatField(db_index=True, default=sweettooth.extensions.models.get_default_rating_score),
+        ),
+        migrations.AddField(
+            model_name='extension',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(compute_ratings, migrations.RunPython.noop),
+    ]
@@ -1,16 +1,31 @@
 
+import copy
+import datetime
+import hashlib
 import json
+import os
+import stat
+import struct
+import tempfile
+import zlib
 
-from zipfile import ZipFile, BadZipfile
+from zipfile import ZipFile, BadZipfile, sizeFileHeader, structFileHeader
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.db import models
+from django.db.models.signals import post_delete
 from django.dispatch import Signal
 from django.urls import reverse
 
 import autoslug
 import re
 
+from sweettooth.core import tasks
+from sweettooth.extensions import blobs, images
+from sweettooth.extensions.archives import get_archive_storage
+from sweettooth.utils import LRUCache
+
 (STATUS_UNREVIEWED,
  STATUS_REJECTED,
  STATUS_INACTIVE,
@@ -88,6 +103,25 @@ def make_icon_filename(obj, filename=None):
     return "icons/icon_%d.png" % (obj.pk,)
 
 
+# Extension fields that make_metadata_json puts into metadata.json.
+METADATA_FIELDS = ('name', 'description', 'url', 'uuid')
+
+# Extension fields kept up to date by sweettooth.ratings, with UPDATE
+# queries of their own. Views that save an extension they loaded pass
+# update_fields, so as not to write back ratings changed in between.
+RATING_FIELDS = ('rating_count', 'rating_sum', 'rating_score')
+
+def get_rating_score(count, total):
+    """
+    The mean of count ratings adding up to total, smoothed towards
+    EXTENSION_RATING_PRIOR_MEAN (a Bayesian average).
+    """
+    prior_count = settings.EXTENSION_RATING_PRIOR_COUNT
+    return (settings.EXTENSION_RATING_PRIOR_MEAN * prior_count + total) / (prior_count + count)
+
+def get_default_rating_score():
+    return get_rating_score(0, 0)
+
 class Extension(models.Model):
     name = models.CharField(max_length=200)
     uuid = models.CharField(max_length=200, unique=True, db_index=True)
@@ -99,6 +133,11 @@ class Extension(models.Model):
     downloads = models.PositiveIntegerField(default=0)
     popularity = models.IntegerField(default=0)
 
+    # The ratings of the public comments; see RATING_FIELDS.
+    rating_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_score = models.FloatField(default=get_default_rating_score, db_index=True)
+
     class Meta:
         permissions = (
             ("can-modify-data", "Can modify extension data"),
@@ -107,6 +146,10 @@ class Extension(models.Model):
     screenshot = models.ImageField(upload_to=make_screenshot_filename, blank=True)
     icon = models.ImageField(upload_to=make_icon_filename, blank=True, default="")
 
+    # Scaled down copies of the icon and screenshot; see
+    # sweettooth.extensions.images.
+    image_variants_json = models.TextField(blank=True, default="")
+
     objects = ExtensionManager()
 
     def __str__(self):
@@ -124,16 +167,51 @@ class Extension(models.Model):
         if not validate_uuid(self.uuid):
             raise ValidationError("Your extension has an invalid UUID")
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._saved_metadata_fields = self.get_metadata_fields()
+
+    def get_metadata_fields(self):
+        """
+        The fields copied into every version's metadata.json, leaving out
+        deferred ones so that loading them costs no queries.
+        """
+        deferred = self.get_deferred_fields()
+        return dict((name, getattr(self, name)) for name in METADATA_FIELDS
+                    if name not in deferred)
+
     def save(self, replace_metadata_json=True, *args, **kwargs):
+        adding = self._state.adding
         super().save(*args, **kwargs)
-        if replace_metadata_json:
-            for version in self.versions.all():
-                if version.source:
-                    try:
-                        version.replace_metadata_json()
-                    except BadZipfile:
-                        # Ignore bad zipfiles, we don't care
-                        pass
+
+        # A field loaded since __init__ counts as changed; the task only
+        # rewrites the versions whose metadata.json differs anyway.
+        metadata_fields = self.get_metadata_fields()
+        if replace_metadata_json and not adding and metadata_fields != self._saved_metadata_fields:
+            # Rewriting the archives of every version takes a while;
+            # don't do it in the request.
+            tasks.enqueue(update_versions_metadata_json, self.pk,
+                          key=get_metadata_task_key(self.pk))
+        self._saved_metadata_fields = metadata_fields
+
+    @property
+    def rating_average(self):
+        if not self.rating_count:
+            return None
+        return self.rating_sum / self.rating_count
+
+    def get_image_url(self, field, variant, ext='png'):
+        """
+        Return the URL of a variant of the icon or screenshot, falling
+        back to the image as uploaded until the variants are made.
+        """
+        fieldfile = getattr(self, field)
+        name = images.get_variant_name(self, field, variant, ext)
+        if name is not None:
+            return fieldfile.storage.url(name)
+        elif fieldfile and ext == 'png':
+            return fieldfile.url
+        return None
 
     def get_absolute_url(self):
         return reverse('extensions-detail', kwargs=dict(pk=self.pk,
@@ -248,33 +326,91 @@ class InvalidExtensionData(Exception):
         self.message = message
 
 
-def parse_zipfile_metadata(uploaded_file):
+def hash_zipfile_member(zipfile, info, keep=False, output=None):
     """
-    Given a file, extract out the metadata.json, parse, and return it.
+    Read a member through once, checking its CRC, and copy it to output
+    if given. Returns its sha256 and, if keep is set, its contents.
+    """
+    sha256 = hashlib.sha256()
+    blocks = [] if keep else None
+
+    with zipfile.open(info) as f:
+        for block in iter(lambda: f.read(64 * 1024), b''):
+            sha256.update(block)
+            if keep:
+                blocks.append(block)
+            if output is not None:
+                output.write(block)
+
+    return sha256.hexdigest(), b''.join(blocks) if keep else None
+
+class ScannedZipfile(object):
+    """
+    What scan_zipfile learned about an upload: the parsed metadata and
+    (filename, size, sha256) for each of its files.
+    """
+    def __init__(self, metadata, files):
+        self.metadata = metadata
+        self.files = files
+
+def scan_zipfile(uploaded_file):
+    """
+    Validate an uploaded extension in a single pass over its contents,
+    hashing every file and parsing metadata.json on the way.
     """
     try:
         zipfile = ZipFile(uploaded_file, 'r')
     except BadZipfile:
         raise InvalidExtensionData("Invalid zip file")
 
-    if zipfile.testzip() is not None:
-        raise InvalidExtensionData("Invalid zip file")
+    with zipfile:
+        infos = [info for info in zipfile.infolist() if not info.filename.endswith('/')]
 
-    total_uncompressed = sum(i.file_size for i in zipfile.infolist())
-    if total_uncompressed > 5*1024*1024: # 5 MB
-        raise InvalidExtensionData("Zip file is too large")
+        # The sizes in the central directory bound what reading the
+        # members can produce, so check them before decompressing anything.
+        total_uncompressed = sum(info.file_size for info in infos)
+        total_compressed = sum(info.compress_size for info in infos)
+        if total_uncompressed > settings.EXTENSION_MAX_UNCOMPRESSED_SIZE:
+            raise InvalidExtensionData("Zip file is too large")
+        if total_uncompressed > total_compressed * settings.EXTENSION_MAX_COMPRESSION_RATIO:
+            raise InvalidExtensionData("Zip file is compressed suspiciously well")
 
-    try:
-        metadata = json.load(zipfile.open('metadata.json', 'r'))
-    except KeyError:
+        files = []
+        metadata_json = None
+        for info in infos:
+            if len(info.filename) > ExtensionVersionFile._meta.get_field('filename').max_length:
+                raise InvalidExtensionData("File name is too long: %s" % (info.filename,))
+
+            try:
+                sha256, contents = hash_zipfile_member(zipfile, info,
+                                                       keep=info.filename == 'metadata.json')
+            except (BadZipfile, EOFError, NotImplementedError, RuntimeError, zlib.error):
+                # Bad CRCs, truncated data, encrypted members, or
+                # compression methods we can't read.
+                raise InvalidExtensionData("Invalid zip file")
+
+            files.append((info.filename, info.file_size, sha256))
+            if contents is not None:
+                metadata_json = contents
+
+    if metadata_json is None:
         # no metadata.json in archive, raise error
         raise InvalidExtensionData("Missing metadata.json")
+
+    try:
+        # From bytes, json detects the encoding and skips a BOM.
+        metadata = json.loads(metadata_json)
     except ValueError:
         # invalid JSON file, raise error
         raise InvalidExtensionData("Invalid JSON data")
 
-    zipfile.close()
-    return metadata
+    return ScannedZipfile(metadata, files)
+
+def parse_zipfile_metadata(uploaded_file):
+    """
+    Given a file, extract out the metadata.json, parse, and return it.
+    """
+    return scan_zipfile(uploaded_file).metadata
 
 # uuid max length + suffix max length
 filename_max_length = Extension._meta.get_field('uuid').max_length + len(".v000.shell-version.zip")
@@ -290,15 +426,239 @@ class ExtensionVersionManager(models.Manager):
         return self.filter(status=STATUS_ACTIVE)
 
 
+class SharedZipFile(ZipFile):
+    """
+    A read-only ZipFile that owns the file it reads, closing both when
+    it's closed or garbage collected. The cache only drops its reference
+    on eviction, so whoever still holds the ZipFile, like a streamed
+    review diff, keeps reading, and the file is closed once the last of
+    them lets go.
+    """
+
+    def __init__(self, f):
+        self._owned_file = f
+        try:
+            super().__init__(f, 'r')
+        except Exception:
+            f.close()
+            raise
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._owned_file.close()
+
+# Read-only ZipFiles of version sources, by storage and name, so the
+# central directory isn't fetched again on every review request.
+_open_zipfiles = LRUCache(settings.EXTENSION_OPEN_ZIPFILES)
+_open_zipfiles_pid = None
+
+def open_cached_zipfile(name, storage=None):
+    """
+    Return a shared, read-only ZipFile of the archive called name in
+    storage, by default the EXTENSION_ARCHIVE_STORAGE. Don't close it.
+
+    The archive is reopened when the storage says it changed.
+    """
+    global _open_zipfiles_pid
+
+    if storage is None:
+        storage = get_archive_storage()
+
+    # A forked child (like the check_files workers) must not share file
+    # handles with its parent, so it starts with its own.
+    if _open_zipfiles_pid != os.getpid():
+        _open_zipfiles.clear()
+        _open_zipfiles_pid = os.getpid()
+
+    key = (storage, name)
+    stamp = storage.stat(name)[0]
+
+    entry = _open_zipfiles.get(key)
+    if entry is not None and entry[0] == stamp:
+        return entry[1]
+
+    stamp, f = storage.open(name)
+    zipfile = SharedZipFile(f)
+    _open_zipfiles.set(key, (stamp, zipfile))
+    return zipfile
+
+# Flag bit set when a member's CRC and sizes follow its data instead of
+# being in the local header.
+ZIP_DATA_DESCRIPTOR = 0x08
+
+def _copy_raw_member(source, info, zipfile):
+    """
+    Append the member described by info, read from the open file source,
+    to zipfile without decompressing it.
+    """
+    source.seek(info.header_offset)
+    header = struct.unpack(structFileHeader, source.read(sizeFileHeader))
+    # The local header's name and extra field can differ from the
+    # central directory's, so skip by the lengths it gives itself.
+    source.seek(header[10] + header[11], os.SEEK_CUR)
+
+    info = copy.copy(info)
+    # The CRC and sizes are known from the central directory; put them in
+    # the new local header and drop the data descriptor.
+    info.flag_bits &= ~ZIP_DATA_DESCRIPTOR
+    info.header_offset = zipfile.fp.tell()
+    zipfile.fp.write(info.FileHeader())
+
+    remaining = info.compress_size
+    while remaining > 0:
+        block = source.read(min(remaining, 64 * 1024))
+        if not block:
+            raise BadZipfile("Truncated member %r" % (info.filename,))
+        zipfile.fp.write(block)
+        remaining -= len(block)
+
+    zipfile.filelist.append(info)
+    zipfile.NameToInfo[info.filename] = info
+    zipfile.start_dir = zipfile.fp.tell()
+
+def replace_zipfile_members(path, members):
+    """
+    Rewrite the archive at path with the members in members, a dict of
+    filename to contents, replacing or added after the others.
+
+    The other members are copied still compressed, a block at a time, so
+    nothing is recompressed and memory use doesn't grow with the archive.
+    The new archive is written next to the old one and renamed over it,
+    so readers see either the old or the new file, never a partial one.
+    Returns the sha256 of the new archive.
+    """
+    directory = os.path.dirname(path)
+    mode = stat.S_IMODE(os.stat(path).st_mode)
+
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with open(path, 'rb') as source, os.fdopen(fd, 'wb') as dest:
+            with ZipFile(source, 'r') as zipfile_in, ZipFile(dest, 'w') as zipfile_out:
+                for info in zipfile_in.infolist():
+                    if info.filename not in members:
+                        _copy_raw_member(source, info, zipfile_out)
+
+                for filename, contents in members.items():
+                    zipfile_out.writestr(filename, contents)
+
+            dest.flush()
+            os.fsync(dest.fileno())
+
+        # ZipFile seeks back to fill in the headers, so hash it once it's
+        # written; it's still in the page cache.
+        sha256 = hash_file(temp_path)
+
+        # mkstemp creates the file readable only by us.
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+    return sha256
+
+def hash_metadata_json(contents):
+    if isinstance(contents, str):
+        contents = contents.encode('utf-8')
+    return hashlib.sha256(contents).hexdigest()
+
+def get_metadata_task_key(pk):
+    return "metadata-json:%d" % (pk,)
+
+def update_versions_metadata_json(extension_pk):
+    """
+    Background task: bring metadata.json in the versions of an
+    extension up to date. Versions already done are skipped, so it's
+    safe to run again.
+    """
+    versions = ExtensionVersion.objects.filter(extension_id=extension_pk).exclude(source="")
+    for version in versions.select_related('extension').prefetch_related('shell_versions'):
+        try:
+            version.update_metadata_json()
+        except BadZipfile:
+            # Ignore bad zipfiles, we don't care
+            pass
+
+def store_uploaded_blobs(version_pk):
+    """
+    Background task: put the files of a new version in the blob store.
+    Writing each one out durably takes a sync per file, which the
+    upload shouldn't wait for.
+    """
+    version = ExtensionVersion.objects.filter(pk=version_pk).exclude(source="").first()
+    if version is not None:
+        blobs.store_version_blobs(version)
+
+def get_publish_task_key(pk):
+    return "publish:%d" % (pk,)
+
+def publish_version(version_pk):
+    """
+    Background task: publish a version uploaded before archives were
+    published, hashing its source.
+    """
+    version = ExtensionVersion.objects.filter(pk=version_pk).exclude(source="").first()
+    if version is not None and not version.published_name:
+        version.publish(hash_file(version.source.storage.path(version.source.name)))
+
 def make_filename(obj, filename=None):
     return "%s.v%d.shell-extension.zip" % (obj.extension.uuid, obj.version)
 
+# Where published archives go, under MEDIA_ROOT. Their names include a hash
+# of their contents, so they never change and can be cached for good.
+PUBLISHED_DIRECTORY = "download"
+
+def make_published_name(obj, sha256):
+    filename = "%s.v%d.%s.shell-extension.zip" % (obj.extension.uuid, obj.version, sha256[:16])
+    return "%s/%s" % (PUBLISHED_DIRECTORY, obj.source.storage.get_valid_name(filename))
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(64 * 1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def remove_stale_published_archives(storage, grace=datetime.timedelta(days=1), dry_run=False):
+    """
+    Remove the published archives that were superseded longer than grace
+    ago, so downloads already redirected to them could finish. Returns
+    how many were removed.
+    """
+    cutoff = datetime.datetime.now() - grace
+
+    count = 0
+    for superseded in SupersededArchive.objects.filter(superseded__lt=cutoff):
+        # Versions can go back to an earlier copy.
+        if not ExtensionVersion.objects.filter(published_name=superseded.name).exists():
+            count += 1
+            if not dry_run:
+                try:
+                    storage.delete(superseded.name)
+                except FileNotFoundError:
+                    pass
+
+        if not dry_run:
+            superseded.delete()
+
+    return count
+
 
 class ExtensionVersion(models.Model):
     extension = models.ForeignKey(Extension, on_delete=models.CASCADE, related_name="versions")
     version = models.IntegerField(default=0)
     extra_json_fields = models.TextField()
     status = models.PositiveIntegerField(choices=STATUSES.items())
+
+    # sha256 of the metadata.json in the source, so it's only rewritten
+    # when the fields it's generated from change.
+    metadata_hash = models.CharField(max_length=64, blank=True)
+
+    # What the CHANGELOG gained since the previous version, extracted
+    # once on upload so nothing has to open the archives to show it.
+    changelog = models.TextField(blank=True)
     shell_versions = models.ManyToManyField(ShellVersion)
 
     class Meta:
@@ -311,6 +671,10 @@ class ExtensionVersion(models.Model):
     source = models.FileField(upload_to=make_filename,
                               max_length=filename_max_length)
 
+    # The name, in the source's storage, of the published copy of the
+    # source that downloads are sent to. See publish().
+    published_name = models.CharField(max_length=filename_max_length + 32, blank=True)
+
     objects = ExtensionVersionManager()
 
     @property
@@ -339,37 +703,148 @@ class ExtensionVersion(models.Model):
     def make_metadata_json_string(self):
         return json.dumps(self.make_metadata_json(), sort_keys=True, indent=2)
 
+    def publish(self, sha256):
+        """
+        Hard link the source, whose contents have sha256, under a name
+        derived from it, and point downloads there. The name changes
+        whenever the source is rewritten, so the file behind it never does.
+        """
+        storage = self.source.storage
+        source_path = storage.path(self.source.name)
+        name = make_published_name(self, sha256)
+        SupersededArchive.objects.filter(name=name).delete()
+
+        path = storage.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            # The link appears whole, so there's no need for a temporary
+            # name; if it's there already, someone else published it.
+            os.link(source_path, path)
+        except FileExistsError:
+            pass
+
+        previous = self.published_name
+        self.published_name = name
+        if self.pk is not None:
+            ExtensionVersion.objects.filter(pk=self.pk).update(published_name=name)
+
+        if previous and previous != name:
+            # For remove_stale_published_archives.
+            SupersededArchive.objects.get_or_create(name=previous)
+
+    def get_download_url(self):
+        if not self.published_name:
+            # Versions uploaded before archives were published. Hashing
+            # the source takes a while; send downloads to it meanwhile.
+            key = get_publish_task_key(self.pk)
+            if not tasks.pending_keys([key]):
+                tasks.enqueue(publish_version, self.pk, key=key)
+            return self.source.storage.url(self.source.name)
+        return self.source.storage.url(self.published_name)
+
     def get_zipfile(self, mode):
         return ZipFile(self.source.storage.path(self.source.name), mode)
 
-    def replace_metadata_json(self):
+    def get_file_hashes(self):
         """
-        In the uploaded extension zipfile, edit metadata.json
-        to reflect the new contents.
+        Return {filename: sha256} for the files in the source, from the
+        stored ExtensionVersionFile rows. They're computed, and stored,
+        on first use.
         """
+        hashes = dict(self.files.values_list('filename', 'sha256'))
+        if hashes or not self.source:
+            return hashes
+
+        files = []
+        zipfile = self.get_cached_zipfile()
+        for info in zipfile.infolist():
+            if info.filename.endswith('/'):
+                continue
 
-        # We can't easily *replace* files in a zipfile
-        # archive. See https://bugs.python.org/issue6818.
-        # Just read all the contents from the old zipfile
-        # into memory and then emit a new one with the
-        # generated metadata.json
-        zipfile_in = self.get_zipfile("r")
+            sha256, contents = hash_zipfile_member(zipfile, info)
+            files.append((info.filename, info.file_size, sha256))
 
-        filemap = {}
-        for info in zipfile_in.infolist():
-            if info.filename == "metadata.json":
-                continue
+        return self.store_file_hashes(files)
 
-            contents = zipfile_in.read(info)
-            filemap[info] = contents
+    def store_file_hashes(self, files):
+        """
+        Store (filename, size, sha256) for the files in the source, as
+        already known from scanning the upload, and return them as
+        get_file_hashes does.
+        """
+        # Two requests may fill in the hashes of the same version at once;
+        # they're the same either way.
+        ExtensionVersionFile.objects.bulk_create([ExtensionVersionFile(version=self,
+                                                                       filename=filename,
+                                                                       size=size,
+                                                                       sha256=sha256)
+                                                  for filename, size, sha256 in files],
+                                                 ignore_conflicts=True)
+        return dict((filename, sha256) for filename, size, sha256 in files)
+
+    def get_cached_zipfile(self):
+        """
+        Return the shared read-only ZipFile of the source. Unlike
+        get_zipfile, the caller must not close it.
+        """
+        return open_cached_zipfile(self.source.name)
 
-        zipfile = self.get_zipfile("w")
-        for info, contents in filemap.items():
-            zipfile.writestr(info, contents)
+    def replace_metadata_json(self):
+        """
+        In the uploaded extension zipfile, edit metadata.json
+        to reflect the new contents. Returns the new metadata.json.
+        """
+        contents = self.make_metadata_json_string()
+        sha256 = replace_zipfile_members(self.source.storage.path(self.source.name),
+                                         {"metadata.json": contents})
+        self.metadata_json_replaced(contents, sha256)
+        return contents
 
-        metadata = self.make_metadata_json()
-        zipfile.writestr("metadata.json", self.make_metadata_json_string())
-        zipfile.close()
+    def metadata_json_replaced(self, contents, sha256):
+        """
+        Record that metadata.json in the source was replaced with
+        contents, making the new source's hash sha256, and publish it.
+        """
+        metadata_hash = hash_metadata_json(contents)
+        self.set_metadata_hash(metadata_hash)
+        self.publish(sha256)
+
+        # The other files didn't change; only metadata.json's hash needs
+        # updating, if the files were hashed at all.
+        if self.pk is not None:
+            data = contents.encode('utf-8')
+            if self.files.filter(filename="metadata.json").update(sha256=metadata_hash, size=len(data)):
+                blobs.store_blob(data)
+
+    def set_metadata_hash(self, metadata_hash):
+        self.metadata_hash = metadata_hash
+        if self.pk is not None:
+            ExtensionVersion.objects.filter(pk=self.pk).update(metadata_hash=metadata_hash)
+
+    def update_metadata_json(self):
+        """
+        Replace metadata.json only if it differs from what
+        make_metadata_json generates now. Returns whether it did.
+        """
+        contents = self.make_metadata_json_string()
+        metadata_hash = hash_metadata_json(contents)
+        if metadata_hash == self.metadata_hash:
+            return False
+
+        # The hash isn't known for versions uploaded before it was
+        # stored, or may have been lost with a rolled back task after the
+        # archive was rewritten; check the archive before rewriting it.
+        try:
+            current = self.get_cached_zipfile().read("metadata.json")
+        except KeyError:
+            current = None
+
+        if current is not None and hash_metadata_json(current) == metadata_hash:
+            self.set_metadata_hash(metadata_hash)
+            return False
+
+        self.replace_metadata_json()
+        return True
 
     def save(self, *args, **kwargs):
         assert self.extension is not None
@@ -421,6 +896,103 @@ class ExtensionVersion(models.Model):
     def is_inactive(self):
         return self.status == STATUS_INACTIVE
 
+class ExtensionVersionFile(models.Model):
+    """A file in the source of an ExtensionVersion, with its hash."""
+    version = models.ForeignKey(ExtensionVersion, on_delete=models.CASCADE, related_name="files")
+    filename = models.CharField(max_length=255)
+    size = models.PositiveIntegerField()
+    sha256 = models.CharField(max_length=64)
+
+    class Meta:
+        unique_together = ('version', 'filename')
+
+    def __str__(self):
+        return "%s in %s" % (self.filename, self.version)
+
+class ArchiveCheck(models.Model):
+    """The result of the last check_files run over a version's source."""
+    version = models.OneToOneField(ExtensionVersion, on_delete=models.CASCADE,
+                                   primary_key=True, related_name="archive_check")
+    checked = models.DateTimeField()
+
+    # The file as it was checked, so unchanged files can be skipped.
+    mtime_ns = models.BigIntegerField(null=True)
+    size = models.BigIntegerField(null=True)
+    sha256 = models.CharField(max_length=64, blank=True)
+
+    crc_ok = models.BooleanField(default=False)
+    error = models.TextField(blank=True)
+
+    def __str__(self):
+        return "%s: %s" % (self.version, "ok" if self.crc_ok else self.error)
+
+    def is_current(self, stat):
+        return self.crc_ok and (self.mtime_ns, self.size) == (stat.st_mtime_ns, stat.st_size)
+
+class DownloadStat(models.Model):
+    """
+    Downloads of an extension on one day, counted from the web server's
+    access logs by importaccesslogs. See sweettooth.extensions.accesslog.
+    """
+    extension = models.ForeignKey(Extension, on_delete=models.CASCADE, related_name="download_stats")
+    # Null when the request didn't say which version it wanted.
+    version = models.ForeignKey(ExtensionVersion, on_delete=models.CASCADE, null=True,
+                                related_name="download_stats")
+    # As the client sent it; blank for requests of the archive itself.
+    shell_version = models.CharField(max_length=16, blank=True)
+    day = models.DateField(db_index=True)
+
+    # Requests to /download-extension/, which redirect to the archive.
+    downloads = models.PositiveIntegerField(default=0)
+    # Archives served from /extension-data/, those redirects included.
+    fetches = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('extension', 'version', 'shell_version', 'day')
+        constraints = [
+            # NULLs never compare equal, so unique_together lets rows
+            # without a version repeat. Databases without partial indexes,
+            # like MySQL, skip this one.
+            models.UniqueConstraint(fields=['extension', 'shell_version', 'day'],
+                                    condition=models.Q(version__isnull=True),
+                                    name='downloadstat_unique_without_version'),
+        ]
+
+    def __str__(self):
+        return "%s on %s" % (self.version or self.extension, self.day)
+
+class SupersededArchive(models.Model):
+    """
+    A published archive no version points to any more, kept for a while
+    for downloads already sent to it. See remove_stale_published_archives.
+    """
+    name = models.CharField(max_length=filename_max_length + 32, unique=True)
+    superseded = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
+
+def version_deleted(sender, instance, **kwargs):
+    if instance.published_name:
+        SupersededArchive.objects.get_or_create(name=instance.published_name)
+
+post_delete.connect(version_deleted, sender=ExtensionVersion)
+
+class AccessLogCheckpoint(models.Model):
+    """
+    How far importaccesslogs has read a log file. Files are recognised by
+    the hash of their first line, which survives rotation and compression.
+    """
+    fingerprint = models.CharField(max_length=64, unique=True)
+    # The name the file was last read under, for people to look at.
+    filename = models.TextField()
+    # In uncompressed bytes.
+    offset = models.BigIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "%s at %d" % (self.filename, self.offset)
+
 submitted_for_review = Signal(providing_args=["request", "version"])
 reviewed = Signal(providing_args=["request", "version", "review"])
 extension_updated = Signal(providing_args=["extension"])
@@ -1,8 +1,22 @@
-
 from django import template
+from django.utils.html import format_html
 
 register = template.Library()
 
 @register.simple_tag
-def extension_icon(icon):
-    return icon.url if icon else "/static/images/plugin.png"
+def extension_icon(icon, variant='list'):
+    return icon.instance.get_image_url('icon', variant) if icon else "/static/images/plugin.png"
+
+@register.simple_tag
+def extension_picture(extension, field, variant, css_class=""):
+    """
+    A <picture> of a variant of the icon or screenshot, offering the
+    WebP copy to browsers that take it.
+    """
+    png = extension.get_image_url(field, variant)
+    webp = extension.get_image_url(field, variant, 'webp')
+
+    if webp is None:
+        return format_html('<img src="{}" class="{}">', png, css_class)
+    return format_html('<picture><source srcset="{}" type="image/webp"><img src="{}" class="{}"></picture>',
+                       webp, png, css_class)
@@ -1,16 +1,25 @@
 
+import datetime
+import gzip
+import hashlib
 import os.path
 import json
 import tempfile
 import unittest
-from io import BytesIO
+from io import BytesIO, StringIO
 from uuid import uuid4
-from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED, ZIP_STORED, BadZipfile, ZipFile
 
 from django.test import TestCase, TransactionTestCase
-from django.core.files.base import File
+from PIL import Image, features
+from django.core.files.base import ContentFile, File
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.urls import reverse
-from sweettooth.extensions import models, views
+from sweettooth.core.tasks import run_pending
+from sweettooth.extensions import archives, blobs, images, models, views
+from sweettooth.extensions.templatetags.extension_icon import extension_icon, extension_picture
 
 from sweettooth.testutils import BasicUserTestCase
 
@@ -135,6 +144,44 @@ class ParseZipfileTest(BasicUserTestCase, TestCase):
             with self.assertRaisesMessage(models.InvalidExtensionData, "Invalid JSON data"):
                 models.parse_zipfile_metadata(f)
 
+    def make_zipfile(self, files, compression=ZIP_DEFLATED):
+        f = BytesIO()
+        with ZipFile(f, 'w', compression) as zipfile:
+            for filename, contents in files.items():
+                zipfile.writestr(filename, contents)
+        return f
+
+    def test_scan_zipfile(self):
+        f = self.make_zipfile({'metadata.json': '{"uuid": "test@mecheye.net"}',
+                               'extension.js': "let x;\n",
+                               'schemas/': ""})
+        upload = models.scan_zipfile(f)
+
+        self.assertEqual(upload.metadata, {"uuid": "test@mecheye.net"})
+        self.assertEqual(upload.files,
+                         [('metadata.json', 28, hashlib.sha256(b'{"uuid": "test@mecheye.net"}').hexdigest()),
+                          ('extension.js', 7, hashlib.sha256(b"let x;\n").hexdigest())])
+
+    def test_metadata_bom(self):
+        f = self.make_zipfile({'metadata.json': b'\xef\xbb\xbf{"uuid": "test@mecheye.net"}'})
+        self.assertEqual(models.scan_zipfile(f).metadata, {"uuid": "test@mecheye.net"})
+
+    def test_bad_crc(self):
+        f = self.make_zipfile({'metadata.json': '{"uuid": "test@mecheye.net"}',
+                               'extension.js': "let x;\n"}, ZIP_STORED)
+        data = f.getvalue().replace(b"let x;", b"let y;")
+
+        with self.assertRaisesMessage(models.InvalidExtensionData, "Invalid zip file"):
+            models.scan_zipfile(BytesIO(data))
+
+    def test_compression_ratio(self):
+        f = self.make_zipfile({'metadata.json': '{"uuid": "test@mecheye.net"}',
+                               'extension.js': " " * 1024 * 1024})
+
+        with self.assertRaisesMessage(models.InvalidExtensionData, "compressed suspiciously well"):
+            models.scan_zipfile(f)
+
+
 
 class ReplaceMetadataTest(BasicUserTestCase, TestCase):
     @unittest.expectedFailure
@@ -168,7 +215,378 @@ class ReplaceMetadataTest(BasicUserTestCase, TestCase):
         old_zip.close()
         new_zip.close()
 
+class CachedZipfileTest(TestCase):
+    def write_zipfile(self, path, contents):
+        with ZipFile(path, 'w') as zipfile:
+            zipfile.writestr('extension.js', contents)
+
+    def test_reopened_when_changed(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            storage = archives.LocalArchiveStorage(tempdir)
+            self.write_zipfile(os.path.join(tempdir, 'test.zip'), "one")
+
+            zipfile = models.open_cached_zipfile('test.zip', storage)
+            self.assertIs(zipfile, models.open_cached_zipfile('test.zip', storage))
+            self.assertEqual(zipfile.read('extension.js'), b"one")
+
+            self.write_zipfile(os.path.join(tempdir, 'test.zip'), "second")
+            new_zipfile = models.open_cached_zipfile('test.zip', storage)
+            self.assertIsNot(zipfile, new_zipfile)
+            self.assertEqual(new_zipfile.read('extension.js'), b"second")
+
+            # Whoever still holds the old one can keep reading it, until
+            # they let go of it.
+            self.assertEqual(zipfile.read('extension.js'), b"one")
+            f = zipfile.fp
+            del zipfile
+            self.assertTrue(f.closed)
+
+    def test_range_reads(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            storage = archives.CountingArchiveStorage(tempdir)
+            with ZipFile(os.path.join(tempdir, 'test.zip'), 'w', ZIP_STORED) as zipfile:
+                zipfile.writestr('extension.js', "let x;")
+                zipfile.writestr('data.bin', os.urandom(256 * 1024))
+                zipfile.writestr('metadata.json', "{}")
+
+            zipfile = models.open_cached_zipfile('test.zip', storage)
+            self.assertEqual(zipfile.read('extension.js'), b"let x;")
+            self.assertEqual(zipfile.read('metadata.json'), b"{}")
+            # The end of the archive, and its start; not what's between.
+            self.assertLess(storage.bytes_read, 2 * storage.buffer_size)
+
+            self.assertEqual(len(zipfile.read('data.bin')), 256 * 1024)
+            self.assertGreater(storage.bytes_read, 256 * 1024)
+
+class ReplaceZipfileMembersTest(TestCase):
+    def test_replace_members(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'test.zip')
+            with open(path, 'wb') as f:
+                # Not seekable, so the members get data descriptors.
+                class Unseekable(object):
+                    write = f.write
+                    flush = f.flush
+                    def tell(self):
+                        return f.tell()
+
+                with ZipFile(Unseekable(), 'w', ZIP_DEFLATED) as zipfile:
+                    zipfile.writestr('extension.js', "let x = 1;\n" * 1000)
+                    zipfile.writestr('metadata.json', "{}")
+                    zipfile.writestr('schemas/org.gnome.test.gschema.xml', "<schemalist/>")
+            os.chmod(path, 0o644)
+
+            with ZipFile(path, 'r') as old:
+                self.assertTrue(old.getinfo('extension.js').flag_bits & models.ZIP_DATA_DESCRIPTOR)
+                old_infos = dict((info.filename, info) for info in old.infolist())
+            storage = archives.LocalArchiveStorage(tempdir)
+            reader = models.open_cached_zipfile('test.zip', storage)
+
+            models.replace_zipfile_members(path, {'metadata.json': '{"uuid": "test"}'})
+
+            self.assertEqual(os.listdir(tempdir), ['test.zip'])
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+            # Readers of the old file aren't disturbed...
+            self.assertEqual(reader.read('metadata.json'), b"{}")
+            # ...and new ones get the new file.
+            self.assertIsNot(reader, models.open_cached_zipfile('test.zip', storage))
+
+            with ZipFile(path, 'r') as new:
+                self.assertIsNone(new.testzip())
+                self.assertEqual(new.namelist(), ['extension.js', 'schemas/org.gnome.test.gschema.xml',
+                                                  'metadata.json'])
+                self.assertEqual(new.read('metadata.json'), b'{"uuid": "test"}')
+                self.assertEqual(new.read('extension.js'), b"let x = 1;\n" * 1000)
+
+                info = new.getinfo('extension.js')
+                self.assertEqual(info.compress_type, ZIP_DEFLATED)
+                self.assertEqual(info.compress_size, old_infos['extension.js'].compress_size)
+                self.assertEqual(info.date_time, old_infos['extension.js'].date_time)
+                self.assertFalse(info.flag_bits & models.ZIP_DATA_DESCRIPTOR)
+
+    def test_failure_keeps_original(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'test.zip')
+            with open(path, 'wb') as f:
+                f.write(b"not a zipfile")
+
+            with self.assertRaises(BadZipfile):
+                models.replace_zipfile_members(path, {'metadata.json': "{}"})
+
+            self.assertEqual(os.listdir(tempdir), ['test.zip'])
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b"not a zipfile")
+
+class ImageVariantsTest(BasicUserTestCase, TestCase):
+    def setUp(self):
+        super().setUp()
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+
+        media_settings = self.settings(MEDIA_ROOT=root.name)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+        metadata = {"uuid": "test-images@mecheye.net", "name": "Test Images"}
+        self.extension = models.Extension.objects.create_from_metadata(metadata, creator=self.user)
+
+    def upload_image(self, kind, size):
+        f = BytesIO()
+        Image.new('RGB', size, 'red').save(f, 'PNG')
+        return self.client.post(reverse('extensions-ajax-%s' % (kind,), kwargs=dict(pk=self.extension.pk)),
+                                dict(file=SimpleUploadedFile('image.png', f.getvalue())))
+
+    def test_screenshot_variants(self):
+        self.upload_image('screenshot', (2000, 1000))
+        self.extension.refresh_from_db()
+        original = self.extension.screenshot.url
+
+        # Until the task has run, the upload is shown as it is.
+        self.assertEqual(self.extension.get_image_url('screenshot', 'detail'), original)
+
+        run_pending()
+        self.extension.refresh_from_db()
+        storage = self.extension.screenshot.storage
+
+        for variant, size in images.VARIANT_SIZES['screenshot']:
+            name = images.get_variant_name(self.extension, 'screenshot', variant)
+            with Image.open(storage.path(name)) as image:
+                self.assertEqual(image.size, (size, size // 2))
+            self.assertEqual(self.extension.get_image_url('screenshot', variant), storage.url(name))
+
+        if features.check('webp'):
+            self.assertIn('image/webp', extension_picture(self.extension, 'screenshot', 'detail'))
+
+        # A new upload replaces them.
+        old_name = images.get_variant_name(self.extension, 'screenshot', 'list')
+        self.upload_image('screenshot', (300, 200))
+        self.extension.refresh_from_db()
+        self.assertEqual(self.extension.get_image_url('screenshot', 'list'), self.extension.screenshot.url)
+
+        run_pending()
+        self.extension.refresh_from_db()
+        self.assertFalse(storage.exists(old_name))
+        with Image.open(storage.path(images.get_variant_name(self.extension, 'screenshot', 'list'))) as image:
+            # Never scaled up.
+            self.assertEqual(image.size, (300, 200))
+
+    def test_icon_variants(self):
+        self.upload_image('icon', (512, 512))
+        run_pending()
+        self.extension.refresh_from_db()
+
+        url = extension_icon(self.extension.icon)
+        self.assertNotEqual(url, self.extension.icon.url)
+        self.assertEqual(url, self.extension.get_image_url('icon', 'list'))
+
+        details = views.ajax_details(self.extension)
+        self.assertEqual(details['icon'], url)
+
+    def test_not_an_image(self):
+        self.client.post(reverse('extensions-ajax-icon', kwargs=dict(pk=self.extension.pk)),
+                         dict(file=SimpleUploadedFile('image.png', b"not an image")))
+        run_pending()
+        self.extension.refresh_from_db()
+        self.assertEqual(extension_icon(self.extension.icon), self.extension.icon.url)
+
+class ArchiveCommandTestCase(BasicUserTestCase, TestCase):
+    def setUp(self):
+        super().setUp()
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+
+        media_settings = self.settings(MEDIA_ROOT=root.name)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+        metadata = {"uuid": "test-check@mecheye.net", "name": "Test Check"}
+        self.extension = models.Extension.objects.create_from_metadata(metadata, creator=self.user)
+
+    def create_version(self, contents):
+        f = BytesIO()
+        with ZipFile(f, 'w', ZIP_STORED) as zipfile:
+            zipfile.writestr('extension.js', contents)
+
+        return models.ExtensionVersion.objects.create(extension=self.extension,
+                                                      source=ContentFile(f.getvalue(), name="source.zip"),
+                                                      extra_json_fields="{}",
+                                                      status=models.STATUS_ACTIVE)
+
+class CheckFilesTest(ArchiveCommandTestCase):
+    def check_files(self, *args):
+        call_command('check_files', '--workers=1', *args, stdout=StringIO(), stderr=StringIO())
+
+    def test_check_files(self):
+        good = self.create_version("let good;")
+        bad = self.create_version("let bad;")
+
+        with open(bad.source.path, 'rb') as f:
+            data = f.read()
+        with open(bad.source.path, 'wb') as f:
+            f.write(data.replace(b"let bad;", b"let BAD;"))
+
+        self.check_files()
+        good_check = models.ArchiveCheck.objects.get(version=good)
+        bad_check = models.ArchiveCheck.objects.get(version=bad)
+        self.assertTrue(good_check.crc_ok)
+        self.assertEqual(good_check.sha256, models.hash_file(good.source.path))
+        self.assertFalse(bad_check.crc_ok)
+        self.assertIn("extension.js", bad_check.error)
+
+        # Unchanged archives that passed aren't read again; bad ones are.
+        self.check_files()
+        self.assertEqual(models.ArchiveCheck.objects.get(version=good).checked, good_check.checked)
+        self.assertNotEqual(models.ArchiveCheck.objects.get(version=bad).checked, bad_check.checked)
+
+        self.check_files('--reject')
+        good.refresh_from_db()
+        bad.refresh_from_db()
+        self.assertEqual(good.status, models.STATUS_ACTIVE)
+        self.assertEqual(bad.status, models.STATUS_REJECTED)
+
+class RegenerateMetadataTest(ArchiveCommandTestCase):
+    def regenerate(self, *args):
+        stdout = StringIO()
+        call_command('regeneratemetadata', '--workers=1', *args, stdout=stdout, stderr=StringIO())
+        return stdout.getvalue()
+
+    def read_metadata(self, version):
+        with version.get_zipfile('r') as zipfile:
+            return json.loads(zipfile.read('metadata.json').decode('utf-8'))
+
+    def test_regenerate(self):
+        version1 = self.create_version("let one;")
+        version2 = self.create_version("let two;")
+
+        other = models.Extension.objects.create_from_metadata({"uuid": "other@mecheye.net", "name": "Other"},
+                                                              creator=self.user)
+        other_version = models.ExtensionVersion.objects.create(extension=other,
+                                                               source=version1.source.name,
+                                                               extra_json_fields="{}",
+                                                               status=models.STATUS_UNREVIEWED)
+
+        output = self.regenerate('--extension', self.extension.uuid, '--status', 'active')
+        self.assertIn("2 rewritten, 0 already up to date", output)
+        self.assertEqual(self.read_metadata(version2)['version'], 2)
+        self.assertEqual(self.read_metadata(version2)['name'], "Test Check")
+        other_version.refresh_from_db()
+        self.assertEqual(other_version.metadata_hash, "")
+
+        # The stored hashes match now, so no archive is opened.
+        self.assertIn("0 rewritten, 2 already up to date", self.regenerate('--extension', self.extension.uuid))
+
+        # Without them, the archives are checked but not rewritten.
+        models.ExtensionVersion.objects.update(metadata_hash="")
+        mtime = os.stat(version1.source.path).st_mtime_ns
+        self.assertIn("0 rewritten, 2 already up to date", self.regenerate('--extension', self.extension.uuid))
+        self.assertEqual(os.stat(version1.source.path).st_mtime_ns, mtime)
+
+class ImportAccessLogsTest(ArchiveCommandTestCase):
+    def log_line(self, target, status=200, day="19/Oct/2026"):
+        return ('203.0.113.7 - - [%s:10:11:12 +0000] "GET %s HTTP/1.1" %d 1234 "-" "GNOME Shell" "-"\n'
+                % (day, target, status))
+
+    def import_logs(self, *filenames):
+        stderr = StringIO()
+        call_command('importaccesslogs', *filenames, stdout=StringIO(), stderr=stderr)
+        return stderr.getvalue()
+
+    def get_stats(self):
+        return [(stat.version_id, stat.shell_version, str(stat.day), stat.downloads, stat.fetches)
+                for stat in models.DownloadStat.objects.order_by('day', 'version', 'shell_version')]
+
+    def test_import(self):
+        version = self.create_version("let one;")
+        uuid = self.extension.uuid
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "access.log")
+
+        with open(path, 'w') as f:
+            f.write(self.log_line("/download-extension/%s.shell-extension.zip?version_tag=%d&shell_version=3.38"
+                                  % (uuid.replace('@', '%40'), version.pk), status=302))
+            f.write(self.log_line("/extension-data/download/test-checkmecheye.net.v1.0123456789abcdef"
+                                  ".shell-extension.zip"))
+            f.write(self.log_line("/extension-data/%s.v1.shell-extension.zip" % (uuid,), status=206))
+            f.write(self.log_line("/download-extension/gone@mecheye.net.shell-extension.zip", status=302))
+            f.write(self.log_line("/extension-query/"))
+            f.write(self.log_line("/extension-data/%s.v1.shell-extension.zip" % (uuid,))[:40])
+
+        errors = self.import_logs(path)
+        self.assertIn("1 downloads of unknown extensions", errors)
+        self.assertEqual(self.get_stats(), [(version.pk, "", "2026-10-19", 0, 1),
+                                            (version.pk, "3.38", "2026-10-19", 1, 0)])
+
+        # The line being written is finished, and the log rotated.
+        with open(path, 'a') as f:
+            f.write(self.log_line("/extension-data/%s.v1.shell-extension.zip" % (uuid,))[40:])
+            f.write(self.log_line("/download-extension/%s.shell-extension.zip?shell_version=40" % (uuid,),
+                                  status=302, day="20/Oct/2026"))
+
+        rotated = path + ".1.gz"
+        with open(path, 'rb') as f, gzip.open(rotated, 'wb') as compressed:
+            compressed.write(f.read())
+        os.unlink(path)
+
+        self.import_logs(rotated)
+        self.assertEqual(self.get_stats(), [(version.pk, "", "2026-10-19", 0, 2),
+                                            (version.pk, "3.38", "2026-10-19", 1, 0),
+                                            (None, "40", "2026-10-20", 1, 0)])
+
+        # Nothing is counted twice.
+        self.import_logs(rotated)
+        self.assertEqual(models.DownloadStat.objects.count(), 3)
+
+        # Not even without a version.
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            models.DownloadStat.objects.create(extension=self.extension, shell_version="40",
+                                               day=datetime.date(2026, 10, 20))
+
+class PopulateDownloadsTest(BasicUserTestCase, TestCase):
+    def populate(self, data, *args):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as f:
+            f.write(data)
+            f.flush()
+
+            stderr = StringIO()
+            call_command('populatedownloads', f.name, '--chunk=2', *args, stdout=StringIO(), stderr=stderr)
+            return stderr.getvalue()
+
+    def test_populate(self):
+        one = models.Extension.objects.create_from_metadata({"uuid": "one@mecheye.net", "name": "One"},
+                                                            creator=self.user)
+        two = models.Extension.objects.create_from_metadata({"uuid": "two@mecheye.net", "name": "Two"},
+                                                            creator=self.user)
+
+        errors = self.populate("10 one@mecheye.net\n"
+                               "20 two@mecheye.net\n"
+                               "5 gone@mecheye.net\n"
+                               "garbage\n"
+                               "30 one@mecheye.net\n")
+        one.refresh_from_db()
+        two.refresh_from_db()
+        self.assertEqual((one.downloads, two.downloads), (30, 20))
+        self.assertIn("1 malformed", errors)
+        self.assertIn("1 unknown UUIDs, with 5 downloads", errors)
+        self.assertIn("gone@mecheye.net", errors)
+
+        self.populate("1 one@mecheye.net\n2 one@mecheye.net\n4 two@mecheye.net\n", '--merge')
+        one.refresh_from_db()
+        two.refresh_from_db()
+        self.assertEqual((one.downloads, two.downloads), (33, 24))
+
 class UploadTest(BasicUserTestCase, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+
+        storage_settings = self.settings(MEDIA_ROOT=os.path.join(root.name, 'media'),
+                                         EXTENSION_BLOB_ROOT=os.path.join(root.name, 'blobs'))
+        storage_settings.enable()
+        self.addCleanup(storage_settings.disable)
+
     def upload_file(self, zipfile):
         with get_test_zipfile(zipfile) as f:
             return self.client.post(reverse('extensions-upload-file'),
@@ -195,6 +613,11 @@ class UploadTest(BasicUserTestCase, TransactionTestCase):
                                                        slug=extension.slug))
         self.assertRedirects(response, url)
 
+        # Hashed while the upload was scanned, with the rewritten metadata.json.
+        hashes = version1.get_file_hashes()
+        version1.files.all().delete()
+        self.assertEqual(hashes, version1.get_file_hashes())
+
         version1.status = models.STATUS_ACTIVE
         version1.save()
 
@@ -203,11 +626,192 @@ class UploadTest(BasicUserTestCase, TransactionTestCase):
 
         version2 = extension.versions.order_by("-version")[0]
         self.assertNotEqual(version1, version2)
+        self.assertEqual(version2.status, models.STATUS_UNREVIEWED)
 
-        # This should be auto-approved.
+        # This should be auto-approved, once the queued check has run.
+        run_pending()
+        version2.refresh_from_db()
         self.assertEqual(version2.status, models.STATUS_ACTIVE)
         self.assertEqual(version2.version, version1.version+1)
 
+    def test_metadata_json_updated_in_background(self):
+        self.upload_file('SimpleExtension')
+        extension = models.Extension.objects.get(uuid="test-extension@mecheye.net")
+        version = extension.versions.get()
+        self.assertEqual(version.metadata_hash,
+                         models.hash_metadata_json(version.make_metadata_json_string()))
+
+        def read_metadata():
+            with version.get_zipfile('r') as zipfile:
+                return json.loads(zipfile.read('metadata.json').decode('utf-8'))
+
+        # The review of the upload.
+        run_pending()
+
+        # Saving without changing what metadata.json holds queues nothing.
+        extension.downloads += 1
+        extension.save()
+        self.assertEqual(run_pending(), 0)
+
+        # Nor does saving with deferred fields, which aren't loaded to
+        # compare them.
+        deferred = models.Extension.objects.only('downloads').get(pk=extension.pk)
+        deferred.downloads += 1
+        with self.assertNumQueries(1):
+            deferred.save()
+        self.assertEqual(run_pending(), 0)
+
+        extension.description = "A new description"
+        extension.save()
+        self.assertEqual(read_metadata()['description'], "Simple test metadata")
+
+        self.assertEqual(run_pending(), 1)
+        self.assertEqual(read_metadata()['description'], "A new description")
+
+        # Running it again, or losing the stored hash, doesn't rewrite anything.
+        mtime = os.stat(version.source.path).st_mtime_ns
+        models.update_versions_metadata_json(extension.pk)
+        models.ExtensionVersion.objects.filter(pk=version.pk).update(metadata_hash="")
+        models.update_versions_metadata_json(extension.pk)
+        self.assertEqual(os.stat(version.source.path).st_mtime_ns, mtime)
+
+        version.refresh_from_db()
+        self.assertEqual(version.metadata_hash,
+                         models.hash_metadata_json(version.make_metadata_json_string()))
+
+    def upload_files(self, files):
+        f = BytesIO()
+        with ZipFile(f, 'w', ZIP_DEFLATED) as zipfile:
+            for filename, contents in files.items():
+                zipfile.writestr(filename, contents)
+
+        return self.client.post(reverse('extensions-upload-file'),
+                                dict(source=SimpleUploadedFile('extension.zip', f.getvalue()),
+                                     gplv2_compliant=True,
+                                     tos_compliant=True), follow=True)
+
+    def test_blob_store(self):
+        files = {'metadata.json': json.dumps({"uuid": "test-blobs@mecheye.net",
+                                              "name": "Test Blobs",
+                                              "shell-version": ["3.2"]}),
+                 'extension.js': "let x = 1;\n",
+                 'prefs.js': "let y = 2;\n",
+                 'README': "let x = 1;\n"}
+        self.upload_files(files)
+        self.upload_files(files)
+        version1, version2 = models.ExtensionVersion.objects.order_by('version')
+
+        hashes1, hashes2 = version1.get_file_hashes(), version2.get_file_hashes()
+        # The files are stored after the upload, in the background.
+        self.assertFalse(blobs.has_blob(hashes1['extension.js']))
+        run_pending()
+        for sha256 in list(hashes1.values()) + list(hashes2.values()):
+            self.assertTrue(blobs.has_blob(sha256))
+
+        # Only metadata.json differs; the other files are stored once.
+        refcounts = blobs.get_refcounts()
+        for filename, sha256 in hashes1.items():
+            if filename == 'metadata.json':
+                self.assertEqual(refcounts[sha256], 1)
+            else:
+                self.assertGreaterEqual(refcounts[sha256], 2)
+
+        usage = blobs.get_usage()
+        self.assertEqual(usage['blobs'], len(set(hashes1.values()) | set(hashes2.values())))
+        self.assertEqual(usage['unreferenced_blobs'], 0)
+        self.assertEqual(usage['missing_blobs'], 0)
+        self.assertEqual(usage['archive_bytes'],
+                         os.stat(version1.source.path).st_size + os.stat(version2.source.path).st_size)
+
+        self.assertEqual(blobs.check_archive(version2), [])
+        os.unlink(blobs.get_blob_path(hashes2['prefs.js']))
+        self.assertEqual(blobs.check_archive(version2), ["prefs.js isn't in the store"])
+        blobs.store_blob(b"let y = 2;\n")
+
+        # Storing a blob again marks it as recently used.
+        path = blobs.get_blob_path(hashes2['prefs.js'])
+        os.utime(path, (0, 0))
+        blobs.store_blob(b"let y = 2;\n")
+        self.assertGreater(os.stat(path).st_mtime, 0)
+
+        archive = BytesIO()
+        blobs.build_archive(version2, archive)
+        with ZipFile(archive, 'r') as built, version2.get_zipfile('r') as original:
+            filenames = [name for name in original.namelist() if not name.endswith('/')]
+            self.assertEqual(sorted(built.namelist()), sorted(filenames))
+            for filename in filenames:
+                self.assertEqual(built.read(filename), original.read(filename))
+
+        self.assertEqual(list(blobs.verify_blobs()), [])
+
+        # Nothing is collected within the grace period.
+        version2.delete()
+        self.assertEqual(blobs.collect_garbage()[0], 0)
+        self.assertEqual(blobs.collect_garbage(datetime.timedelta(0))[0], 1)
+        self.assertFalse(blobs.has_blob(hashes2['metadata.json']))
+        for sha256 in hashes1.values():
+            self.assertTrue(blobs.has_blob(sha256))
+
+    def test_link_identical_archives(self):
+        self.upload_file('SimpleExtension')
+        self.upload_file('SimpleExtension')
+        version1, version2 = models.ExtensionVersion.objects.order_by('version')
+
+        with open(version1.source.path, 'rb') as f:
+            contents = f.read()
+        with open(version2.source.path, 'wb') as f:
+            f.write(contents)
+
+        count, size = blobs.link_identical_archives([version1, version2])
+        self.assertEqual((count, size), (1, len(contents)))
+        self.assertTrue(os.path.samefile(version1.source.path, version2.source.path))
+        self.assertEqual(blobs.link_identical_archives([version1, version2]), (0, 0))
+
+    def test_published_archives(self):
+        self.upload_file('SimpleExtension')
+        run_pending()
+        extension = models.Extension.objects.get(uuid="test-extension@mecheye.net")
+        version = extension.versions.get()
+        storage = version.source.storage
+
+        old_name = version.published_name
+        self.assertTrue(os.path.samefile(storage.path(old_name), version.source.path))
+        self.assertRedirects(self.client.get(reverse('review-download', kwargs=dict(pk=version.pk))),
+                             storage.url(old_name), fetch_redirect_response=False)
+
+        extension.name = "A new name"
+        extension.save()
+        run_pending()
+
+        version.refresh_from_db()
+        self.assertNotEqual(version.published_name, old_name)
+        self.assertTrue(os.path.samefile(storage.path(version.published_name), version.source.path))
+        self.assertIn(models.hash_file(version.source.path)[:16], version.published_name)
+
+        # The old copy stays, unchanged, for a while.
+        with ZipFile(storage.path(old_name), 'r') as zipfile:
+            self.assertEqual(json.loads(zipfile.read('metadata.json').decode('utf-8'))['name'],
+                             "Test Extension")
+        self.assertEqual(models.remove_stale_published_archives(storage), 0)
+        self.assertEqual(models.remove_stale_published_archives(storage, datetime.timedelta(0)), 1)
+        self.assertFalse(storage.exists(old_name))
+        self.assertTrue(storage.exists(version.published_name))
+
+        # Versions from before archives were published are published in
+        # the background, and downloaded from the source until then.
+        name = version.published_name
+        models.ExtensionVersion.objects.filter(pk=version.pk).update(published_name="")
+        version.refresh_from_db()
+        self.assertEqual(version.get_download_url(), version.source.url)
+        run_pending()
+        version.refresh_from_db()
+        self.assertEqual(version.published_name, name)
+
+        # Nor do the copies of deleted versions stay.
+        version.delete()
+        self.assertEqual(models.remove_stale_published_archives(storage, datetime.timedelta(0)), 1)
+        self.assertFalse(storage.exists(name))
+
     def test_upload_large_uuid(self):
         self.upload_file('LargeUUID')
 
@@ -390,8 +994,8 @@ class DownloadExtensionTest(BasicUserTestCase, TestCase):
                                                     source=File(zipfile, "version1.zip"))
         v2.parse_metadata_json({"shell-version": ['3.4']})
 
-        self.assertRedirects(self.download(metadata['uuid'], '3.2'), v1.source.url)
-        self.assertRedirects(self.download(metadata['uuid'], '3.4'), v2.source.url)
+        self.assertRedirects(self.download(metadata['uuid'], '3.2'), v1.get_download_url())
+        self.assertRedirects(self.download(metadata['uuid'], '3.4'), v2.get_download_url())
 
     def test_bare_versions(self):
         zipfile = get_test_zipfile("SimpleExtension")
@@ -413,18 +1017,18 @@ class DownloadExtensionTest(BasicUserTestCase, TestCase):
                                                     source=File(zipfile, "version2.zip"))
         v2.parse_metadata_json({"shell-version": ['3.2.1']})
 
-        self.assertRedirects(self.download(metadata['uuid'], '3.2.0'), v1.source.url)
-        self.assertRedirects(self.download(metadata['uuid'], '3.2.1'), v2.source.url)
-        self.assertRedirects(self.download(metadata['uuid'], '3.2.2'), v1.source.url)
+        self.assertRedirects(self.download(metadata['uuid'], '3.2.0'), v1.get_download_url())
+        self.assertRedirects(self.download(metadata['uuid'], '3.2.1'), v2.get_download_url())
+        self.assertRedirects(self.download(metadata['uuid'], '3.2.2'), v1.get_download_url())
 
         v3 = models.ExtensionVersion.objects.create(extension=extension,
                                                     status=models.STATUS_ACTIVE,
                                                     source=File(zipfile, "version3.zip"))
         v3.parse_metadata_json({"shell-version": ['3.2']})
 
-        self.assertRedirects(self.download(metadata['uuid'], '3.2.0'), v3.source.url)
-        self.assertRedirects(self.download(metadata['uuid'], '3.2.1'), v3.source.url)
-        self.assertRedirects(self.download(metadata['uuid'], '3.2.2'), v3.source.url)
+        self.assertRedirects(self.download(metadata['uuid'], '3.2.0'), v3.get_download_url())
+        self.assertRedirects(self.download(metadata['uuid'], '3.2.1'), v3.get_download_url())
+        self.assertRedirects(self.download(metadata['uuid'], '3.2.2'), v3.get_download_url())
 
     def test_multiple_versions(self):
         zipfile = get_test_zipfile("SimpleExtension")
@@ -446,9 +1050,9 @@ class DownloadExtensionTest(BasicUserTestCase, TestCase):
                                                     source=File(zipfile, "version2.zip"))
         v2.parse_metadata_json({"shell-version": ['3.2.2']})
 
-        self.assertRedirects(self.download(metadata['uuid'], '3.2.0'), v1.source.url)
-        self.assertRedirects(self.download(metadata['uuid'], '3.2.1'), v1.source.url)
-        self.assertRedirects(self.download(metadata['uuid'], '3.2.2'), v2.source.url)
+        self.assertRedirects(self.download(metadata['uuid'], '3.2.0'), v1.get_download_url())
+        self.assertRedirects(self.download(metadata['uuid'], '3.2.1'), v1.get_download_url())
+        self.assertRedirects(self.download(metadata['uuid'], '3.2.2'), v2.get_download_url())
 
 class UpdateVersionTest(TestCase):
     fixtures = [os.path.join(testdata_dir, 'test_upgrade_data.json')]
@@ -647,10 +1251,10 @@ class QueryExtensionsTest(BasicUserTestCase, TestCase):
         self.assertEqual(uuids, [])
 
     def test_sort(self):
-        one = self.create_extension("one", downloads=50, popularity=15)
+        one = self.create_extension("one", downloads=50, popularity=15, rating_score=3.5)
         models.ExtensionVersion.objects.create(extension=one, status=models.STATUS_ACTIVE)
 
-        two = self.create_extension("two", downloads=40, popularity=20)
+        two = self.create_extension("two", downloads=40, popularity=20, rating_score=4.0)
         models.ExtensionVersion.objects.create(extension=two, status=models.STATUS_ACTIVE)
 
         uuids = self.gather_uuids(dict(sort="name"))
@@ -675,6 +1279,11 @@ class QueryExtensionsTest(BasicUserTestCase, TestCase):
         uuids = self.gather_uuids(dict(sort="downloads", order="asc"))
         self.assertEqual(uuids, [two.uuid, one.uuid])
 
+        uuids = self.gather_uuids(dict(sort="rating"))
+        self.assertEqual(uuids, [two.uuid, one.uuid])
+        uuids = self.gather_uuids(dict(sort="rating", order="asc"))
+        self.assertEqual(uuids, [one.uuid, two.uuid])
+
     def test_grab_proper_extension_version(self):
         extension = self.create_extension("extension")
 
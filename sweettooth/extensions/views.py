@@ -14,7 +14,8 @@ from django.views.decorators.http import require_POST
 from django.urls import reverse
 
 from sweettooth.exceptions import DatabaseErrorWithMessages
-from sweettooth.extensions import models, search
+from sweettooth.core import tasks
+from sweettooth.extensions import images, models, search
 from sweettooth.extensions.forms import UploadForm
 
 from sweettooth.decorators import ajax_view, model_view
@@ -104,9 +105,9 @@ def shell_download(request, uuid):
         raise Http404()
 
     extension.downloads += 1
-    extension.save(replace_metadata_json=False)
+    extension.save(replace_metadata_json=False, update_fields=['downloads'])
 
-    return redirect(version.source.url)
+    return redirect(version.get_download_url())
 
 @ajax_view
 def shell_update(request):
@@ -169,8 +170,8 @@ def ajax_query_params_query(request, versions, n_per_page):
         queryset = queryset.filter(uuid__in=uuids)
 
     sort = request.GET.get('sort', 'popularity')
-    sort = dict(recent='created').get(sort, sort)
-    if sort not in ('created', 'downloads', 'popularity', 'name'):
+    sort = dict(recent='created', rating='rating_score').get(sort, sort)
+    if sort not in ('created', 'downloads', 'popularity', 'name', 'rating_score'):
         raise Http404()
 
     queryset = queryset.order_by(sort)
@@ -338,7 +339,7 @@ def ajax_inline_edit_view(request, extension):
 
     models.extension_updated.send(sender=extension, extension=extension)
 
-    extension.save()
+    extension.save(update_fields=[key])
 
     return value
 
@@ -347,7 +348,8 @@ def ajax_inline_edit_view(request, extension):
 @model_view(models.Extension)
 def ajax_upload_screenshot_view(request, extension):
     extension.screenshot = request.FILES['file']
-    extension.save(replace_metadata_json=False)
+    extension.save(replace_metadata_json=False, update_fields=['screenshot'])
+    tasks.enqueue(images.generate_image_variants, extension.pk, 'screenshot')
     return extension.screenshot.url
 
 @ajax_view
@@ -355,7 +357,8 @@ def ajax_upload_screenshot_view(request, extension):
 @model_view(models.Extension)
 def ajax_upload_icon_view(request, extension):
     extension.icon = request.FILES['file']
-    extension.save(replace_metadata_json=False)
+    extension.save(replace_metadata_json=False, update_fields=['icon'])
+    tasks.enqueue(images.generate_image_variants, extension.pk, 'icon')
     return extension.icon.url
 
 def ajax_details(extension, version=None):
@@ -368,13 +371,16 @@ def ajax_details(extension, version=None):
                    link = extension.get_absolute_url(),
                    icon = extension_icon(extension.icon),
                    screenshot = extension.screenshot.url if extension.screenshot else None,
-                   shell_version_map = extension.visible_shell_version_map)
+                   screenshot_thumbnail = extension.get_image_url('screenshot', 'thumbnail'),
+                   shell_version_map = extension.visible_shell_version_map,
+                   rating = dict(count=extension.rating_count, average=extension.rating_average))
 
     if version is not None:
         download_url = reverse('extensions-shell-download', kwargs=dict(uuid=extension.uuid))
         details['version'] = version.version
         details['version_tag'] = version.pk
         details['download_url'] = "%s?version_tag=%d" % (download_url, version.pk)
+        details['changelog'] = version.changelog
     return details
 
 @ajax_view
@@ -422,7 +428,8 @@ def create_version(request, file_source):
     try:
         with transaction.atomic():
             try:
-                metadata = models.parse_zipfile_metadata(file_source)
+                upload = models.scan_zipfile(file_source)
+                metadata = upload.metadata
                 uuid = metadata['uuid']
             except (models.InvalidExtensionData, KeyError) as e:
                 messages.error(request, "Invalid extension data: %s" % (e.message,))
@@ -449,9 +456,16 @@ def create_version(request, file_source):
                                                              source=file_source,
                                                              status=models.STATUS_UNREVIEWED)
             version.parse_metadata_json(metadata)
-            version.replace_metadata_json()
+            # Only metadata.json is rewritten; nothing is decompressed.
+            metadata_json = version.replace_metadata_json().encode('utf-8')
             version.save()
 
+            # The files were hashed while scanning the upload.
+            files = [f for f in upload.files if f[0] != 'metadata.json']
+            files.append(('metadata.json', len(metadata_json), version.metadata_hash))
+            version.store_file_hashes(files)
+            tasks.enqueue(models.store_uploaded_blobs, version.pk)
+
             return version, []
     except DatabaseErrorWithMessages as e:
         return None, e.messages
@@ -1,5 +1,11 @@
+import uuid
 
-from django.db import models
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models import Count, ExpressionWrapper, F, FloatField, Sum, Value
+from django.db.models.signals import post_delete, post_save
 from django_comments.models import Comment
 from django_comments.managers import CommentManager
 from django_comments.signals import comment_will_be_posted
@@ -9,7 +15,113 @@ class RatingComment(Comment):
 
     rating = models.IntegerField(blank=True, default=-1)
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # What the saved comment adds to its extension's ratings; see
+        # apply_rating_change.
+        self._saved_rating = self.get_counted_rating()
+
+    def get_counted_rating(self):
+        """The rating this comment adds to its extension's, or None."""
+        if self.is_public and not self.is_removed and self.rating is not None and self.rating > -1:
+            return self.rating
+        return None
+
+    def get_extension_pk(self):
+        from sweettooth.extensions.models import Extension
+
+        if self.content_type_id != ContentType.objects.get_for_model(Extension).pk:
+            return None
+        return int(self.object_pk)
+
 def make_sure_user_was_authenticated(sender, comment, request, **kwargs):
     return request.user.is_authenticated
 
 comment_will_be_posted.connect(make_sure_user_was_authenticated)
+
+def get_comments_generation(content_type_id, object_pk):
+    """
+    Return a token that changes whenever a comment on the object is
+    posted, edited or removed. Cached pages of comments include it in
+    their keys, so they're never served stale.
+    """
+    key = "comments-generation:%s:%s" % (content_type_id, object_pk)
+    return cache.get_or_set(key, lambda: uuid.uuid4().hex, None)
+
+def invalidate_comments(sender, instance, **kwargs):
+    cache.delete("comments-generation:%s:%s" % (instance.content_type_id, instance.object_pk))
+
+# Removing a comment, through django_comments' moderation views, saves it.
+post_save.connect(invalidate_comments, sender=RatingComment)
+post_delete.connect(invalidate_comments, sender=RatingComment)
+
+def add_extension_ratings(extension_pk, count, total):
+    """Add count ratings, adding up to total, to an extension's."""
+    from sweettooth.extensions.models import Extension
+
+    prior_count = settings.EXTENSION_RATING_PRIOR_COUNT
+    prior_total = settings.EXTENSION_RATING_PRIOR_MEAN * prior_count
+
+    extensions = Extension.objects.filter(pk=extension_pk)
+    with transaction.atomic():
+        extensions.update(rating_count=F('rating_count') + count,
+                          rating_sum=F('rating_sum') + total)
+        # Separately: MySQL would see the new counts in the same UPDATE,
+        # other databases the old ones. See get_rating_score.
+        extensions.update(rating_score=ExpressionWrapper(
+            (Value(prior_total) + F('rating_sum')) / (Value(float(prior_count)) + F('rating_count')),
+            output_field=FloatField()))
+
+def apply_rating_change(comment, old, new):
+    if old != new:
+        extension_pk = comment.get_extension_pk()
+        if extension_pk is not None:
+            add_extension_ratings(extension_pk, (new is not None) - (old is not None), (new or 0) - (old or 0))
+
+    comment._saved_rating = new
+
+def update_rating(sender, instance, created, **kwargs):
+    # Posting, moderating and editing a comment all save it.
+    apply_rating_change(instance, None if created else instance._saved_rating, instance.get_counted_rating())
+
+def remove_rating(sender, instance, **kwargs):
+    apply_rating_change(instance, instance._saved_rating, None)
+
+post_save.connect(update_rating, sender=RatingComment)
+post_delete.connect(remove_rating, sender=RatingComment)
+
+def recompute_ratings(apps=None):
+    """
+    Recount the ratings of every extension from its comments. Returns
+    the number of extensions whose ratings were off. A migration passes
+    its apps, to use the models as they are at that point.
+    """
+    from sweettooth.extensions.models import RATING_FIELDS, get_rating_score
+
+    if apps is None:
+        from django.apps import apps
+
+    Extension = apps.get_model('extensions', 'Extension')
+    RatingComment = apps.get_model('ratings', 'RatingComment')
+
+    totals = (RatingComment.objects.filter(content_type__app_label='extensions',
+                                           content_type__model='extension',
+                                           is_public=True, is_removed=False, rating__gt=-1)
+                                   # The default ordering would end up in the GROUP BY.
+                                   .order_by()
+                                   .values('object_pk')
+                                   .annotate(count=Count('id'), total=Sum('rating'))
+                                   .values_list('object_pk', 'count', 'total'))
+    by_pk = dict((int(pk), (count, total)) for pk, count, total in totals)
+
+    changed = []
+    for pk, count, total, score in Extension.objects.values_list('pk', *RATING_FIELDS).iterator():
+        ratings = by_pk.get(pk, (0, 0))
+        ratings += (get_rating_score(*ratings),)
+        if ratings != (count, total, score):
+            extension = Extension(pk=pk)
+            extension.rating_count, extension.rating_sum, extension.rating_score = ratings
+            changed.append(extension)
+
+    Extension.objects.bulk_update(changed, RATING_FIELDS, batch_size=500)
+    return len(changed)
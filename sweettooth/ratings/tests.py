@@ -0,0 +1,154 @@
+import datetime
+import json
+import tempfile
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from sweettooth.extensions.models import Extension, get_rating_score
+from sweettooth.ratings.models import RatingComment
+
+from sweettooth.testutils import BasicUserTestCase
+
+# Pages are only cached in a cache every process shares.
+cache_dir = tempfile.TemporaryDirectory()
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                                       'LOCATION': cache_dir.name}})
+class CommentsListTest(BasicUserTestCase, TestCase):
+    def setUp(self):
+        super().setUp()
+        caches['default'].clear()
+
+        metadata = {"uuid": "test-comments@mecheye.net", "name": "Test Comments"}
+        self.extension = Extension.objects.create_from_metadata(metadata, creator=self.user)
+        self.other_user = User.objects.create_user('TestUser2', 'other@non-existant.tld', 'password')
+
+    def add_comment(self, user, text, days_ago, rating=-1):
+        return RatingComment.objects.create(content_object=self.extension, site_id=1, user=user,
+                                            comment=text, rating=rating,
+                                            submit_date=datetime.datetime(2026, 10, 19) -
+                                                        datetime.timedelta(days=days_ago))
+
+    def get_page(self, **params):
+        response = self.client.get(reverse('comments-list'), dict(params, pk=self.extension.pk))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode(response.charset))
+
+    def test_pages(self):
+        for i in range(5):
+            self.add_comment(self.other_user, "comment %d" % (i,), days_ago=i)
+        self.add_comment(self.user, "by the author", days_ago=10, rating=4)
+        # Comments from the same moment are told apart by their pk.
+        self.add_comment(self.other_user, "same time", days_ago=10)
+
+        # The session, the extension, then the comments with their users.
+        with self.assertNumQueries(3):
+            page = self.get_page(limit=3)
+        self.assertEqual([c['comment'] for c in page['comments']], ["comment 0", "comment 1", "comment 2"])
+        self.assertFalse(page['comments'][0]['is_extension_creator'])
+
+        page = self.get_page(limit=3, cursor=page['next'])
+        self.assertEqual([c['comment'] for c in page['comments']], ["comment 3", "comment 4", "same time"])
+
+        page = self.get_page(limit=3, cursor=page['next'])
+        self.assertEqual([c['comment'] for c in page['comments']], ["by the author"])
+        self.assertTrue(page['comments'][0]['is_extension_creator'])
+        self.assertEqual(page['comments'][0]['rating'], 4)
+        self.assertIsNone(page['next'])
+
+        response = self.client.get(reverse('comments-list'), dict(pk=self.extension.pk, cursor="bogus"))
+        self.assertEqual(response.status_code, 400)
+
+    def test_cache_invalidation(self):
+        comment = self.add_comment(self.other_user, "first", days_ago=1)
+        self.assertEqual(len(self.get_page()['comments']), 1)
+
+        # Served from the cache: only the session and extension are looked up.
+        with self.assertNumQueries(2):
+            self.get_page()
+
+        self.add_comment(self.other_user, "second", days_ago=0)
+        self.assertEqual([c['comment'] for c in self.get_page()['comments']], ["second", "first"])
+
+        comment.is_removed = True
+        comment.save()
+        self.assertEqual([c['comment'] for c in self.get_page()['comments']], ["second"])
+
+    def test_not_cached_per_process(self):
+        self.add_comment(self.other_user, "first", days_ago=1)
+        with self.settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            self.get_page()
+            with self.assertNumQueries(3):
+                self.get_page()
+
+    def test_all(self):
+        for i in range(7):
+            self.add_comment(self.other_user, "comment %d" % (i,), days_ago=i)
+
+        response = self.client.get('/comments/all/', dict(pk=self.extension.pk))
+        self.assertEqual(len(json.loads(response.content.decode(response.charset))), 5)
+
+        response = self.client.get('/comments/all/', dict(pk=self.extension.pk, all='true'))
+        self.assertEqual([c['comment'] for c in json.loads(response.content.decode(response.charset))],
+                         ["comment %d" % (i,) for i in range(7)])
+
+@override_settings(EXTENSION_RATING_PRIOR_MEAN=3.0, EXTENSION_RATING_PRIOR_COUNT=2)
+class RatingAggregatesTest(BasicUserTestCase, TestCase):
+    def setUp(self):
+        super().setUp()
+        metadata = {"uuid": "test-ratings@mecheye.net", "name": "Test Ratings"}
+        self.extension = Extension.objects.create_from_metadata(metadata, creator=self.user)
+
+    def add_comment(self, rating):
+        return RatingComment.objects.create(content_object=self.extension, site_id=1, user=self.user,
+                                            comment="", rating=rating,
+                                            submit_date=datetime.datetime.now())
+
+    def assertRatings(self, count, total):
+        extension = Extension.objects.get(pk=self.extension.pk)
+        self.assertEqual((extension.rating_count, extension.rating_sum), (count, total))
+        self.assertAlmostEqual(extension.rating_score, get_rating_score(count, total))
+
+    def test_incremental(self):
+        self.assertAlmostEqual(get_rating_score(0, 0), 3.0)
+
+        five = self.add_comment(5)
+        self.add_comment(4)
+        # Comments without a rating don't count.
+        self.add_comment(-1)
+        self.assertRatings(2, 9)
+        self.assertAlmostEqual(Extension.objects.get(pk=self.extension.pk).rating_score, 15 / 4)
+
+        # Saving the edited fields of an extension loaded earlier, as the
+        # views do, keeps the new ratings.
+        self.extension.name = "Renamed"
+        self.extension.save(update_fields=['name'])
+        self.assertRatings(2, 9)
+
+        five.rating = 1
+        five.save()
+        self.assertRatings(2, 5)
+
+        # Removed by a moderator, then approved again.
+        five.is_removed = True
+        five.save()
+        self.assertRatings(1, 4)
+        five.is_removed = False
+        five.save()
+        self.assertRatings(2, 5)
+
+        five.delete()
+        self.assertRatings(1, 4)
+
+    def test_recompute(self):
+        self.add_comment(5)
+        self.add_comment(2)
+        Extension.objects.filter(pk=self.extension.pk).update(rating_count=0, rating_sum=0, rating_score=0)
+
+        call_command('recomputeratings', stdout=StringIO())
+        self.assertRatings(2, 7)
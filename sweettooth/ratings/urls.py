@@ -4,5 +4,6 @@ from sweettooth.ratings import views
 
 urlpatterns = [
     url(r'^posted/$', views.comment_done, name='comments-comment-done'),
-    url(r'^all/$', views.get_comments),
+    url(r'^list/$', views.get_comments, name='comments-list'),
+    url(r'^all/$', views.get_all_comments),
 ]
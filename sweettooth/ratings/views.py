@@ -1,14 +1,21 @@
 
-import json
+import hashlib
 
 import django_comments as comments
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.messages import info
-from django.shortcuts import redirect
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.shortcuts import get_object_or_404, redirect
 from django.urls import reverse
 from django.utils.dateformat import format as format_date
+from django.utils.dateparse import parse_datetime
 
 from sweettooth.extensions import models
-from sweettooth.decorators import ajax_view, model_view
+from sweettooth.decorators import ajax_view, dump_json
+from sweettooth.ratings.models import get_comments_generation
 from sweettooth.utils import gravatar_url
 
 def comment_done(request):
@@ -17,10 +24,9 @@ def comment_done(request):
     info(request, "Thank you for your comment")
     return redirect(comment.get_content_object_url())
 
-def comment_details(request, comment):
-    extension = comment.content_object
+def comment_details(request, comment, extension):
     gravatar = gravatar_url(request, comment.email)
-    is_extension_creator = (comment.user == extension.creator)
+    is_extension_creator = (comment.user_id == extension.creator_id)
     username = comment.user.username if comment.user else "nobody"
 
     details = dict(gravatar = gravatar,
@@ -36,15 +42,94 @@ def comment_details(request, comment):
 
     return details
 
+# Comments sent per page, unless asked for fewer.
+COMMENTS_PAGE_SIZE = 5
+COMMENTS_MAX_PAGE_SIZE = 50
+
+# Seconds a page of comments stays cached; changes invalidate it sooner.
+COMMENTS_CACHE_TIMEOUT = 60 * 60
+
+def make_cursor(comment):
+    return "%s,%d" % (comment.submit_date.isoformat(), comment.pk)
+
+def parse_cursor(cursor):
+    date, pk = cursor.rsplit(',', 1)
+    date = parse_datetime(date)
+    if date is None:
+        raise ValueError(cursor)
+    return date, int(pk)
+
+def get_comments_page(request, extension, cursor, limit):
+    """
+    Return the comments on extension, newest first, that come after
+    cursor: {comments: [...], next: the cursor of the next page or None}.
+    """
+    comment_list = (comments.get_model().objects.for_model(extension)
+                                                .filter(is_public=True, is_removed=False)
+                                                .select_related('user')
+                                                # '-pk' is dropped from the ORDER BY of
+                                                # this inherited model; the id isn't.
+                                                .order_by('-submit_date', '-id'))
+
+    if cursor:
+        date, pk = parse_cursor(cursor)
+        comment_list = comment_list.filter(Q(submit_date__lt=date) | Q(submit_date=date, pk__lt=pk))
+
+    # One more than asked for tells whether there's a next page.
+    page = list(comment_list[:limit + 1])
+    next_cursor = make_cursor(page[limit - 1]) if len(page) > limit else None
+
+    return dict(comments=[comment_details(request, comment, extension) for comment in page[:limit]],
+                next=next_cursor)
+
 @ajax_view
 def get_comments(request):
-    extension = models.Extension.objects.get(pk=request.GET['pk'])
-    show_all = json.loads(request.GET.get('all', 'false'))
+    try:
+        pk = int(request.GET['pk'])
+        cursor = request.GET.get('cursor', '')
+        limit = min(int(request.GET.get('limit', COMMENTS_PAGE_SIZE)), COMMENTS_MAX_PAGE_SIZE)
+        if cursor:
+            parse_cursor(cursor)
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest()
 
-    comment_list = comments.get_model().objects.for_model(extension)
-    comment_list = comment_list.order_by('-submit_date')
+    if limit < 1:
+        return HttpResponseBadRequest()
+
+    extension = get_object_or_404(models.Extension, pk=pk)
+
+    cache = caches['default']
+    if isinstance(cache, LocMemCache):
+        # Other processes wouldn't see that a comment changed.
+        return HttpResponse(dump_json(get_comments_page(request, extension, cursor, limit)),
+                            content_type="application/json")
+
+    # Pages are cached until a comment on the extension changes.
+    content_type = ContentType.objects.get_for_model(extension)
+    generation = get_comments_generation(content_type.pk, extension.pk)
+    key = "comments:%d:%s:%d:%s" % (extension.pk, generation, limit,
+                                    hashlib.md5(cursor.encode('utf-8')).hexdigest())
+
+    content = cache.get(key)
+    if content is None:
+        content = dump_json(get_comments_page(request, extension, cursor, limit))
+        cache.set(key, content, COMMENTS_CACHE_TIMEOUT)
+
+    return HttpResponse(content, content_type="application/json")
+
+@ajax_view
+def get_all_comments(request):
+    """
+    What /comments/all/ used to return, for clients that still use it:
+    the five newest comments, or with all=true, every one of them.
+    """
+    extension = get_object_or_404(models.Extension, pk=request.GET['pk'])
+    show_all = request.GET.get('all', 'false') == 'true'
 
-    if not show_all:
-        comment_list = comment_list[:5]
+    page = get_comments_page(request, extension, '', COMMENTS_MAX_PAGE_SIZE if show_all else COMMENTS_PAGE_SIZE)
+    comment_list = page['comments']
+    while show_all and page['next']:
+        page = get_comments_page(request, extension, page['next'], COMMENTS_MAX_PAGE_SIZE)
+        comment_list += page['comments']
 
-    return [comment_details(request, comment) for comment in comment_list]
+    return comment_list
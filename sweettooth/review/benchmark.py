@@ -0,0 +1,270 @@
+"""
+Benchmarks for the review diff engine.
+
+The corpus is generated, from a seed, to look like what gets uploaded:
+extension JavaScript with small or large changes, reordered code,
+minified bundles and translation catalogs. Each case is timed through
+get_chunks end to end, then per MyersDiffer phase, then for the
+intra-line regions alone, and its peak allocations are measured with
+tracemalloc. The results are plain dicts, ready for JSON, so runs from
+before and after a change can be compared with compare_results.
+"""
+
+import platform
+import random
+import statistics
+import time
+import tracemalloc
+
+from sweettooth.review import diffutils
+
+WORDS = ("actor", "settings", "label", "button", "menu", "item", "icon",
+         "panel", "signal", "box", "text", "source", "window", "index",
+         "value", "child", "layout", "style", "timeout", "extension")
+
+def _identifier(rng):
+    return rng.choice(WORDS) + rng.choice(WORDS).capitalize()
+
+def _statement(rng):
+    kind = rng.randrange(5)
+    if kind == 0:
+        return "let %s = %s.%s(%d);" % (_identifier(rng), _identifier(rng), _identifier(rng), rng.randrange(100))
+    elif kind == 1:
+        return "this._%s.connect('%s', this._on%s.bind(this));" % (_identifier(rng), rng.choice(WORDS),
+                                                                  _identifier(rng).capitalize())
+    elif kind == 2:
+        return "if (%s === null)" % (_identifier(rng),)
+    elif kind == 3:
+        return "%s.add_child(%s);" % (_identifier(rng), _identifier(rng))
+    else:
+        return "return %s;" % (_identifier(rng),)
+
+def _function(rng):
+    body = ["    " + _statement(rng) for i in range(rng.randint(3, 15))]
+    return ["function %s() {" % (_identifier(rng),)] + body + ["}", ""]
+
+def _javascript(rng, num_lines):
+    blocks = []
+    count = 0
+    while count < num_lines:
+        block = _function(rng)
+        blocks.append(block)
+        count += len(block)
+    return blocks
+
+def _flatten(blocks):
+    return [line for block in blocks for line in block]
+
+def small_edits(rng, scale):
+    blocks = _javascript(rng, 1500 * scale)
+    old = _flatten(blocks)
+    new = list(old)
+
+    for i in range(10 * scale):
+        index = rng.randrange(len(new))
+        if rng.random() < 0.7:
+            new[index] = "    " + _statement(rng)
+        else:
+            new.insert(index, "    " + _statement(rng))
+
+    return old, new
+
+def large_rewrite(rng, scale):
+    blocks = _javascript(rng, 1500 * scale)
+    new_blocks = [_function(rng) if rng.random() < 0.6 else block for block in blocks]
+    return _flatten(blocks), _flatten(new_blocks)
+
+def reordered_blocks(rng, scale):
+    blocks = _javascript(rng, 1500 * scale)
+    new_blocks = list(blocks)
+
+    for i in range(len(new_blocks) // 4):
+        block = new_blocks.pop(rng.randrange(len(new_blocks)))
+        new_blocks.insert(rng.randrange(len(new_blocks) + 1), block)
+
+    return _flatten(blocks), _flatten(new_blocks)
+
+def minified(rng, scale):
+    # Bundled/minified code: few lines, each thousands of characters.
+    old = [";".join(_statement(rng).replace(" ", "") for i in range(rng.randint(100, 400)))
+           for line in range(20 * scale)]
+    new = list(old)
+
+    for i in range(5 * scale):
+        index = rng.randrange(len(new))
+        statements = new[index].split(";")
+        statements[rng.randrange(len(statements))] = _statement(rng).replace(" ", "")
+        new[index] = ";".join(statements)
+
+    return old, new
+
+def po_catalog(rng, scale):
+    # A translation catalog after a string freeze: source references
+    # move, some translations change, a few strings come and go.
+    def entry(msgid, line, msgstr):
+        return ["#: extension.js:%d" % (line,),
+                'msgid "%s"' % (msgid,),
+                'msgstr "%s"' % (msgstr,),
+                ""]
+
+    strings = [(" ".join(rng.choice(WORDS) for i in range(rng.randint(1, 6))), rng.randrange(2000))
+               for i in range(1000 * scale)]
+
+    old, new = [], []
+    for msgid, line in strings:
+        msgstr = msgid.upper()
+        old += entry(msgid, line, msgstr)
+
+        if rng.random() < 0.05:
+            continue
+        if rng.random() < 0.5:
+            line += rng.randint(1, 20)
+        if rng.random() < 0.2:
+            msgstr = msgstr.lower()
+        new += entry(msgid, line, msgstr)
+
+    return old, new
+
+CASES = (
+    ("small edits", small_edits),
+    ("large rewrite", large_rewrite),
+    ("reordered blocks", reordered_blocks),
+    ("minified js", minified),
+    ("po catalog", po_catalog),
+)
+
+def generate_corpus(seed=0, scale=1):
+    """Yield (name, old lines, new lines) for each case."""
+    for name, generate in CASES:
+        old, new = generate(random.Random("%s-%d" % (name, seed)), scale)
+        yield name, old, new
+
+class TimedMyersDiffer(diffutils.MyersDiffer):
+    """A MyersDiffer that records the time spent in each phase."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.phases = dict(codes=0.0, discard=0.0, lcs=0.0, shift=0.0)
+        self._lcs_depth = 0
+
+    def _timed(self, phase, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self.phases[phase] += time.perf_counter() - start
+
+    def _gen_diff_codes(self, lines):
+        return self._timed('codes', super()._gen_diff_codes, lines)
+
+    def _discard_confusing_lines(self):
+        return self._timed('discard', super()._discard_confusing_lines)
+
+    def _lcs(self, *args):
+        # Recursive; only time the outermost call.
+        self._lcs_depth += 1
+        try:
+            if self._lcs_depth == 1:
+                return self._timed('lcs', super()._lcs, *args)
+            return super()._lcs(*args)
+        finally:
+            self._lcs_depth -= 1
+
+    def _shift_chunks(self, data, other_data):
+        return self._timed('shift', super()._shift_chunks, data, other_data)
+
+def _best_and_median(timings):
+    return dict(best=min(timings), median=statistics.median(timings))
+
+def time_get_chunks(old, new, max_cost, repeat):
+    timings = []
+    for i in range(repeat):
+        diffutils.get_line_changed_regions.cache_clear()
+        start = time.perf_counter()
+        chunks = list(diffutils.get_chunks(old, new, max_cost=max_cost))
+        timings.append(time.perf_counter() - start)
+
+    return dict(_best_and_median(timings), chunks=len(chunks))
+
+def time_phases(old, new, max_cost, repeat):
+    runs = []
+    for i in range(repeat):
+        differ = TimedMyersDiffer(old, new, ignore_space=True, max_cost=max_cost)
+
+        start = time.perf_counter()
+        opcodes = list(differ.get_opcodes())
+        total = time.perf_counter() - start
+
+        phases = dict(differ.phases)
+        phases['opcodes'] = total - sum(phases.values())
+        phases['total'] = total
+        runs.append(phases)
+
+    result = dict((phase, min(run[phase] for run in runs)) for phase in runs[0])
+    result['opcodes_count'] = len(opcodes)
+    return result, opcodes
+
+def time_regions(old, new, opcodes, repeat):
+    pairs = [(old[i], new[j])
+             for tag, i1, i2, j1, j2 in opcodes if tag == 'replace'
+             for i, j in zip(range(i1, i2), range(j1, j2))]
+
+    timings = []
+    for i in range(repeat):
+        diffutils.get_line_changed_regions.cache_clear()
+        start = time.perf_counter()
+        for oldline, newline in pairs:
+            diffutils.get_line_changed_regions(oldline, newline)
+        timings.append(time.perf_counter() - start)
+
+    return dict(_best_and_median(timings), pairs=len(pairs))
+
+def measure_memory(old, new, max_cost):
+    diffutils.get_line_changed_regions.cache_clear()
+    tracemalloc.start()
+    try:
+        list(diffutils.get_chunks(old, new, max_cost=max_cost))
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return dict(peak_bytes=peak)
+
+def run_case(name, old, new, max_cost=None, repeat=3):
+    phases, opcodes = time_phases(old, new, max_cost, repeat)
+
+    return dict(name=name,
+                old_lines=len(old),
+                new_lines=len(new),
+                old_bytes=sum(len(line) for line in old),
+                new_bytes=sum(len(line) for line in new),
+                get_chunks=time_get_chunks(old, new, max_cost, repeat),
+                phases=phases,
+                regions=time_regions(old, new, opcodes, repeat),
+                memory=measure_memory(old, new, max_cost))
+
+def run(cases, max_cost=None, repeat=3, seed=None, scale=None):
+    return dict(python=platform.python_version(),
+                max_cost=max_cost,
+                repeat=repeat,
+                seed=seed,
+                scale=scale,
+                cases=[run_case(name, old, new, max_cost, repeat) for name, old, new in cases])
+
+def compare_results(baseline, results):
+    """
+    Yield (case name, metric, baseline value, new value) for the
+    timings and peak memory of the cases both runs have.
+    """
+    baseline_cases = dict((case['name'], case) for case in baseline['cases'])
+
+    for case in results['cases']:
+        old_case = baseline_cases.get(case['name'])
+        if old_case is None:
+            continue
+
+        yield case['name'], 'get_chunks', old_case['get_chunks']['best'], case['get_chunks']['best']
+        for phase in ('codes', 'discard', 'lcs', 'shift', 'opcodes'):
+            yield case['name'], phase, old_case['phases'][phase], case['phases'][phase]
+        yield case['name'], 'regions', old_case['regions']['best'], case['regions']['best']
+        yield case['name'], 'peak_bytes', old_case['memory']['peak_bytes'], case['memory']['peak_bytes']
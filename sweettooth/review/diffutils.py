@@ -1,15 +1,39 @@
-
 # The code in this file is adapted from ReviewBoard, MIT licensed
 # https://github.com/reviewboard/reviewboard
 # Copyright 2011 Review Board Team
 
+import functools
 import re
+import time
+from array import array
+from collections import Counter
 from itertools import zip_longest
 from difflib import SequenceMatcher
 
+from django.conf import settings
+
+# Matches the next line that is still provisionally discarded.
+DISCARDED_RE = re.compile(b'[^\x00]')
+
+def new_vector(size, value=0):
+    # Plain lists on purpose: the snake search reads these in its innermost
+    # loop, and indexing an array boxes a fresh int object on every read.
+    return [value] * size
+
 class MyersDiffer:
     """
     An implementation of Eugene Myers's O(ND) Diff algorithm based on GNU diff.
+
+    Lines are interned into integer codes kept in flat arrays, and the
+    modified flags and discards are bytearrays, so nothing compares
+    strings or probes dicts once the codes are generated. The undiscarded
+    codes and the diagonal vectors stay lists, which index faster than
+    arrays in the innermost loops.
+
+    If max_cost is given, the search for a middle snake gives up after
+    that many steps and splits on the diagonal that made the most
+    progress, like GNU diff does without --minimal. The result is still
+    a correct diff, just not necessarily the smallest one.
     """
     SNAKE_LIMIT = 20
 
@@ -24,12 +48,12 @@ class MyersDiffer:
         def __init__(self, data):
             self.data = data
             self.length = len(data)
-            self.modified = {}
-            self.undiscarded = []
+            self.modified = bytearray(self.length)
+            self.undiscarded = None
             self.undiscarded_lines = 0
-            self.real_indexes = []
+            self.real_indexes = None
 
-    def __init__(self, a, b, ignore_space=False):
+    def __init__(self, a, b, ignore_space=False, max_cost=None):
         if type(a) != type(b):
             raise TypeError
 
@@ -40,6 +64,7 @@ class MyersDiffer:
         self.a_data = self.b_data = None
         self.ignore_space = ignore_space
         self.minimal_diff = False
+        self.max_cost = max_cost
 
         # SMS State
         self.max_lines = 0
@@ -50,8 +75,8 @@ class MyersDiffer:
 
     def ratio(self):
         self._gen_diff_data()
-        a_equals = self.a_data.length - len(self.a_data.modified)
-        b_equals = self.b_data.length - len(self.b_data.modified)
+        a_equals = self.a_data.length - self.a_data.modified.count(1)
+        b_equals = self.b_data.length - self.b_data.modified.count(1)
 
         return 1.0 * (a_equals + b_equals) / \
                      (self.a_data.length + self.b_data.length)
@@ -66,18 +91,19 @@ class MyersDiffer:
         """
         self._gen_diff_data()
 
+        a_modified, a_length = self.a_data.modified, self.a_data.length
+        b_modified, b_length = self.b_data.modified, self.b_data.length
+
         a_line = b_line = 0
         last_group = None
 
         # Go through the entire set of lines on both the old and new files
-        while a_line < self.a_data.length or b_line < self.b_data.length:
+        while a_line < a_length or b_line < b_length:
             a_start = a_line
             b_start = b_line
 
-            if a_line < self.a_data.length and \
-               not self.a_data.modified.get(a_line, False) and \
-               b_line < self.b_data.length and \
-               not self.b_data.modified.get(b_line, False):
+            if a_line < a_length and not a_modified[a_line] and \
+               b_line < b_length and not b_modified[b_line]:
                 # Equal
                 a_changed = b_changed = 1
                 tag = "equal"
@@ -89,17 +115,15 @@ class MyersDiffer:
                 # Count every old line that's been modified, and the
                 # remainder of old lines if we've reached the end of the new
                 # file.
-                while a_line < self.a_data.length and \
-                      (b_line >= self.b_data.length or \
-                       self.a_data.modified.get(a_line, False)):
+                while a_line < a_length and \
+                      (b_line >= b_length or a_modified[a_line]):
                     a_line += 1
 
                 # Count every new line that's been modified, and the
                 # remainder of new lines if we've reached the end of the old
                 # file.
-                while b_line < self.b_data.length and \
-                      (a_line >= self.a_data.length or \
-                       self.b_data.modified.get(b_line, False)):
+                while b_line < b_length and \
+                      (a_line >= a_length or b_modified[b_line]):
                     b_line += 1
 
                 a_changed = a_line - a_start
@@ -136,7 +160,7 @@ class MyersDiffer:
 
 
         if not last_group:
-            last_group = ("equal", 0, self.a_data.length, 0, self.b_data.length)
+            last_group = ("equal", 0, a_length, 0, b_length)
 
         yield last_group
 
@@ -158,8 +182,8 @@ class MyersDiffer:
 
         vector_size = self.a_data.undiscarded_lines + \
                       self.b_data.undiscarded_lines + 3
-        self.fdiag = [0] * vector_size
-        self.bdiag = [0] * vector_size
+        self.fdiag = new_vector(vector_size)
+        self.bdiag = new_vector(vector_size)
         self.downoff = self.upoff = self.b_data.undiscarded_lines + 1
 
         self._lcs(0, self.a_data.undiscarded_lines,
@@ -173,28 +197,18 @@ class MyersDiffer:
         Converts all unique lines of text into unique numbers. Comparing
         lists of numbers is faster than comparing lists of strings.
         """
-        codes = []
-
-        for line in lines:
-            # TODO: Handle ignoring/triming spaces, ignoring casing, and
-            #       special hooks
+        # TODO: Handle ignoring/triming spaces, ignoring casing, and
+        #       special hooks
 
-            stripped_line = line.lstrip()
+        if self.ignore_space:
+            # We still want to show lines that contain only whitespace.
+            lines = [line.lstrip() or line for line in lines]
 
-            if self.ignore_space:
-                # We still want to show lines that contain only whitespace.
-                if len(stripped_line) > 0:
-                    line = stripped_line
-
-            try:
-                code = self.code_table[line]
-            except KeyError:
-                # This is a new, unrecorded line, so mark it and store it.
-                self.last_code += 1
-                code = self.last_code
-                self.code_table[line] = code
-
-            codes.append(code)
+        # Codes are handed out in order of first appearance, starting at 1.
+        table = self.code_table
+        codes = array('l', [table.setdefault(line, len(table) + 1)
+                            for line in lines])
+        self.last_code = len(table)
 
         return codes
 
@@ -204,13 +218,18 @@ class MyersDiffer:
         """
         down_vector = self.fdiag # The vector for the (0, 0) to (x, y) search
         up_vector   = self.bdiag # The vector for the (u, v) to (N, M) search
+        downoff = self.downoff
+        upoff = self.upoff
+        a_codes = self.a_data.undiscarded
+        b_codes = self.b_data.undiscarded
+        snake_limit = self.SNAKE_LIMIT
 
         down_k = a_lower - b_lower # The k-line to start the forward search
         up_k   = a_upper - b_upper # The k-line to start the reverse search
         odd_delta = (down_k - up_k) % 2 != 0
 
-        down_vector[self.downoff + down_k] = a_lower
-        up_vector[self.upoff + up_k] = a_upper
+        down_vector[downoff + down_k] = a_lower
+        up_vector[upoff + up_k] = a_upper
 
         dmin = a_lower - b_upper
         dmax = a_upper - b_lower
@@ -226,84 +245,87 @@ class MyersDiffer:
 
             if down_min > dmin:
                 down_min -= 1
-                down_vector[self.downoff + down_min - 1] = -1
+                down_vector[downoff + down_min - 1] = -1
             else:
                 down_min += 1
 
             if down_max < dmax:
                 down_max += 1
-                down_vector[self.downoff + down_max + 1] = -1
+                down_vector[downoff + down_max + 1] = -1
             else:
                 down_max -= 1
 
-            # Extend the forward path
-            for k in range(down_max, down_min - 1, -2):
-                tlo = down_vector[self.downoff + k - 1]
-                thi = down_vector[self.downoff + k + 1]
+            # Extend the forward path. The loop runs over vector indexes
+            # rather than k-lines to save re-adding the offset everywhere;
+            # both vectors share the same offset, so an index is valid in
+            # either of them.
+            up_first, up_last = upoff + up_min, upoff + up_max
+            for index in range(downoff + down_max, downoff + down_min - 1, -2):
+                tlo = down_vector[index - 1]
+                thi = down_vector[index + 1]
 
                 if tlo >= thi:
                     x = tlo + 1
                 else:
                     x = thi
 
-                y = x - k
+                y = x - index + downoff
                 old_x = x
 
                 # Find the end of the furthest reaching forward D-path in
                 # diagonal k
-                while x < a_upper and y < b_upper and \
-                      self.a_data.undiscarded[x] == self.b_data.undiscarded[y]:
+                while x < a_upper and y < b_upper and a_codes[x] == b_codes[y]:
                     x += 1
                     y += 1
 
-                if odd_delta and up_min <= k <= up_max and \
-                   up_vector[self.upoff + k] <= x:
+                if odd_delta and up_first <= index <= up_last and \
+                   up_vector[index] <= x:
                     return x, y, True, True
 
-                if x - old_x > self.SNAKE_LIMIT:
+                if x - old_x > snake_limit:
                     big_snake = True
 
-                down_vector[self.downoff + k] = x
+                down_vector[index] = x
 
             # Extend the reverse path
             if up_min > dmin:
                 up_min -= 1
-                up_vector[self.upoff + up_min - 1] = self.max_lines
+                up_vector[upoff + up_min - 1] = self.max_lines
             else:
                 up_min += 1
 
             if up_max < dmax:
                 up_max += 1
-                up_vector[self.upoff + up_max + 1] = self.max_lines
+                up_vector[upoff + up_max + 1] = self.max_lines
             else:
                 up_max -= 1
 
-            for k in range(up_max, up_min - 1, -2):
-                tlo = up_vector[self.upoff + k - 1]
-                thi = up_vector[self.upoff + k + 1]
+            down_first, down_last = downoff + down_min, downoff + down_max
+            for index in range(upoff + up_max, upoff + up_min - 1, -2):
+                tlo = up_vector[index - 1]
+                thi = up_vector[index + 1]
 
                 if tlo < thi:
                     x = tlo
                 else:
                     x = thi - 1
 
-                y = x - k
+                y = x - index + upoff
                 old_x = x
 
                 while x > a_lower and y > b_lower and \
-                      self.a_data.undiscarded[x - 1] == \
-                      self.b_data.undiscarded[y - 1]:
+                      a_codes[x - 1] == b_codes[y - 1]:
                     x -= 1
                     y -= 1
 
-                if not odd_delta and down_min <= k <= down_max and \
-                   x <= down_vector[self.downoff + k]:
+                if not odd_delta and down_first <= index <= down_last and \
+                   x <= down_vector[index]:
                     return x, y, True, True
 
-                if old_x - x > self.SNAKE_LIMIT:
+                if old_x - x > snake_limit:
                     big_snake = True
 
-                up_vector[self.upoff + k] = x
+                up_vector[index] = x
 
             if find_minimal:
                 continue
@@ -321,11 +343,11 @@ class MyersDiffer:
             if cost > 200 and big_snake:
                 ret_x, ret_y, best = \
                     self._find_diagonal(down_min, down_max, down_k, 0,
-                                        self.downoff, down_vector,
+                                        downoff, down_vector,
                                         lambda x: x - a_lower,
-                                        lambda x: a_lower + self.SNAKE_LIMIT <=
+                                        lambda x: a_lower + snake_limit <=
                                                   x < a_upper,
-                                        lambda y: b_lower + self.SNAKE_LIMIT <=
+                                        lambda y: b_lower + snake_limit <=
                                                   y < b_upper,
                                         lambda i,k: i - k,
                                         1, cost)
@@ -334,21 +356,67 @@ class MyersDiffer:
                     return ret_x, ret_y, True, False
 
                 ret_x, ret_y, best = \
-                    self._find_diagonal(up_min, up_max, up_k, best, self.upoff,
+                    self._find_diagonal(up_min, up_max, up_k, best, upoff,
                                         up_vector,
                                         lambda x: a_upper - x,
                                         lambda x: a_lower < x <= a_upper -
-                                                  self.SNAKE_LIMIT,
+                                                  snake_limit,
                                         lambda y: b_lower < y <= b_upper -
-                                                  self.SNAKE_LIMIT,
+                                                  snake_limit,
                                         lambda i,k: i + k,
                                         0, cost)
 
                 if best > 0:
                     return ret_x, ret_y, False, True
 
+            if self.max_cost is not None and cost >= self.max_cost:
+                return self._find_furthest(a_lower, a_upper, b_lower, b_upper,
+                                           down_min, down_max, up_min, up_max)
+
         raise Exception("The function should not have reached here.")
 
+    def _find_furthest(self, a_lower, a_upper, b_lower, b_upper,
+                       down_min, down_max, up_min, up_max):
+        """
+        Gives up on the middle snake once the search got too expensive and
+        splits on whichever diagonal got closest to its goal instead.
+        """
+        down_vector, downoff = self.fdiag, self.downoff
+        up_vector, upoff = self.bdiag, self.upoff
+
+        # The forward diagonal that maximizes x + y.
+        down_best_xy = -1
+        for d in range(down_max, down_min - 1, -2):
+            x = min(down_vector[downoff + d], a_upper)
+            y = x - d
+
+            if y > b_upper:
+                x = b_upper + d
+                y = b_upper
+
+            if x + y > down_best_xy:
+                down_best_xy = x + y
+                down_best_x = x
+
+        # The reverse diagonal that minimizes x + y.
+        up_best_xy = a_upper + b_upper + 1
+        for d in range(up_max, up_min - 1, -2):
+            x = max(a_lower, up_vector[upoff + d])
+            y = x - d
+
+            if y < b_lower:
+                x = b_lower + d
+                y = b_lower
+
+            if x + y < up_best_xy:
+                up_best_xy = x + y
+                up_best_x = x
+
+        if (a_upper + b_upper) - up_best_xy < down_best_xy - (a_lower + b_lower):
+            return down_best_x, down_best_xy - down_best_x, True, False
+        else:
+            return up_best_x, up_best_xy - up_best_x, False, True
+
     def _find_diagonal(self, minimum, maximum, k, best, diagoff, vector,
                        vdiff_func, check_x_range, check_y_range,
                        discard_index, k_offset, cost):
@@ -379,29 +447,30 @@ class MyersDiffer:
         The divide-and-conquer implementation of the Longest Common
         Subsequence (LCS) algorithm.
         """
+        a_codes = self.a_data.undiscarded
+        b_codes = self.b_data.undiscarded
+
         # Fast walkthrough equal lines at the start
         while a_lower < a_upper and b_lower < b_upper and \
-              self.a_data.undiscarded[a_lower] == \
-              self.b_data.undiscarded[b_lower]:
+              a_codes[a_lower] == b_codes[b_lower]:
             a_lower += 1
             b_lower += 1
 
         while a_upper > a_lower and b_upper > b_lower and \
-              self.a_data.undiscarded[a_upper - 1] == \
-              self.b_data.undiscarded[b_upper - 1]:
+              a_codes[a_upper - 1] == b_codes[b_upper - 1]:
             a_upper -= 1
             b_upper -= 1
 
         if a_lower == a_upper:
             # Inserted lines.
-            while b_lower < b_upper:
-                self.b_data.modified[self.b_data.real_indexes[b_lower]] = True
-                b_lower += 1
+            modified, real_indexes = self.b_data.modified, self.b_data.real_indexes
+            for index in real_indexes[b_lower:b_upper]:
+                modified[index] = True
         elif b_lower == b_upper:
             # Deleted lines
-            while a_lower < a_upper:
-                self.a_data.modified[self.a_data.real_indexes[a_lower]] = True
-                a_lower += 1
+            modified, real_indexes = self.a_data.modified, self.a_data.real_indexes
+            for index in real_indexes[a_lower:a_upper]:
+                modified[index] = True
         else:
             # Find the middle snake and length of an optimal path for A and B
             x, y, low_minimal, high_minimal = \
@@ -424,15 +493,24 @@ class MyersDiffer:
         the two lines are identical, we can shift the chunk so that the line
         appears both before and after the line, rather than only after.
         """
+        codes = data.data
+        modified = data.modified
+        other_modified = other_data.modified
+
+        def changed(flags, index):
+            # The scan runs off both ends of the files; anything out there
+            # counts as unchanged.
+            return 0 <= index < len(flags) and flags[index]
+
         i = j = 0
         i_end = data.length
 
         while True:
             # Scan forward in order to find the start of a run of changes.
-            while i < i_end and not data.modified.get(i, False):
+            while i < i_end and not changed(modified, i):
                 i += 1
 
-                while other_data.modified.get(j, False):
+                while changed(other_modified, j):
                     j += 1
 
             if i == i_end:
@@ -442,10 +520,10 @@ class MyersDiffer:
 
             # Find the end of these changes
             i += 1
-            while data.modified.get(i, False):
+            while changed(modified, i):
                 i += 1
 
-            while other_data.modified.get(j, False):
+            while changed(other_modified, j):
                 j += 1
 
             while True:
@@ -454,43 +532,43 @@ class MyersDiffer:
                 # Move the changed chunks back as long as the previous
                 # unchanged line matches the last changed line.
                 # This merges with the previous changed chunks.
-                while start != 0 and data.data[start - 1] == data.data[i - 1]:
+                while start != 0 and codes[start - 1] == codes[i - 1]:
                     start -= 1
                     i -= 1
 
-                    data.modified[start] = True
-                    data.modified[i] = False
+                    modified[start] = True
+                    modified[i] = False
 
-                    while data.modified.get(start - 1, False):
+                    while changed(modified, start - 1):
                         start -= 1
 
                     j -= 1
-                    while other_data.modified.get(j, False):
+                    while changed(other_modified, j):
                         j -= 1
 
                 # The end of the changed run at the last point where it
                 # corresponds to the changed run in the other data set.
                 # If it's equal to i_end, then we didn't find a corresponding
                 # point.
-                if other_data.modified.get(j - 1, False):
+                if changed(other_modified, j - 1):
                     corresponding = i
                 else:
                     corresponding = i_end
 
                 # Move the changed region forward as long as the first
                 # changed line is the same as the following unchanged line.
-                while i != i_end and data.data[start] == data.data[i]:
-                    data.modified[start] = False
-                    data.modified[i] = True
+                while i != i_end and codes[start] == codes[i]:
+                    modified[start] = False
+                    modified[i] = True
 
                     start += 1
                     i += 1
 
-                    while data.modified.get(i, False):
+                    while changed(modified, i):
                         i += 1
 
                     j += 1
-                    while other_data.modified.get(j, False):
+                    while changed(other_modified, j):
                         j += 1
                         corresponding = i
 
@@ -503,25 +581,27 @@ class MyersDiffer:
                 start -= 1
                 i -= 1
 
-                data.modified[start] = True
-                data.modified[i] = False
+                modified[start] = True
+                modified[i] = False
 
                 j -= 1
-                while other_data.modified.get(j, False):
+                while changed(other_modified, j):
                     j -= 1
 
     def _discard_confusing_lines(self):
-        def build_discard_list(data, discards, counts):
-            many = 5 * self._very_approx_sqrt(data.length / 64)
+        DISCARD_NONE = self.DISCARD_NONE
+        DISCARD_FOUND = self.DISCARD_FOUND
+        DISCARD_CANCEL = self.DISCARD_CANCEL
 
-            for i, item in enumerate(data.data):
-                if item != 0:
-                    num_matches = counts[item]
+        def build_discard_list(data, counts):
+            many = 5 * self._very_approx_sqrt(data.length / 64)
 
-                    if num_matches == 0:
-                        discards[i] = self.DISCARD_FOUND
-                    elif num_matches > many:
-                        discards[i] = self.DISCARD_CANCEL
+            # Lines that never appear on the other side are discarded, lines
+            # that appear there too often only provisionally so.
+            return bytearray(DISCARD_FOUND if num_matches == 0 else
+                             DISCARD_CANCEL if num_matches > many else
+                             DISCARD_NONE
+                             for num_matches in map(counts.__getitem__, data.data))
 
         def scan_run(discards, i, length, index_func):
             consec = 0
@@ -530,16 +610,16 @@ class MyersDiffer:
                 index = index_func(i, j)
                 discard = discards[index]
 
-                if j >= 8 and discard == self.DISCARD_FOUND:
+                if j >= 8 and discard == DISCARD_FOUND:
                     break
 
-                if discard == self.DISCARD_FOUND:
+                if discard == DISCARD_FOUND:
                     consec += 1
                 else:
                     consec = 0
 
-                    if discard == self.DISCARD_CANCEL:
-                        discards[index] = self.DISCARD_NONE
+                    if discard == DISCARD_CANCEL:
+                        discards[index] = DISCARD_NONE
 
                 if consec == 3:
                     break
@@ -547,28 +627,32 @@ class MyersDiffer:
         def check_discard_runs(data, discards):
             i = 0
             while i < data.length:
+                # Lines that are kept can't start a run, so skip straight
+                # to the next one that is (provisionally) discarded.
+                match = DISCARDED_RE.search(discards, i)
+                if match is None:
+                    break
+
+                i = match.start()
+
                 # Cancel the provisional discards that are not in the middle
                 # of a run of discards
-                if discards[i] == self.DISCARD_CANCEL:
-                    discards[i] = self.DISCARD_NONE
-                elif discards[i] == self.DISCARD_FOUND:
+                if discards[i] == DISCARD_CANCEL:
+                    discards[i] = DISCARD_NONE
+                elif discards[i] == DISCARD_FOUND:
                     # We found a provisional discard
-                    provisional = 0
 
                     # Find the end of this run of discardable lines and count
                     # how many are provisionally discardable.
-                    #for j in range(i, data.length):
-                    j = i
-                    while j < data.length:
-                        if discards[j] == self.DISCARD_NONE:
-                            break
-                        elif discards[j] == self.DISCARD_CANCEL:
-                            provisional += 1
-                        j += 1
+                    j = discards.find(DISCARD_NONE, i)
+                    if j == -1:
+                        j = data.length
+
+                    provisional = discards.count(DISCARD_CANCEL, i, j)
 
                     # Cancel the provisional discards at the end and shrink
                     # the run.
-                    while j > i and discards[j - 1] == self.DISCARD_CANCEL:
+                    while j > i and discards[j - 1] == DISCARD_CANCEL:
                         j -= 1
                         discards[j] = 0
                         provisional -= 1
@@ -580,21 +664,21 @@ class MyersDiffer:
                     if provisional * 4 > length:
                         while j > i:
                             j -= 1
-                            if discards[j] == self.DISCARD_CANCEL:
-                                discards[j] = self.DISCARD_NONE
+                            if discards[j] == DISCARD_CANCEL:
+                                discards[j] = DISCARD_NONE
                     else:
                         minimum = 1 + self._very_approx_sqrt(length / 4)
                         j = 0
                         consec = 0
                         while j < length:
-                            if discards[i + j] != self.DISCARD_CANCEL:
+                            if discards[i + j] != DISCARD_CANCEL:
                                 consec = 0
                             else:
                                 consec += 1
                                 if minimum == consec:
                                     j -= consec
                                 elif minimum < consec:
-                                    discards[i + j] = self.DISCARD_NONE
+                                    discards[i + j] = DISCARD_NONE
 
                             j += 1
 
@@ -605,35 +689,26 @@ class MyersDiffer:
                 i += 1
 
         def discard_lines(data, discards):
-            j = 0
-            for i, item in enumerate(data.data):
-                if self.minimal_diff or discards[i] == self.DISCARD_NONE:
-                    data.undiscarded[j] = item
-                    data.real_indexes[j] = i
-                    j += 1
-                else:
-                    data.modified[i] = True
-
-            data.undiscarded_lines = j
-
+            if self.minimal_diff:
+                kept = range(data.length)
+            else:
+                kept = [i for i, discard in enumerate(discards)
+                        if discard == DISCARD_NONE]
 
-        self.a_data.undiscarded = [0] * self.a_data.length
-        self.b_data.undiscarded = [0] * self.b_data.length
-        self.a_data.real_indexes = [0] * self.a_data.length
-        self.b_data.real_indexes = [0] * self.b_data.length
-        a_discarded = [0] * self.a_data.length
-        b_discarded = [0] * self.b_data.length
-        a_code_counts = [0] * (1 + self.last_code)
-        b_code_counts = [0] * (1 + self.last_code)
+                for i, discard in enumerate(discards):
+                    if discard != DISCARD_NONE:
+                        data.modified[i] = True
 
-        for item in self.a_data.data:
-            a_code_counts[item] += 1
+            data.undiscarded_lines = len(kept)
+            data.real_indexes = array('l', kept)
+            data.undiscarded = list(map(data.data.__getitem__, kept))
+            data.undiscarded.extend(new_vector(data.length - len(kept)))
 
-        for item in self.b_data.data:
-            b_code_counts[item] += 1
+        a_code_counts = Counter(self.a_data.data)
+        b_code_counts = Counter(self.b_data.data)
 
-        build_discard_list(self.a_data, a_discarded, b_code_counts)
-        build_discard_list(self.b_data, b_discarded, a_code_counts)
+        a_discarded = build_discard_list(self.a_data, b_code_counts)
+        b_discarded = build_discard_list(self.b_data, a_code_counts)
 
         check_discard_runs(self.a_data, a_discarded)
         check_discard_runs(self.b_data, b_discarded)
@@ -653,6 +728,38 @@ class MyersDiffer:
 
 ALPHANUM_RE = re.compile(r'\w')
 
+# SequenceMatcher is quadratic in the line length, so lines longer than
+# this (minified sources, mostly) get no intra-line regions at all.
+MAX_REGION_LINE_LENGTH = 4000
+
+class RegionBudget(object):
+    """
+    A time allowance for the intra-line regions of a single diff.
+
+    Once it runs out, diff_line stops computing regions and returns the
+    remaining lines without them. ``degraded`` is set whenever a line
+    was left without regions, either for this or for its length.
+    """
+    def __init__(self, seconds):
+        self.deadline = time.monotonic() + seconds
+        self.degraded = False
+
+    def allows(self, oldline, newline):
+        if oldline is None or newline is None or oldline == newline:
+            return True
+
+        if (len(oldline) > MAX_REGION_LINE_LENGTH or
+            len(newline) > MAX_REGION_LINE_LENGTH or
+            time.monotonic() > self.deadline):
+            self.degraded = True
+            return False
+
+        return True
+
+# Replaced lines tend to repeat (the same call changed all over a file,
+# or the same file in many versions), so remember recent results. The
+# regions are tuples as the results are shared by every caller.
+@functools.lru_cache(maxsize=settings.REVIEW_REGION_CACHE_SIZE)
 def get_line_changed_regions(oldline, newline):
     if oldline is None or newline is None:
         return (None, None)
@@ -660,6 +767,9 @@ def get_line_changed_regions(oldline, newline):
     if oldline == newline:
         return (None, None)
 
+    if len(oldline) > MAX_REGION_LINE_LENGTH or len(newline) > MAX_REGION_LINE_LENGTH:
+        return (None, None)
+
     # Use the SequenceMatcher directly. It seems to give us better results
     # for this. We should investigate steps to move to the new differ.
     differ = SequenceMatcher(None, oldline, newline)
@@ -670,7 +780,12 @@ def get_line_changed_regions(oldline, newline):
     # FIXME: just a plain, linear threshold is pretty crummy here.  Short
     # changes in a short line get lost.  I haven't yet thought of a fancy
     # nonlinear test.
-    if differ.ratio() < 0.6:
+    #
+    # real_quick_ratio() is an upper bound of ratio() that only looks at
+    # the lengths, so lines that grew or shrank a lot are turned away for
+    # free. quick_ratio() isn't worth it: source lines share nearly all
+    # of their characters, so it rarely rejects anything.
+    if differ.real_quick_ratio() < 0.6 or differ.ratio() < 0.6:
         return (None, None)
 
     oldchanges = []
@@ -698,7 +813,7 @@ def get_line_changed_regions(oldline, newline):
 
         back = (0, 0)
 
-    return (oldchanges, newchanges)
+    return (tuple(oldchanges), tuple(newchanges))
 
 def new_chunk(lines, collapsable=False, tag='equal'):
     return {
@@ -707,6 +822,14 @@ def new_chunk(lines, collapsable=False, tag='equal'):
         'collapsable': collapsable,
     }
 
+def new_collapsed_chunk(oldindex, newindex, numlines):
+    # A collapsed run of equal lines, sent without its lines. The client
+    # fetches them by range when the reviewer expands it.
+    chunk = new_chunk([], collapsable=True)
+    chunk['collapsed'] = dict(oldindex=oldindex, newindex=newindex,
+                              numlines=numlines)
+    return chunk
+
 def get_fake_chunk(numlines, tag):
     lines = [new_line(oldindex=n, newindex=n) for n in range(numlines)]
     return new_chunk(lines, tag=tag)
@@ -723,14 +846,30 @@ def new_line(oldindex, newindex, oldregion=None, newregion=None):
                 oldindex=oldindex, newindex=newindex,
                 oldregion=oldregion, newregion=newregion)
 
-def diff_line(old, new):
+def diff_line(old, new, budget=None):
     oldindex, oldline = old
     newindex, newline = new
 
-    oldregion, newregion = get_line_changed_regions(oldline, newline)
+    if budget is not None and not budget.allows(oldline, newline):
+        oldregion, newregion = None, None
+    else:
+        oldregion, newregion = get_line_changed_regions(oldline, newline)
+
     return new_line(oldindex, newindex, oldregion, newregion)
 
-def get_chunks(a, b):
+def diff_lines(a, b, i1, i2, j1, j2, budget=None):
+    oldlines = zip(range(i1, i2), a[i1:i2])
+    newlines = zip(range(j1, j2), b[j1:j2])
+
+    return [diff_line(old, new, budget) for old, new in zip_longest(oldlines, newlines, fillvalue=(None, None))]
+
+def get_chunks(a, b, max_cost=None, lazy=False, budget=None):
+    """Yields the chunks of a diff between the lists of lines a and b.
+
+    With lazy set, long collapsable runs of equal lines are yielded as
+    placeholders (see new_collapsed_chunk) instead of line by line.
+    budget is an optional RegionBudget for the intra-line regions.
+    """
     if a == b:
         return
 
@@ -749,7 +888,7 @@ def get_chunks(a, b):
 
     ignore_space = True
 
-    differ = MyersDiffer(a, b, ignore_space=ignore_space)
+    differ = MyersDiffer(a, b, ignore_space=ignore_space, max_cost=max_cost)
 
     context_num_lines = 3
     collapse_threshold = 2 * context_num_lines + 3
@@ -757,27 +896,30 @@ def get_chunks(a, b):
     for tag, i1, i2, j1, j2 in differ.get_opcodes():
         numlines = max(i2-i1, j2-j1)
 
-        oldlines = zip(range(i1, i2), a[i1:i2])
-        newlines = zip(range(j1, j2), b[j1:j2])
+        def lines(start, end):
+            return diff_lines(a, b, i1 + start, i1 + end, j1 + start, j1 + end, budget)
 
-        lines = [diff_line(old, new) for old, new in zip_longest(oldlines, newlines, fillvalue=(None, None))]
+        def collapsed_chunk(start, end):
+            if lazy:
+                return new_collapsed_chunk(i1 + start, j1 + start, end - start)
+            return new_chunk(lines(start, end), collapsable=True)
 
         if tag == 'equal' and numlines > collapse_threshold:
             last_range_start = numlines - context_num_lines
 
             if linenum == 1:
-                yield new_chunk(lines[:last_range_start], collapsable=True)
-                yield new_chunk(lines[last_range_start:numlines])
+                yield collapsed_chunk(0, last_range_start)
+                yield new_chunk(lines(last_range_start, numlines))
             else:
-                yield new_chunk(lines[:context_num_lines])
+                yield new_chunk(lines(0, context_num_lines))
 
                 if i2 == a_num_lines and j2 == b_num_lines:
-                    yield new_chunk(lines[context_num_lines:numlines], collapsable=True)
+                    yield collapsed_chunk(context_num_lines, numlines)
                 else:
-                    yield new_chunk(lines[context_num_lines:last_range_start], collapsable=True)
-                    yield new_chunk(lines[last_range_start:numlines])
+                    yield collapsed_chunk(context_num_lines, last_range_start)
+                    yield new_chunk(lines(last_range_start, numlines))
         else:
-            yield new_chunk(lines[:numlines], collapsable=False, tag=tag)
+            yield new_chunk(diff_lines(a, b, i1, i2, j1, j2, budget), collapsable=False, tag=tag)
 
         linenum += numlines
 
@@ -0,0 +1,106 @@
+import codecs
+import functools
+import hashlib
+import os.path
+
+import chardet
+import pygments
+import pygments.util
+import pygments.lexers
+import pygments.formatters
+
+from django.conf import settings
+
+from sweettooth.utils import LRUCache
+
+# Stolen from ReviewBoard
+# See the top of diffutils.py for details
+class NoWrapperHtmlFormatter(pygments.formatters.HtmlFormatter):
+    """An HTML Formatter for Pygments that don't wrap items in a div."""
+
+    def _wrap_div(self, inner):
+        # Method called by the formatter to wrap the contents of inner.
+        # Inner is a list of tuples containing formatted code. If the first item
+        # in the tuple is zero, then it's a wrapper, so we should ignore it.
+        for tup in inner:
+            if tup[0]:
+                yield tup
+
+code_formatter = NoWrapperHtmlFormatter(style="borland", cssclass="code")
+
+# Highlighted output, keyed by the content hash rather than by version
+# and filename, so an unchanged file is only highlighted once no matter
+# how many versions (or extensions) ship it.
+highlight_cache = LRUCache(settings.REVIEW_HIGHLIGHT_CACHE_SIZE, sizeof=len)
+
+# Extension sources are nearly always one of these, so there is no need
+# to have Pygments score every lexer it knows against the file contents.
+LEXER_ALIASES = {
+    '.js':   'javascript',
+    '.json': 'json',
+    '.css':  'css',
+    '.xml':  'xml',
+    '.ui':   'xml',
+    '.po':   'pot',
+    '.sh':   'bash',
+}
+
+@functools.lru_cache(maxsize=None)
+def get_lexer_by_alias(alias):
+    return pygments.lexers.get_lexer_by_name(alias)
+
+def detect_encoding(raw, final=True):
+    """
+    Return the encoding to decode raw with. With final unset, raw may
+    end halfway through a character (the head of a longer file).
+    """
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(raw, final)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+
+    # Only run the (slow) charset detection on files that aren't UTF-8.
+    encoding = chardet.detect(raw)['encoding'] or 'latin-1'
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        return 'latin-1'
+
+    return encoding
+
+def decode_source(raw):
+    if raw.startswith(codecs.BOM_UTF8):
+        raw = raw[len(codecs.BOM_UTF8):]
+
+    return raw.decode(detect_encoding(raw), 'replace')
+
+def get_lexer(filename, text):
+    base, extension = os.path.splitext(filename)
+
+    alias = LEXER_ALIASES.get(extension.lower())
+    if alias is not None:
+        return get_lexer_by_alias(alias)
+
+    try:
+        return pygments.lexers.guess_lexer_for_filename(filename, text)
+    except pygments.util.ClassNotFound:
+        return get_lexer_by_alias('text')
+
+def get_cache_key(raw, lexer, formatter):
+    return (hashlib.sha256(raw).hexdigest(),
+            lexer.name,
+            type(formatter).__name__,
+            formatter.style.__name__)
+
+def highlight_file(filename, raw, formatter):
+    text = decode_source(raw)
+    lexer = get_lexer(filename, text)
+
+    key = get_cache_key(raw, lexer, formatter)
+    html = highlight_cache.get(key)
+    if html is None:
+        html = pygments.highlight(text, lexer, formatter)
+        highlight_cache.set(key, html)
+
+    return html
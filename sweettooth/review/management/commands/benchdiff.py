@@ -0,0 +1,66 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from sweettooth.review import benchmark
+
+class Command(BaseCommand):
+    help = 'Benchmarks the review diff engine (see sweettooth.review.benchmark)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*', help='An old and a new file to diff instead of the generated corpus')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--scale', type=int, default=1, help='Multiplies the size of the generated files')
+        parser.add_argument('--case', action='append', help='Only run the named generated cases')
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--max-cost', type=int, default=settings.REVIEW_DIFF_MAX_COST,
+                            help='0 for an exact diff')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+        parser.add_argument('--compare', help='Compare with results from an earlier --output')
+
+    def handle(self, *args, **options):
+        if options['files']:
+            if len(options['files']) != 2:
+                raise CommandError("Give an old and a new file")
+
+            old_name, new_name = options['files']
+            with open(old_name, 'rb') as old, open(new_name, 'rb') as new:
+                cases = [("%s -> %s" % (old_name, new_name),
+                          old.read().decode('utf-8', 'replace').splitlines(),
+                          new.read().decode('utf-8', 'replace').splitlines())]
+        else:
+            cases = benchmark.generate_corpus(options['seed'], options['scale'])
+            if options['case']:
+                cases = [case for case in cases if case[0] in options['case']]
+
+        results = benchmark.run(cases,
+                                max_cost=options['max_cost'] or None,
+                                repeat=options['repeat'],
+                                seed=options['seed'],
+                                scale=options['scale'])
+
+        for case in results['cases']:
+            phases = case['phases']
+            self.stdout.write("%-18s %6d/%6d lines  get_chunks %8.3f s  "
+                              "codes %.3f discard %.3f lcs %.3f shift %.3f opcodes %.3f  "
+                              "regions %.3f s (%d pairs)  peak %.1f MiB" %
+                              (case['name'], case['old_lines'], case['new_lines'],
+                               case['get_chunks']['best'],
+                               phases['codes'], phases['discard'], phases['lcs'],
+                               phases['shift'], phases['opcodes'],
+                               case['regions']['best'], case['regions']['pairs'],
+                               case['memory']['peak_bytes'] / 1024 / 1024))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+
+            self.stdout.write("")
+            for name, metric, old, new in benchmark.compare_results(baseline, results):
+                ratio = new / old if old else float('inf')
+                self.stdout.write("%-18s %-10s %12.4g -> %12.4g  (%.2fx)" % (name, metric, old, new, ratio))
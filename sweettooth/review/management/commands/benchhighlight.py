@@ -0,0 +1,85 @@
+import glob
+import os.path
+import time
+from zipfile import ZipFile, BadZipfile
+
+import pygments
+import pygments.lexers
+import pygments.util
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from sweettooth.review.highlight import code_formatter, decode_source, get_lexer
+from sweettooth.review.views import BINARY_TYPES, IMAGE_TYPES
+
+def highlight_guessed(filename, raw):
+    # What highlight_file did before the lexer table: score every lexer
+    # against the contents and run charset detection on the whole file.
+    try:
+        lexer = pygments.lexers.guess_lexer_for_filename(filename, raw,
+                                                         encoding='chardet')
+    except pygments.util.ClassNotFound:
+        lexer = pygments.lexers.get_lexer_by_name('text', encoding='chardet')
+
+    return pygments.highlight(raw, lexer, code_formatter)
+
+def highlight_table(filename, raw):
+    text = decode_source(raw)
+    return pygments.highlight(text, get_lexer(filename, text), code_formatter)
+
+def iter_sources(paths):
+    for path in paths:
+        try:
+            zipfile = ZipFile(path, 'r')
+        except BadZipfile:
+            with open(path, 'rb') as f:
+                yield path, f.read()
+            continue
+
+        with zipfile:
+            for name in zipfile.namelist():
+                base, extension = os.path.splitext(name)
+                if name.endswith('/') or extension in BINARY_TYPES or extension in IMAGE_TYPES:
+                    continue
+
+                yield "%s:%s" % (os.path.basename(path), name), zipfile.read(name)
+
+def best_of(func, filename, raw, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(filename, raw)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+class Command(BaseCommand):
+    help = 'Compares per-file highlight time of lexer guessing against the lexer table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*',
+                            help='Extension archives or plain files. Defaults to every archive in MEDIA_ROOT.')
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or glob.glob(os.path.join(settings.MEDIA_ROOT, '*.shell-extension.zip'))
+
+        totals = [0.0, 0.0]
+        count = 0
+        for name, raw in iter_sources(paths):
+            guessed = best_of(highlight_guessed, name, raw, options['repeat'])
+            table = best_of(highlight_table, name, raw, options['repeat'])
+
+            totals[0] += guessed
+            totals[1] += table
+            count += 1
+
+            self.stdout.write("%-60s %8d bytes %9.2f ms %9.2f ms" % (name[-60:], len(raw),
+                                                                     guessed * 1000, table * 1000))
+
+        if count:
+            self.stdout.write("%d files: guessed %.2f ms, table %.2f ms per file (%.1fx)" %
+                              (count, totals[0] * 1000 / count, totals[1] * 1000 / count,
+                               totals[0] / totals[1] if totals[1] else 0))
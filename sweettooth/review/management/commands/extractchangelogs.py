@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from sweettooth.extensions.models import ExtensionVersion
+from sweettooth.review.views import store_changelog
+
+class Command(BaseCommand):
+    help = 'Extracts the changelog of versions uploaded before it was stored on upload'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Also redo versions that already have a changelog')
+
+    def handle(self, *args, **options):
+        versions = ExtensionVersion.objects.exclude(source="").select_related('extension').order_by('pk')
+        if not options['all']:
+            versions = versions.filter(changelog="")
+
+        count = 0
+        for version in versions.iterator():
+            try:
+                store_changelog(version)
+            except (IOError, OSError) as e:
+                self.stderr.write("%s: %s" % (version, e))
+                continue
+
+            if version.changelog:
+                count += 1
+
+        self.stdout.write("Stored %d changelogs" % (count,))
@@ -1,11 +1,24 @@
 
-from django.test import TestCase
+import io
+import json
+import os
+from zipfile import ZipFile
+
+from django.test import RequestFactory, TestCase, override_settings
 from django.core.files.base import File, ContentFile, StringIO
+from django.urls import reverse
 
 from sweettooth.extensions import models
-from sweettooth.review.views import get_old_version, should_auto_approve_changeset
+from sweettooth.extensions.archives import get_archive_storage
+from sweettooth.extensions.views import ajax_details
+from sweettooth.review.highlight import code_formatter, highlight_cache, highlight_file
+from sweettooth.core import tasks
+from sweettooth.core.models import TASK_DONE
+from sweettooth.review.views import (get_changelog, get_old_version, get_submitted_task_key, grab_line_range, grab_lines,
+                                     read_file, review_submitted_version, should_auto_approve_changeset)
 
 from sweettooth.testutils import BasicUserTestCase
+from sweettooth.utils import LRUCache
 
 from .tests_diff import DiffTest
 
@@ -31,6 +44,199 @@ class DiffViewTest(BasicUserTestCase, TestCase):
                                                           status=models.STATUS_UNREVIEWED)
         self.assertEqual(version1, get_old_version(version3))
 
+    def create_version(self, extension, contents, files=None):
+        f = io.BytesIO()
+        with ZipFile(f, 'w') as zipfile:
+            zipfile.writestr('extension.js', contents)
+            for filename, data in (files or {}).items():
+                zipfile.writestr(filename, data)
+
+        return models.ExtensionVersion.objects.create(extension=extension,
+                                                      source=File(ContentFile(f.getvalue()), name="aa.zip"),
+                                                      status=models.STATUS_UNREVIEWED)
+
+    def test_lazy_file_diff(self):
+        metadata = {"uuid": "test-metadata@mecheye.net",
+                    "name": "Test Metadata"}
+
+        extension = models.Extension.objects.create_from_metadata(metadata, creator=self.user)
+        oldlines = ["line %d" % (i,) for i in range(100)]
+        newlines = oldlines[:50] + ["changed"] + oldlines[51:]
+        self.create_version(extension, "\n".join(oldlines))
+        version = self.create_version(extension, "\n".join(newlines))
+
+        response = self.client.get(reverse('review-ajax-file-diff', kwargs=dict(pk=version.pk)),
+                                   dict(filename='extension.js', lazy=1))
+        data = json.loads(response.content.decode(response.charset))
+
+        # Three lines of context on each side of the change, and
+        # the two collapsed ranges around them.
+        self.assertEqual(sorted(data['newlines'], key=int), [str(i) for i in range(47, 54)])
+        self.assertEqual(data['newlines']['50'], "changed")
+        self.assertFalse(data['degraded'])
+        collapsed = [chunk['collapsed'] for chunk in data['chunks'] if chunk['collapsable']]
+        self.assertEqual(collapsed, [dict(oldindex=0, newindex=0, numlines=47),
+                                     dict(oldindex=54, newindex=54, numlines=46)])
+
+        response = self.client.get(reverse('review-ajax-file-diff', kwargs=dict(pk=version.pk)),
+                                   dict(filename='extension.js', lazy=0))
+        self.assertEqual(json.loads(response.content.decode(response.charset))['newlines'], newlines)
+
+        response = self.client.get(reverse('review-ajax-file-lines', kwargs=dict(pk=version.pk)),
+                                   dict(filename='extension.js', start=54, end=100))
+        data = json.loads(response.content.decode(response.charset))
+        self.assertEqual(data['lines'], newlines[54:100])
+
+    def test_version_diff(self):
+        metadata = {"uuid": "test-metadata@mecheye.net",
+                    "name": "Test Metadata"}
+
+        extension = models.Extension.objects.create_from_metadata(metadata, creator=self.user)
+        self.create_version(extension, "a\nb\nc", {'prefs.js': "x\ny", 'icon.png': "png",
+                                                   'gone.css': "body {}"})
+        version = self.create_version(extension, "a\nB\nc", {'prefs.js': "x\nz", 'icon.png': "gif",
+                                                             'stylesheet.css': "div {}"})
+
+        response = self.client.get(reverse('review-ajax-version-diff', kwargs=dict(pk=version.pk)))
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        changeset, diffs = json.loads(lines[0]), [json.loads(line) for line in lines[1:]]
+
+        self.assertEqual(changeset['changed'], ['extension.js', 'icon.png', 'prefs.js'])
+        self.assertEqual([d['filename'] for d in diffs],
+                         ['extension.js', 'prefs.js', 'stylesheet.css', 'gone.css'])
+
+        file_diff = self.client.get(reverse('review-ajax-file-diff', kwargs=dict(pk=version.pk)),
+                                    dict(filename='prefs.js', lazy=1))
+        self.assertEqual(dict(json.loads(file_diff.content.decode(file_diff.charset)), filename='prefs.js'),
+                         diffs[1])
+
+    def test_diff_against_base(self):
+        metadata = {"uuid": "test-metadata@mecheye.net",
+                    "name": "Test Metadata"}
+
+        extension = models.Extension.objects.create_from_metadata(metadata, creator=self.user)
+        version1 = self.create_version(extension, "one", {'prefs.js': "x"})
+        self.create_version(extension, "two", {'prefs.js': "x"})
+        version3 = self.create_version(extension, "one", {'prefs.js': "y"})
+
+        url = reverse('review-ajax-file-list', kwargs=dict(pk=version3.pk))
+        files = json.loads(self.client.get(url).content.decode('utf-8'))
+        self.assertEqual(files['changed'], ['extension.js', 'prefs.js'])
+
+        files = json.loads(self.client.get(url, dict(base=version1.pk)).content.decode('utf-8'))
+        self.assertEqual(files['changed'], ['prefs.js'])
+        self.assertEqual(files['unchanged'], ['extension.js'])
+
+        # The hashes are stored, once per version.
+        self.assertEqual(version1.files.count(), 2)
+        self.assertEqual(version3.files.get(filename='prefs.js').size, 1)
+
+        # Filling them in again, as a concurrent request would, adds nothing.
+        version1.store_file_hashes(list(version1.files.values_list('filename', 'size', 'sha256')))
+        self.assertEqual(version1.files.count(), 2)
+
+        other = models.Extension.objects.create_from_metadata(dict(metadata, uuid="other@mecheye.net"),
+                                                              creator=self.user)
+        other_version = self.create_version(other, "one")
+        self.assertEqual(self.client.get(url, dict(base=other_version.pk)).status_code, 404)
+
+    @override_settings(EXTENSION_ARCHIVE_STORAGE='sweettooth.extensions.archives.CountingArchiveStorage')
+    def test_reads_only_needed_ranges(self):
+        metadata = {"uuid": "test-metadata@mecheye.net",
+                    "name": "Test Metadata"}
+
+        extension = models.Extension.objects.create_from_metadata(metadata, creator=self.user)
+        data = os.urandom(512 * 1024)
+        self.create_version(extension, "a\nb\nc", {'data.bin': data})
+        version = self.create_version(extension, "a\nB\nc", {'data.bin': data})
+
+        storage = get_archive_storage()
+        storage.reset()
+        response = self.client.get(reverse('review-ajax-file-diff', kwargs=dict(pk=version.pk)),
+                                   dict(filename='extension.js'))
+        self.assertEqual(response.status_code, 200)
+
+        # Both archives are over 512 KiB; only their ends, for the central
+        # directory, and their starts, for extension.js, are read.
+        self.assertGreater(storage.bytes_read, 0)
+        self.assertLess(storage.bytes_read, 4 * storage.buffer_size)
+
+    def test_changelog(self):
+        metadata = {"uuid": "test-metadata@mecheye.net",
+                    "name": "Test Metadata"}
+
+        extension = models.Extension.objects.create_from_metadata(metadata, creator=self.user)
+        version1 = self.create_version(extension, "", {'CHANGELOG': "v1\n- first\n"})
+        version2 = self.create_version(extension, "", {'CHANGELOG': "v2\n- fixed a bug\n\nv1\n- first\n"})
+        self.assertEqual(get_changelog(None, version1), "v1\n- first")
+        self.assertEqual(get_changelog(version1, version2), "v2\n- fixed a bug")
+
+        # Stored on upload and served by the details API.
+        request = RequestFactory().get('/')
+        request.user = self.user
+        models.submitted_for_review.send(sender=self, request=request, version=version2)
+        version2.refresh_from_db()
+        self.assertEqual(version2.changelog, "v2\n- fixed a bug")
+
+        self.assertEqual(ajax_details(extension, version2)['changelog'], "v2\n- fixed a bug")
+
+        version3 = self.create_version(extension, "")
+        self.assertEqual(get_changelog(version2, version3), "")
+
+class ReadFileTest(TestCase):
+    def setUp(self):
+        f = io.BytesIO()
+        with ZipFile(f, 'w') as zipfile:
+            zipfile.writestr('text.js', "\ufeffone\r\ntwo\rthree\n\nfive\n" * 10)
+            zipfile.writestr('blob.dat', b"abc\0def")
+        self.zipfile = ZipFile(f, 'r')
+
+    def test_binary(self):
+        contents = read_file(self.zipfile, 'blob.dat')
+        self.assertTrue(contents['binary'])
+        self.assertEqual(contents['size'], 7)
+        self.assertIsNone(grab_lines(self.zipfile, 'blob.dat'))
+
+    def test_truncated(self):
+        contents = read_file(self.zipfile, 'text.js', limit=40)
+        self.assertTrue(contents['truncated'])
+        self.assertEqual(contents['size'], 240)
+        # Cut after the last full line
+        self.assertTrue(contents['data'].endswith(b"\n"))
+        self.assertLess(len(contents['data']), 40)
+
+        self.assertFalse(read_file(self.zipfile, 'text.js')['truncated'])
+        self.assertIsNone(read_file(self.zipfile, 'missing.js'))
+
+    def test_line_range(self):
+        lines = grab_lines(self.zipfile, 'text.js')
+        self.assertEqual(lines[:5], ["one", "two", "three", "", "five"])
+
+        for start, end in ((0, 3), (4, 12), (45, 60)):
+            self.assertEqual(grab_line_range(self.zipfile, 'text.js', start, end), lines[start:end])
+
+class SubmissionStatusTest(BasicUserTestCase, TestCase):
+    def test_submission_status(self):
+        metadata = {"uuid": "test-metadata@mecheye.net",
+                    "name": "Test Metadata"}
+
+        extension = models.Extension.objects.create_from_metadata(metadata, creator=self.user)
+        version = models.ExtensionVersion.objects.create(extension=extension,
+                                                         source=File(ContentFile("doot doo"), name="aa"),
+                                                         status=models.STATUS_UNREVIEWED)
+        tasks.enqueue(review_submitted_version, version.pk, self.user.pk,
+                      key=get_submitted_task_key(version.pk))
+
+        url = reverse('review-ajax-submission-status', kwargs=dict(pk=version.pk))
+        data = json.loads(self.client.get(url).content.decode('utf-8'))
+        self.assertTrue(data['pending'])
+        self.assertIn("checking upload", data['mvs'])
+
+        tasks.BackgroundTask.objects.update(status=TASK_DONE)
+        data = json.loads(self.client.get(url).content.decode('utf-8'))
+        self.assertFalse(data['pending'])
+        self.assertNotIn("checking upload", data['mvs'])
+
 class TestAutoApproveLogic(TestCase):
     def build_changeset(self, added=None, deleted=None, changed=None, unchanged=None):
         return dict(added=added or [],
@@ -48,3 +254,40 @@ class TestAutoApproveLogic(TestCase):
         self.assertFalse(should_auto_approve_changeset(self.build_changeset(changed=['secret_keys.json'])))
         self.assertFalse(should_auto_approve_changeset(self.build_changeset(changed=['libbignumber/BigInteger.js'])))
         self.assertFalse(should_auto_approve_changeset(self.build_changeset(added=['libbignumber/BigInteger.js'])))
+
+class HighlightCacheTest(TestCase):
+    def setUp(self):
+        highlight_cache.clear()
+
+    def test_identical_content_is_shared(self):
+        raw = b"const Main = imports.ui.main;\n"
+
+        first = highlight_file('extension.js', raw, code_formatter)
+        self.assertEqual(len(highlight_cache), 1)
+
+        # Same content in another file (and so another version or
+        # extension) with the same lexer reuses the entry.
+        second = highlight_file('prefs.js', raw, code_formatter)
+        self.assertEqual(first, second)
+        self.assertEqual(len(highlight_cache), 1)
+
+        highlight_file('extension.js', raw + b"// changed\n", code_formatter)
+        self.assertEqual(len(highlight_cache), 2)
+
+    def test_size_bounded_eviction(self):
+        evicted = []
+        cache = LRUCache(10, sizeof=len, on_evict=evicted.append)
+
+        cache.set('a', 'xxxx')
+        cache.set('b', 'yyyy')
+        cache.get('a')
+        cache.set('c', 'zzzz')
+
+        self.assertEqual(evicted, ['yyyy'])
+        self.assertIn('a', cache)
+        self.assertIn('c', cache)
+        self.assertEqual(cache.size, 8)
+
+        # Values larger than the whole cache are never stored.
+        cache.set('d', 'x' * 11)
+        self.assertNotIn('d', cache)
@@ -1,6 +1,9 @@
-
+import json
 from unittest import TestCase
-from sweettooth.review.diffutils import get_chunks, new_chunk, new_line
+
+from sweettooth.review import benchmark
+from sweettooth.review.diffutils import (MAX_REGION_LINE_LENGTH, MyersDiffer, RegionBudget, get_chunks,
+                                        get_line_changed_regions, new_chunk, new_collapsed_chunk, new_line)
 
 def strip_regions(chunks):
     for chunk in chunks:
@@ -48,3 +51,96 @@ class DiffTest(TestCase):
         b = ["a", "c"]
         self.assertDiff(a, b, [new_chunk(tag='equal', lines=[new_line(0, 0)]),
                                new_chunk(tag='replace', lines=[new_line(1, 1)])])
+
+class BoundedCostTest(TestCase):
+    def assertValidOpcodes(self, a, b, opcodes):
+        a_line = b_line = 0
+        for tag, i1, i2, j1, j2 in opcodes:
+            self.assertEqual((i1, j1), (a_line, b_line))
+            if tag == 'equal':
+                self.assertEqual(a[i1:i2], b[j1:j2])
+            a_line, b_line = i2, j2
+
+        self.assertEqual((a_line, b_line), (len(a), len(b)))
+
+    def testSmallDiffIsUnaffected(self):
+        a = ["a", "b", "c", "d", "e"]
+        b = ["a", "c", "d", "x", "e"]
+        self.assertEqual(list(MyersDiffer(a, b).get_opcodes()),
+                         list(MyersDiffer(a, b, max_cost=1000).get_opcodes()))
+
+    def testRewriteStaysCorrect(self):
+        a = ["line %d" % (i * 7 % 13) for i in range(400)]
+        b = ["line %d" % (i * 5 % 11) for i in range(400)]
+
+        for max_cost in (1, 2, 10):
+            opcodes = list(MyersDiffer(a, b, max_cost=max_cost).get_opcodes())
+            self.assertValidOpcodes(a, b, opcodes)
+
+class LazyChunksTest(TestCase):
+    def testCollapsedRangesArePlaceholders(self):
+        a = ["line %d" % (i,) for i in range(40)]
+        b = list(a)
+        b[20] = "changed"
+
+        full = list(get_chunks(a, b))
+        lazy = list(get_chunks(a, b, lazy=True))
+        self.assertEqual(len(full), len(lazy))
+
+        for full_chunk, lazy_chunk in zip(full, lazy):
+            if not full_chunk['collapsable']:
+                self.assertEqual(full_chunk, lazy_chunk)
+                continue
+
+            first = full_chunk['lines'][0]
+            self.assertEqual(lazy_chunk, new_collapsed_chunk(first['oldindex'], first['newindex'],
+                                                             len(full_chunk['lines'])))
+
+        self.assertEqual([c['collapsed']['numlines'] for c in lazy if c['collapsable']], [17, 16])
+
+class RegionBudgetTest(TestCase):
+    a = ["function foo() {", "    return 1;", "}"]
+    b = ["function foo() {", "    return 2;", "}"]
+
+    def testRegionsWithinBudget(self):
+        budget = RegionBudget(60)
+        self.assertEqual(list(get_chunks(self.a, self.b, budget=budget)),
+                         list(get_chunks(self.a, self.b)))
+        self.assertFalse(budget.degraded)
+
+    def testExhaustedBudget(self):
+        budget = RegionBudget(-1)
+        chunk = list(get_chunks(self.a, self.b, budget=budget))[1]
+        self.assertEqual(chunk['lines'], [new_line(1, 1)])
+        self.assertTrue(budget.degraded)
+
+    def testLongLines(self):
+        a = ["x" * (MAX_REGION_LINE_LENGTH + 1)]
+        b = ["x" * MAX_REGION_LINE_LENGTH + "y"]
+        budget = RegionBudget(60)
+        chunk = list(get_chunks(a, b, budget=budget))[0]
+        self.assertEqual(chunk['lines'], [new_line(0, 0)])
+        self.assertTrue(budget.degraded)
+
+    def testCachedRegions(self):
+        first = get_line_changed_regions("var x = foo(a);", "var x = foo(b);")
+        again = get_line_changed_regions("var x = foo(a);", "var x = foo(b);")
+        self.assertIs(again, first)
+        self.assertEqual(first, (((12, 13),), ((12, 13),)))
+        self.assertIsInstance(first[0], tuple)
+
+class BenchmarkTest(TestCase):
+    def testResultsCompare(self):
+        cases = [case for case in benchmark.generate_corpus(seed=1)
+                 if case[0] in ("small edits", "minified js")]
+        self.assertEqual(cases, [case for case in benchmark.generate_corpus(seed=1)
+                                 if case[0] in ("small edits", "minified js")])
+
+        results = json.loads(json.dumps(benchmark.run(cases, repeat=1)))
+        self.assertEqual([case['name'] for case in results['cases']], ["small edits", "minified js"])
+        self.assertGreater(results['cases'][0]['memory']['peak_bytes'], 0)
+
+        comparison = list(benchmark.compare_results(results, results))
+        self.assertEqual(len(comparison), 2 * 8)
+        for name, metric, old, new in comparison:
+            self.assertEqual(old, new)
@@ -13,6 +13,9 @@ urlpatterns = [
     url(r'^ajax/get-file/(?P<pk>\d+)', views.ajax_get_file_view, name='review-ajax-files'),
     url(r'^ajax/get-file-list/(?P<pk>\d+)', views.ajax_get_file_list_view, name='review-ajax-file-list'),
     url(r'^ajax/get-file-diff/(?P<pk>\d+)', views.ajax_get_file_diff_view, name='review-ajax-file-diff'),
+    url(r'^ajax/get-file-lines/(?P<pk>\d+)', views.ajax_get_file_lines_view, name='review-ajax-file-lines'),
+    url(r'^ajax/get-version-diff/(?P<pk>\d+)', views.ajax_get_version_diff_view, name='review-ajax-version-diff'),
+    url(r'^ajax/submission-status/(?P<pk>\d+)', views.ajax_submission_status_view, name='review-ajax-submission-status'),
     url(r'^submit/(?P<pk>\d+)', views.submit_review_view, name='review-submit'),
 
     url(r'^download/(?P<pk>\d+)\.shell-extension.zip$',
@@ -1,26 +1,28 @@
 
 import base64
+import codecs
 import itertools
+import json
 import os.path
 
-import pygments
-import pygments.util
-import pygments.lexers
-import pygments.formatters
-
+from django.conf import settings
 from django.core.mail import EmailMessage
-from django.http import HttpResponseForbidden, Http404
+from django.db import transaction
+from django.http import HttpResponseForbidden, Http404, StreamingHttpResponse
 from django.shortcuts import redirect, get_object_or_404, render
 from django.template import Context
 from django.template.loader import render_to_string
 from django.urls import reverse
 from django.views.decorators.http import require_POST
 
-from sweettooth.review.diffutils import get_chunks
+from sweettooth.review.diffutils import RegionBudget, get_chunks
+from sweettooth.review.highlight import code_formatter, detect_encoding, highlight_file
 from sweettooth.review.models import CodeReview, get_all_reviewers
 from sweettooth.extensions import models
 
+from sweettooth.core import tasks
 from sweettooth.decorators import ajax_view, model_view
+from sweettooth.utils import build_absolute_uri
 
 IMAGE_TYPES = {
     '.png':  'image/png',
@@ -34,21 +36,6 @@ IMAGE_TYPES = {
 # Keep this in sync with the BINARY_TYPES list at the top of review.js
 BINARY_TYPES = set(['.mo', '.compiled'])
 
-# Stolen from ReviewBoard
-# See the top of diffutils.py for details
-class NoWrapperHtmlFormatter(pygments.formatters.HtmlFormatter):
-    """An HTML Formatter for Pygments that don't wrap items in a div."""
-
-    def _wrap_div(self, inner):
-        # Method called by the formatter to wrap the contents of inner.
-        # Inner is a list of tuples containing formatted code. If the first item
-        # in the tuple is zero, then it's a wrapper, so we should ignore it.
-        for tup in inner:
-            if tup[0]:
-                yield tup
-
-code_formatter = NoWrapperHtmlFormatter(style="borland", cssclass="code")
-
 def can_review_extension(user, extension):
     if user == extension.creator:
         return True
@@ -61,36 +48,23 @@ def can_review_extension(user, extension):
 def can_approve_extension(user, extension):
     return user.has_perm("review.can-review-extensions")
 
-def highlight_file(filename, raw, formatter):
-    try:
-        lexer = pygments.lexers.guess_lexer_for_filename(filename, raw,
-                                                         encoding='chardet')
-    except pygments.util.ClassNotFound:
-        # released pygments doesn't yet have .json
-        # so hack around it here.
-        if filename.endswith('.json'):
-            lexer = pygments.lexers.get_lexer_by_name('js')
-        else:
-            lexer = pygments.lexers.get_lexer_by_name('text')
-
-    try:
-        return pygments.highlight(raw, lexer, formatter)
-    except TypeError:
-        # Fallback to UTF-8 for old broken pygments version
-        lexer.encoding = "utf-8"
-        return pygments.highlight(raw, lexer, formatter)
-
-def html_for_file(filename, raw):
+def html_for_file(filename, contents):
     base, extension = os.path.splitext(filename)
+    raw = contents['data']
 
     if extension in BINARY_TYPES:
         return None
     elif extension in IMAGE_TYPES:
         mime = IMAGE_TYPES[extension]
-        raw_base64 = base64.standard_b64encode(raw)
+        raw_base64 = base64.standard_b64encode(raw).decode('ascii')
         return dict(raw=True, html='<img src="data:%s;base64,%s">' % (mime, raw_base64,))
+    elif contents['binary']:
+        return dict(raw=False, binary=True, lines=[], size=contents['size'])
     else:
-        return dict(raw=False, lines=highlight_file(filename, raw, code_formatter).splitlines())
+        return dict(raw=False,
+                    lines=highlight_file(filename, raw, code_formatter).splitlines(),
+                    truncated=contents['truncated'],
+                    size=contents['size'])
 
 def get_old_version(version):
     extension = version.extension
@@ -112,47 +86,133 @@ def get_zipfiles(*args):
         if version is None:
             yield None
         else:
-            yield version.get_zipfile('r')
+            yield version.get_cached_zipfile()
+
+# Bytes of a file read to tell binary files from text ones, like git
+# does: text files don't contain NUL bytes.
+BINARY_SNIFF_SIZE = 8 * 1024
+
+def read_file(zipfile, filename, limit=None, sniff=True):
+    """
+    Read a file of a version's zipfile, up to limit bytes (by default
+    REVIEW_MAX_FILE_SIZE). Returns None if there's no such file, or a
+    dict with the data, the real size, and whether the data was
+    truncated or looks binary. Files that look binary are not read past
+    the sniffed head, unless sniff is unset.
+    """
+    if zipfile is None:
+        return None
 
-def grab_lines(zipfile, filename):
     try:
-        f = zipfile.open(filename, 'r')
+        info = zipfile.getinfo(filename)
     except KeyError:
         return None
-    else:
-        content = f.read()
-        f.close()
-        return content.splitlines()
 
-def get_file_list(zipfile):
-    return set(n for n in zipfile.namelist() if not n.endswith('/'))
+    if limit is None:
+        limit = settings.REVIEW_MAX_FILE_SIZE
+
+    with zipfile.open(info) as f:
+        data = f.read(min(BINARY_SNIFF_SIZE, limit))
+        if sniff and b'\0' in data:
+            return dict(data=b'', size=info.file_size, truncated=False, binary=True)
+
+        data += f.read(limit - len(data))
+        truncated = f.read(1) != b''
+
+    if truncated and sniff:
+        # Don't end halfway through a line.
+        newline = data.rfind(b'\n')
+        if newline >= 0:
+            data = data[:newline + 1]
+
+    return dict(data=data, size=info.file_size, truncated=truncated, binary=False)
+
+def decode_lines(data, encoding):
+    if data.startswith(codecs.BOM_UTF8):
+        data = data[len(codecs.BOM_UTF8):]
+
+    return [line.decode(encoding, 'replace') for line in data.splitlines()]
+
+def get_lines(contents):
+    if contents is None or contents['binary']:
+        return None
+
+    data = contents['data']
+    return decode_lines(data, detect_encoding(data, final=not contents['truncated']))
+
+def grab_lines(zipfile, filename):
+    return get_lines(read_file(zipfile, filename))
+
+def grab_line_range(zipfile, filename, start, end):
+    """
+    Lines [start, end) of a file, decoded the same way as grab_lines, but
+    streamed: only what precedes end is decompressed, and only the
+    requested lines are kept. Returns None for missing or binary files.
+    """
+    head = read_file(zipfile, filename, BINARY_SNIFF_SIZE)
+    if head is None or head['binary']:
+        return None
+
+    encoding = detect_encoding(head['data'], final=not head['truncated'])
 
-def get_file_changeset(old_zipfile, new_zipfile):
-    new_filelist = get_file_list(new_zipfile)
+    def iter_lines(f):
+        # Members iterate by '\n'; splitlines() then takes care of
+        # '\r' line ends, so the lines match grab_lines.
+        for piece in f:
+            yield from piece.splitlines()
 
-    if old_zipfile is None:
+    with zipfile.open(filename) as f:
+        lines = list(itertools.islice(iter_lines(f), start, end))
+
+    if start == 0 and lines and lines[0].startswith(codecs.BOM_UTF8):
+        lines[0] = lines[0][len(codecs.BOM_UTF8):]
+
+    return [line.decode(encoding, 'replace') for line in lines]
+
+def get_referenced_lines(chunks, lines, key):
+    # Only the lines the chunks point at, keyed by index; collapsed
+    # ranges are left for ajax_get_file_lines_view.
+    if lines is None:
+        return None
+
+    return dict((line[key], lines[line[key]])
+                for chunk in chunks
+                for line in chunk['lines']
+                if line[key] is not None)
+
+def get_base_version(request, version):
+    """
+    The version to diff against: ?base=<pk> if given, any version of the
+    same extension, or else the previous one.
+    """
+    base = request.GET.get('base')
+    if not base:
+        return get_old_version(version)
+
+    try:
+        return version.extension.versions.exclude(source="").get(pk=base)
+    except (ValueError, models.ExtensionVersion.DoesNotExist):
+        raise Http404()
+
+def get_file_changeset(old_version, new_version):
+    # Compares the stored hashes, so no file is decompressed here, no
+    # matter how far apart the versions are.
+    new_files = new_version.get_file_hashes()
+
+    if old_version is None:
         return dict(unchanged=[],
                     changed=[],
-                    added=sorted(new_filelist),
+                    added=sorted(new_files),
                     deleted=[])
 
-    old_filelist = get_file_list(old_zipfile)
+    old_files = old_version.get_file_hashes()
 
-    both    = new_filelist & old_filelist
-    added   = new_filelist - old_filelist
-    deleted = old_filelist - new_filelist
+    both    = new_files.keys() & old_files.keys()
+    added   = new_files.keys() - old_files.keys()
+    deleted = old_files.keys() - new_files.keys()
 
-    unchanged, changed = set([]), set([])
-
-    for filename in both:
-        old, new = old_zipfile.open(filename, 'r'), new_zipfile.open(filename, 'r')
-        oldcontent, newcontent = old.read(), new.read()
-
-        # Unchanged, remove
-        if oldcontent == newcontent:
-            unchanged.add(filename)
-        else:
-            changed.add(filename)
+    unchanged = set(filename for filename in both if old_files[filename] == new_files[filename])
+    changed   = both - unchanged
 
     return dict(unchanged=sorted(unchanged),
                 changed=sorted(changed),
@@ -162,65 +222,178 @@ def get_file_changeset(old_zipfile, new_zipfile):
 @ajax_view
 @model_view(models.ExtensionVersion)
 def ajax_get_file_list_view(request, version):
-    old_zipfile, new_zipfile = get_zipfiles(get_old_version(version), version)
-    return get_file_changeset(old_zipfile, new_zipfile)
+    return get_file_changeset(get_base_version(request, version), version)
+
+def is_text_file(filename):
+    file_base, file_extension = os.path.splitext(filename)
+    return file_extension not in IMAGE_TYPES and file_extension not in BINARY_TYPES
+
+def get_file_diff(old_zipfile, new_zipfile, filename, lazy=False):
+    old, new = read_file(old_zipfile, filename), read_file(new_zipfile, filename)
+    binary = any(contents['binary'] for contents in (old, new) if contents is not None)
+    truncated = any(contents['truncated'] for contents in (old, new) if contents is not None)
+
+    if binary:
+        return dict(chunks=[], oldlines=None, newlines=None, degraded=False,
+                    binary=True, truncated=False,
+                    oldsize=old and old['size'], newsize=new and new['size'])
+
+    oldlines, newlines = get_lines(old), get_lines(new)
+
+    budget = RegionBudget(settings.REVIEW_DIFF_REGION_SECONDS)
+    chunks = list(get_chunks(oldlines, newlines,
+                             max_cost=settings.REVIEW_DIFF_MAX_COST,
+                             lazy=lazy,
+                             budget=budget))
+
+    if lazy:
+        oldlines = get_referenced_lines(chunks, oldlines, 'oldindex')
+        newlines = get_referenced_lines(chunks, newlines, 'newindex')
+
+    return dict(chunks=chunks,
+                oldlines=oldlines,
+                newlines=newlines,
+                degraded=budget.degraded,
+                binary=False,
+                truncated=truncated,
+                oldsize=old and old['size'],
+                newsize=new and new['size'])
 
 @ajax_view
 @model_view(models.ExtensionVersion)
 def ajax_get_file_diff_view(request, version):
     filename = request.GET['filename']
 
-    file_base, file_extension = os.path.splitext(filename)
-    if file_extension in IMAGE_TYPES:
+    if not is_text_file(filename):
         return None
 
-    if file_extension in BINARY_TYPES:
-        return None
+    old_zipfile, new_zipfile = get_zipfiles(get_base_version(request, version), version)
+    lazy = request.GET.get('lazy') in ('1', 'true')
+    return get_file_diff(old_zipfile, new_zipfile, filename, lazy)
 
-    old_zipfile, new_zipfile = get_zipfiles(get_old_version(version), version)
-    oldlines, newlines = grab_lines(old_zipfile, filename), grab_lines(new_zipfile, filename)
+def iter_version_diffs(old_version, new_version, filenames):
+    # In this process, one file at a time: the cost of each diff is
+    # bounded by REVIEW_DIFF_MAX_COST and REVIEW_DIFF_REGION_SECONDS, and
+    # forking workers from a threaded server can copy a lock some other
+    # thread holds, like the zipfile cache's.
+    old_zipfile, new_zipfile = get_zipfiles(old_version, new_version)
+    for filename in filenames:
+        diff = get_file_diff(old_zipfile, new_zipfile, filename, lazy=True)
+        diff.update(filename=filename)
+        yield diff
 
-    chunks = list(get_chunks(oldlines, newlines))
-    return dict(chunks=chunks,
-                oldlines=oldlines,
-                newlines=newlines)
+@model_view(models.ExtensionVersion)
+def ajax_get_version_diff_view(request, version):
+    """
+    Diffs of all the changed, added and deleted text files of a version
+    against its base version (see get_base_version), as
+    newline-delimited JSON. The first line is the file changeset, then
+    one line per file, in the changeset's order, each in the same form
+    as a lazy ajax_get_file_diff_view response plus its filename.
+    """
+    old_version = get_base_version(request, version)
+    changeset = get_file_changeset(old_version, version)
+
+    filenames = [filename
+                 for filename in itertools.chain(changeset['changed'],
+                                                 changeset['added'],
+                                                 changeset['deleted'])
+                 if is_text_file(filename)]
+
+    def stream():
+        yield json.dumps(changeset) + '\n'
+        for diff in iter_version_diffs(old_version, version, filenames):
+            yield json.dumps(diff) + '\n'
+
+    return StreamingHttpResponse(stream(), content_type='application/x-ndjson')
+
+@ajax_view
+@model_view(models.ExtensionVersion)
+def ajax_get_file_lines_view(request, version):
+    filename = request.GET['filename']
+
+    try:
+        start = int(request.GET['start'])
+        end = int(request.GET['end'])
+    except (KeyError, ValueError):
+        raise Http404()
+
+    if start < 0 or end < start:
+        raise Http404()
+
+    # Capped, so a preview can't decompress a whole huge file at once.
+    end = min(end, start + settings.REVIEW_MAX_PREVIEW_LINES)
+
+    lines = grab_line_range(version.get_cached_zipfile(), filename, start, end)
+    if lines is None:
+        raise Http404()
+
+    return dict(start=start, lines=lines)
+
+CHANGELOG_NAMES = set(['changelog', 'news'])
 
-def get_changelog(old_version, new_version, filename='CHANGELOG'):
+def find_changelog(zipfile):
+    for name in sorted(zipfile.namelist()):
+        base, extension = os.path.splitext(name)
+        if '/' not in name and base.lower() in CHANGELOG_NAMES:
+            return name
+
+    return None
+
+def get_changelog(old_version, new_version):
+    """
+    Return the lines the changelog file gained, or had edited, since
+    old_version, as text. Blocks are separated by blank lines.
+    """
     old_zipfile, new_zipfile = get_zipfiles(old_version, new_version)
-    oldlines, newlines = grab_lines(old_zipfile, filename), grab_lines(new_zipfile, filename)
-    chunks = get_chunks(oldlines, newlines)
+
+    filename = find_changelog(new_zipfile)
+    if filename is None:
+        return ""
+
+    # The file may have been renamed, say from NEWS to CHANGELOG.md.
+    old_filename = old_zipfile and find_changelog(old_zipfile)
+
+    oldlines, newlines = grab_lines(old_zipfile, old_filename), grab_lines(new_zipfile, filename)
+    if newlines is None:
+        return ""
+
+    chunks = get_chunks(oldlines, newlines, max_cost=settings.REVIEW_DIFF_MAX_COST)
 
     contents = []
     for chunk in chunks:
-        if chunk['operation'] != 'insert':
+        if chunk['change'] not in ('insert', 'replace'):
             continue
 
-        content = '\n'.join(newlines[line['newindex']] for line in chunk['lines'])
-        contents.append(content)
+        content = '\n'.join(newlines[line['newindex']] for line in chunk['lines']).strip('\n')
+        if content:
+            contents.append(content)
 
     return '\n\n'.join(contents)
 
+def store_changelog(version):
+    version.changelog = get_changelog(get_old_version(version), version)
+    version.save(update_fields=['changelog'])
 
 @ajax_view
 @model_view(models.ExtensionVersion)
 def ajax_get_file_view(request, obj):
-    zipfile = obj.get_zipfile('r')
+    zipfile = obj.get_cached_zipfile()
     filename = request.GET['filename']
 
-    try:
-        f = zipfile.open(filename, 'r')
-    except KeyError:
+    base, extension = os.path.splitext(filename)
+    contents = read_file(zipfile, filename, sniff=extension not in IMAGE_TYPES)
+    if contents is None:
         raise Http404()
 
-    raw = f.read()
     if request.GET.get('raw', False):
-        return raw
+        return contents['data']
     else:
-        return html_for_file(filename, raw)
+        return html_for_file(filename, contents)
 
 def download_zipfile(request, pk):
     version = get_object_or_404(models.ExtensionVersion, pk=pk)
-    return redirect(version.source.url)
+    return redirect(version.get_download_url())
 
 @require_POST
 @model_view(models.ExtensionVersion)
@@ -272,7 +445,11 @@ def review_version_view(request, obj):
     # Other reviews on the same version.
     previous_reviews = version.reviews.all()
 
-    has_old_version = get_old_version(version) is not None
+    old_version = get_old_version(version)
+    has_old_version = old_version is not None
+
+    # Versions the diff can be shown against.
+    base_versions = all_versions.exclude(pk=version.pk).exclude(source="")
     can_approve = can_approve_extension(request.user, extension)
     can_review = can_review_extension(request.user, extension)
 
@@ -281,6 +458,8 @@ def review_version_view(request, obj):
                    all_versions=all_versions,
                    previous_reviews=previous_reviews,
                    has_old_version=has_old_version,
+                   old_version=old_version,
+                   base_versions=base_versions,
                    can_approve=can_approve,
                    can_review=can_review)
 
@@ -304,11 +483,11 @@ def render_mail(version, template, data):
 
     return EmailMessage(subject=subject.strip(), body=body.strip(), headers=headers)
 
-def send_email_submitted(request, version):
+def send_email_submitted(version):
     extension = version.extension
 
-    url = request.build_absolute_uri(reverse('review-version',
-                                             kwargs=dict(pk=version.pk)))
+    url = build_absolute_uri(reverse('review-version',
+                                     kwargs=dict(pk=version.pk)))
 
     data = dict(url=url)
 
@@ -321,12 +500,12 @@ def send_email_submitted(request, version):
 
     message.send()
 
-def send_email_auto_approved(request, version):
+def send_email_auto_approved(version):
     extension = version.extension
 
-    review_url = request.build_absolute_uri(reverse('review-version',
-                                                    kwargs=dict(pk=version.pk)))
-    version_url = request.build_absolute_uri(version.get_absolute_url())
+    review_url = build_absolute_uri(reverse('review-version',
+                                            kwargs=dict(pk=version.pk)))
+    version_url = build_absolute_uri(version.get_absolute_url())
 
     recipient_list = list(get_all_reviewers().values_list('email', flat=True))
     recipient_list.append(extension.creator.email)
@@ -377,22 +556,60 @@ def should_auto_approve(version):
     if old_version is None:
         return False
 
-    old_zipfile, new_zipfile = get_zipfiles(old_version, version)
-    changeset = get_file_changeset(old_zipfile, new_zipfile)
+    changeset = get_file_changeset(old_version, version)
     return should_auto_approve_changeset(changeset)
 
-def extension_submitted(sender, request, version, **kwargs):
-    if should_auto_approve(version):
+def get_submitted_task_key(version_pk):
+    return "review-submitted:%d" % (version_pk,)
+
+def review_submitted_version(version_pk, submitter_pk):
+    # Runs as a background task; see extension_submitted.
+    version = models.ExtensionVersion.objects.get(pk=version_pk)
+
+    if version.reviews.filter(auto=True).exists():
+        # An earlier attempt approved it, then failed to send the mail.
+        send_email = send_email_auto_approved
+    elif should_auto_approve(version):
         CodeReview.objects.create(version=version,
-                                  reviewer=request.user,
+                                  reviewer_id=submitter_pk,
                                   comments="",
                                   new_status=models.STATUS_ACTIVE,
                                   auto=True)
         version.status = models.STATUS_ACTIVE
         version.save()
-        send_email_auto_approved(request, version)
+        send_email = send_email_auto_approved
     else:
-        send_email_submitted(request, version)
+        send_email = send_email_submitted
+
+    # Only once the task's transaction is in: if it rolls back, the task
+    # is retried and would send the mail again.
+    transaction.on_commit(lambda: send_email(version))
+
+def extension_submitted(sender, request, version, **kwargs):
+    # Cheap enough to do right away (the file is capped, the diff
+    # bounded), and the mail sent by the task below includes it.
+    store_changelog(version)
+
+    # Deciding on auto-approval diffs both archives, and the mail goes
+    # out over SMTP; don't make the uploader wait for either.
+    tasks.enqueue(review_submitted_version, version.pk, request.user.pk,
+                  key=get_submitted_task_key(version.pk))
+
+@ajax_view
+@model_view(models.ExtensionVersion)
+def ajax_submission_status_view(request, version):
+    extension = version.extension
+
+    if not extension.user_can_edit(request.user):
+        return HttpResponseForbidden()
+
+    pending = bool(tasks.pending_keys([get_submitted_task_key(version.pk)]))
+    context = dict(version=version,
+                   extension=extension,
+                   checking=pending)
+
+    return dict(pending=pending,
+                mvs=render_to_string('extensions/multiversion_status.html', context))
 
 models.submitted_for_review.connect(extension_submitted)
 
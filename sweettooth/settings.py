@@ -104,6 +104,18 @@ DATABASES = {
     'default': dj_database_url.config(env="EGO_DATABASE_URL", default="sqlite://./test.db")
 }
 
+# Cache
+# https://docs.djangoproject.com/en/stable/topics/cache/
+# Local memory by default, which each process has its own of. Pages of
+# comments are only cached in a backend every process shares, like
+# memcached, so a comment posted through one is seen by all.
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('EGO_CACHE_BACKEND') or 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': os.getenv('EGO_CACHE_LOCATION') or '',
+    }
+}
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/stable/topics/i18n/
@@ -152,6 +164,54 @@ LOGIN_URL = '/accounts/login/'
 
 COMMENTS_APP = 'sweettooth.ratings'
 
+# Limits on uploaded extensions: the total size of their files, and how
+# much smaller than that the zip file may be.
+EXTENSION_MAX_UNCOMPRESSED_SIZE = 5 * 1024 * 1024
+EXTENSION_MAX_COMPRESSION_RATIO = 100
+
+# Where the files of uploaded extensions are kept, once each, by their
+# sha256 (see sweettooth.extensions.blobs). Uploads are hard linked to
+# them, so keep it on the same filesystem as MEDIA_ROOT; by default it's
+# next to it.
+EXTENSION_BLOB_ROOT = os.getenv('EGO_BLOB_ROOT') or os.path.join(MEDIA_ROOT, '..', 'blobs')
+
+# Extensions are ranked by their mean rating as if they had also been
+# rated EXTENSION_RATING_PRIOR_COUNT times at EXTENSION_RATING_PRIOR_MEAN,
+# so a couple of votes don't put one at the top. Run recomputeratings
+# after changing these.
+EXTENSION_RATING_PRIOR_MEAN = 3.0
+EXTENSION_RATING_PRIOR_COUNT = 5
+
+# Where version sources are read from for review and metadata checks; see
+# sweettooth.extensions.archives. Uploads are still written to MEDIA_ROOT.
+EXTENSION_ARCHIVE_STORAGE = 'sweettooth.extensions.archives.LocalArchiveStorage'
+
+# Extension archives each worker process keeps open for reading.
+EXTENSION_OPEN_ZIPFILES = 32
+
+# Upper bound, in characters, of syntax-highlighted files kept in memory
+# by each worker process for the review views.
+REVIEW_HIGHLIGHT_CACHE_SIZE = 32 * 1024 * 1024
+
+# Pairs of replaced lines whose changed regions each worker process
+# remembers for the review diffs.
+REVIEW_REGION_CACHE_SIZE = 4096
+
+# Bytes of a single file the review views read, highlight and diff;
+# larger files are cut at the last full line.
+REVIEW_MAX_FILE_SIZE = 512 * 1024
+
+# Lines the review views send per request for line range previews.
+REVIEW_MAX_PREVIEW_LINES = 5000
+
+# Steps the review diff may spend looking for an optimal split before it
+# settles for a good enough one (see MyersDiffer). None means no limit.
+REVIEW_DIFF_MAX_COST = 1024
+
+# Seconds a single review diff may spend highlighting changes within
+# replaced lines; the rest of the file is shown without them.
+REVIEW_DIFF_REGION_SECONDS = 2.0
+
 # See http://docs.djangoproject.com/en/stable/topics/logging for
 # more details on how to customize your logging configuration.
 from django.utils.log import DEFAULT_LOGGING as LOGGING
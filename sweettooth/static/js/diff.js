@@ -20,7 +20,27 @@ define(['jquery', 'template!diff/equals_chunk_row'], function ($, rowTemplate) {
 	//
 	// Each "buildChunk" function below should build full row(s).
 
+	// A collapsed chunk from a lazy diff carries no lines, only the
+	// range they span. Build a single placeholder row; the lines are
+	// fetched when it's expanded.
+	function buildCollapsedChunk(chunk) {
+		let range = chunk.collapsed;
+
+		return $('<tr>', {'class': 'diff-line equal equals-chunk-first-row collapsed-range'})
+			.data('range', range)
+			.append($('<td>', {'class': 'old linum'}))
+			.append($('<td>', {'class': 'new linum'}))
+			.append($('<td>', {'class': 'new contents'}).append(
+				$('<a>', {'class': 'collapsed-range-trigger'}).text('+ ' + range.numlines + ' unchanged lines')
+			));
+	}
+
 	function buildEqualChunk(chunk, oldContents, newContents) {
+		if (chunk.collapsed)
+		{
+			return buildCollapsedChunk(chunk);
+		}
+
 		let $elems = [];
 
 		for (let i in chunk.lines)
@@ -163,7 +183,25 @@ define(['jquery', 'template!diff/equals_chunk_row'], function ($, rowTemplate) {
 		'replace': buildReplaceChunk
 	};
 
-	exports.buildDiffTable = function (chunks, oldContents, newContents) {
+	function expandCollapsedRange($row, fetchLines) {
+		let range = $row.data('range');
+
+		return fetchLines(range.newindex, range.newindex + range.numlines).done(function (lines) {
+			let $rows = $.map(lines, function (contents, i) {
+				return $(rowTemplate.render({
+					oldlinenum: range.oldindex + i + 1,
+					newlinenum: range.newindex + i + 1,
+					contents: contents
+				}));
+			});
+
+			$row.replaceWith($rows);
+		});
+	}
+
+	// 'fetchLines(start, end)' should return a promise for the lines of
+	// the new file in [start, end). It's only used for lazy diffs.
+	exports.buildDiffTable = function (chunks, oldContents, newContents, fetchLines) {
 		var $table = $('<table>', {'class': 'code'});
 
 		for (let chunk of chunks)
@@ -185,6 +223,17 @@ define(['jquery', 'template!diff/equals_chunk_row'], function ($, rowTemplate) {
 			}
 		});
 
+		$table.on('click', 'a.collapsed-range-trigger', function (event) {
+			let $row = $(this).closest('tr.collapsed-range');
+			if (!$row.hasClass('loading'))
+			{
+				$row.addClass('loading');
+				expandCollapsedRange($row, fetchLines).fail(function () {
+					$row.removeClass('loading');
+				});
+			}
+		});
+
 		return $table;
 	};
 
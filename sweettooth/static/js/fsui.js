@@ -40,7 +40,8 @@ define(['jquery', 'dbus!_', 'hashParamUtils', 'modal'],
 			'name': gettext("Name"),
 			'recent': gettext("Recent"),
 			'downloads': gettext("Downloads"),
-			'popularity': gettext("Popularity")
+			'popularity': gettext("Popularity"),
+			'rating': gettext("Rating")
 		};
 
 		$.fn.fsUIify = function () {
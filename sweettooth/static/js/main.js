@@ -201,6 +201,27 @@ function($, messages, modal, hashParamUtils, commentsTemplate, staticfiles, cook
             return false;
         });
 
+        // Auto-approval of a new upload is decided in the background;
+        // keep its status up to date until that's done.
+        $('.extension.can-edit tr[data-pk]').has('.extension-status.unreviewed').each(function() {
+            var $tr = $(this);
+            var pk = $tr.data('pk');
+
+            function poll() {
+                $.ajax({
+                    type: 'GET',
+                    dataType: 'json',
+                    url: '/review/ajax/submission-status/' + pk
+                }).done(function(data) {
+                    $tr.find('.mvs').html(data.mvs);
+                    if (data.pending)
+                        setTimeout(poll, 5000);
+                });
+            }
+
+            poll();
+        });
+
         $('.extension.single-page').each(function() {
             var pk = $(this).data('epk');
             if ($(this).hasClass('can-edit')) {
@@ -212,24 +233,21 @@ function($, messages, modal, hashParamUtils, commentsTemplate, staticfiles, cook
                 $('.icon.upload').uploadify('/ajax/upload/icon/'+pk);
             }
 
-            function fetchComments(base, showAll) {
+            function fetchComments(base, cursor) {
                 var $loading = base.find('.loading');
                 $loading.show();
 
                 $.ajax({
                     type: 'GET',
                     dataType: 'json',
-                    data: { pk: pk, all: showAll },
-                    url: '/comments/all/',
-                }).done(function(comments) {
+                    data: cursor ? { pk: pk, cursor: cursor, limit: 50 } : { pk: pk },
+                    url: '/comments/list/',
+                }).done(function(page) {
                     var $commentsHolder = base.find('.comments-holder');
 
                     $loading.hide();
 
-                    if (comments.length < 5)
-                        showAll = false;
-
-                    var data = { comments: comments, show_all: showAll };
+                    var data = { comments: page.comments, show_all: !page.next };
                     var $newContent = $('<div>').append(commentsTemplate.render(data));
                     $newContent.addClass('comments-holder');
 
@@ -237,15 +255,21 @@ function($, messages, modal, hashParamUtils, commentsTemplate, staticfiles, cook
                     $newContent.find('.rating').ratify();
                     $newContent.find('.show-all').on('click', function() {
                         $(this).hide();
-                        fetchComments(base, true);
+                        fetchComments(base, page.next);
                     });
 
-                    $commentsHolder.replaceWith($newContent);
+                    if (cursor) {
+                        // Later pages go after the comments already shown.
+                        $commentsHolder.find('.show-all').remove();
+                        $commentsHolder.append($newContent.children());
+                    } else {
+                        $commentsHolder.replaceWith($newContent);
+                    }
                 });
             }
 
             $(this).find('#comments').each(function() {
-                fetchComments($(this), false);
+                fetchComments($(this), null);
             });
         });
     });
@@ -6,5 +6,12 @@ define(['jquery', 'review'], function($) {
     $(document).ready(function() {
         $("#files").reviewify(false);
         $("#diff").reviewify(true);
+
+        $("#diff_base").on('click', function(event) {
+            // Don't collapse the section the selector sits in.
+            event.stopPropagation();
+        }).change(function() {
+            $("#diff").empty().data('base', $(this).val()).reviewify(true);
+        });
     });
 });
@@ -13,29 +13,142 @@ define(['jquery', 'diff'], function($, diff) {
         return BINARY_TYPES.indexOf(ext) >= 0;
     }
 
-    function buildFileView(data) {
+    function caption(cls, text) {
+        return $('<caption>', {'class': cls}).text(text);
+    }
+
+    function buildLineRow(linum, $contents) {
+        return $('<tr>', {'class': 'line'}).
+            append($('<td>', {'class': 'linum'}).text(linum)).
+            append($('<td>', {'class': 'contents'}).append($contents));
+    }
+
+    function buildFileView(data, filename, pk) {
         if (data.raw)
             return $(data.html);
 
         var $table = $('<table>', {'class': 'code'});
 
+        if (data.binary)
+            return $table.append(caption('file-notice', "Binary file (" + data.size + " bytes), not shown."));
+
         $.each(data.lines, function(i) {
-            $table.append($('<tr>', {'class': 'line'}).
-                          append($('<td>', {'class': 'linum'}).text(i + 1)).
-                          append($('<td>', {'class': 'contents'}).html(this)));
+            $table.append(buildLineRow(i + 1, $('<span>').html(this)));
         });
 
+        if (data.truncated) {
+            // The rest of the file is previewed by line range, without
+            // highlighting.
+            var $more = $('<a>', {'class': 'file-more'}).text("Show more");
+            var next = data.lines.length;
+
+            $table.prepend(caption('file-notice', "This file is " + data.size + " bytes; only the beginning is highlighted."));
+            $table.append($('<tr>', {'class': 'file-more-row'}).append($('<td>'), $('<td>').append($more)));
+
+            $more.click(function() {
+                fetchFileLines(filename, pk, next, next + 1000).done(function(lines) {
+                    var $row = $table.find('tr.file-more-row');
+                    $.each(lines, function(i) {
+                        $row.before(buildLineRow(next + i + 1, $('<span>').text(this)));
+                    });
+
+                    next += lines.length;
+                    if (lines.length < 1000)
+                        $row.remove();
+                });
+            });
+        }
+
         return $table;
     }
 
-    function createDiffView(filename, pk) {
+    function fetchFileLines(filename, pk, start, end) {
         return $.ajax({
             type: 'GET',
             dataType: 'json',
-            data: { filename: filename },
-            url: REVIEW_URL_BASE + '/get-file-diff/' + pk
+            data: { filename: filename, start: start, end: end },
+            url: REVIEW_URL_BASE + '/get-file-lines/' + pk
         }).pipe(function(data) {
-            return diff.buildDiffTable(data.chunks, data.oldlines, data.newlines);
+            return data.lines;
+        });
+    }
+
+    // Streams the diffs of all files of a version in one request. The
+    // response is newline-delimited JSON: the file changeset first, then
+    // one diff per file. Returns the changeset promise and a function
+    // giving the promise for the diff of a file.
+    function loadVersionDiff(pk, base) {
+        var changeset = $.Deferred();
+        var diffs = {};
+        var xhr = new XMLHttpRequest();
+        var seen = 0;
+        var loaded = false;
+
+        function getDiff(filename) {
+            if (!diffs.hasOwnProperty(filename)) {
+                diffs[filename] = $.Deferred();
+                // The stream is over; it won't come any more.
+                if (loaded)
+                    diffs[filename].reject();
+            }
+            return diffs[filename];
+        }
+
+        function consume() {
+            var text = xhr.responseText;
+            var end;
+
+            while ((end = text.indexOf('\n', seen)) >= 0) {
+                var data = JSON.parse(text.slice(seen, end));
+                seen = end + 1;
+
+                if (changeset.state() === 'pending')
+                    changeset.resolve(data);
+                else
+                    getDiff(data.filename).resolve(data);
+            }
+        }
+
+        function fail() {
+            loaded = true;
+            changeset.reject();
+            $.each(diffs, function() { this.reject(); });
+        }
+
+        xhr.onprogress = consume;
+        xhr.onload = function() {
+            if (xhr.status !== 200)
+                return fail();
+
+            consume();
+            loaded = true;
+
+            // Anything not in the stream (e.g. binary files) has no diff.
+            $.each(diffs, function() { this.reject(); });
+        };
+        xhr.onerror = fail;
+        xhr.open('GET', REVIEW_URL_BASE + '/get-version-diff/' + pk + '?' + $.param({ base: base }));
+        xhr.send();
+
+        return { changeset: changeset.promise(), getDiff: getDiff };
+    }
+
+    function createDiffView(filename, pk, versionDiff) {
+        return versionDiff.getDiff(filename).pipe(function(data) {
+            var $table = diff.buildDiffTable(data.chunks, data.oldlines, data.newlines, function(start, end) {
+                return fetchFileLines(filename, pk, start, end);
+            });
+
+            if (data.binary)
+                $table.prepend(caption('file-notice', "Binary file, not shown."));
+            else if (data.truncated)
+                $table.prepend(caption('file-notice', "This file is too large to diff; only the beginning is shown."));
+
+            if (data.degraded)
+                $table.prepend($('<caption>', {'class': 'diff-degraded'}).
+                               text("Changes within some lines are not highlighted: they are too long, or the file has too many of them."));
+
+            return $table;
         });
     }
 
@@ -46,7 +159,7 @@ define(['jquery', 'diff'], function($, diff) {
             data: { filename: filename },
             url: REVIEW_URL_BASE + '/get-file/' + pk
         }).pipe(function(data) {
-            return buildFileView(data);
+            return buildFileView(data, filename, pk);
         });
     }
 
@@ -62,11 +175,19 @@ define(['jquery', 'diff'], function($, diff) {
             var currentFilename;
             var $currentFile = null;
 
-            var req = $.ajax({
-                type: 'GET',
-                dataType: 'json',
-                url: REVIEW_URL_BASE + '/get-file-list/' + pk,
-            });
+            var versionDiff = null;
+            var req;
+
+            if (diff) {
+                versionDiff = loadVersionDiff(pk, $elem.data('base'));
+                req = versionDiff.changeset;
+            } else {
+                req = $.ajax({
+                    type: 'GET',
+                    dataType: 'json',
+                    url: REVIEW_URL_BASE + '/get-file-list/' + pk,
+                });
+            }
 
             function showTable(filename, $file, $selector) {
                 $fileList.find('li a.fileselector').removeClass('selected');
@@ -113,7 +234,7 @@ define(['jquery', 'diff'], function($, diff) {
                             return;
 
                         if ($file === null) {
-                            var d = (diff ? createDiffView : createFileView)(filename, pk, diff);
+                            var d = (diff ? createDiffView : createFileView)(filename, pk, versionDiff);
                             currentFilename = filename;
                             d.done(function($table) {
                                 $file = $table;
@@ -36,13 +36,14 @@ define(['jquery'], function($) {
             }
             else
             {
+                // The scaled down copies in a <picture> show the old
+                // image until new ones are made; browsers prefer them
+                // over the <img>.
+                $old.siblings('source').remove();
                 $old.prop('src', result);
                 $elem.removeClass('placeholder');
 
-                if ($old.parent().is('a'))
-                {
-                    $old.parent().prop('href', result);
-                }
+                $old.closest('a').prop('href', result);
             }
         }
 
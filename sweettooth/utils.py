@@ -1,10 +1,104 @@
-
+import functools
 import hashlib
+import threading
+from collections import OrderedDict
 from urllib.parse import urlencode
 
 GRAVATAR_BASE = "https://secure.gravatar.com/avatar/%s?%s"
 
+@functools.lru_cache(maxsize=4096)
+def gravatar_hash(email):
+    return hashlib.md5(email.lower().encode('utf-8')).hexdigest()
+
 def gravatar_url(request, email, size=70):
-    email_md5 = hashlib.md5(email.lower().encode('utf-8')).hexdigest()
+    email_md5 = gravatar_hash(email)
     options = urlencode({'d': "mm", 's': size})
     return GRAVATAR_BASE % (email_md5, options)
+
+def build_absolute_uri(location):
+    """
+    Like request.build_absolute_uri, for code that runs without a
+    request (background tasks, management commands).
+    """
+    from django.conf import settings
+    from django.contrib.sites.models import Site
+
+    scheme = "http" if settings.DEBUG else "https"
+    return "%s://%s%s" % (scheme, Site.objects.get_current().domain, location)
+
+class LRUCache(object):
+    """
+    A thread-safe mapping bounded by the total size of its values.
+
+    ``sizeof`` gives the cost of a single value and defaults to 1, which
+    makes ``maxsize`` an entry count. ``on_evict`` is called with every
+    value that gets pushed out of the cache.
+    """
+
+    def __init__(self, maxsize, sizeof=None, on_evict=None):
+        self.maxsize = maxsize
+        self.sizeof = sizeof or (lambda value: 1)
+        self.on_evict = on_evict
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._data[key]
+            except KeyError:
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+
+        with self._lock:
+            if key in self._data:
+                old_value, old_size = self._data.pop(key)
+                self.size -= old_size
+                if old_value is not value:
+                    self._evicted(old_value)
+
+            # Something this big would just flush everything else out.
+            if size > self.maxsize:
+                return
+
+            self._data[key] = (value, size)
+            self.size += size
+
+            while self.size > self.maxsize:
+                old_key, (old_value, old_size) = self._data.popitem(last=False)
+                self.size -= old_size
+                self._evicted(old_value)
+
+    def pop(self, key):
+        with self._lock:
+            try:
+                value, size = self._data.pop(key)
+            except KeyError:
+                return
+
+            self.size -= size
+            self._evicted(value)
+
+    def clear(self):
+        with self._lock:
+            while self._data:
+                key, (value, size) = self._data.popitem(last=False)
+                self._evicted(value)
+
+            self.size = 0
+
+    def _evicted(self, value):
+        if self.on_evict is not None:
+            self.on_evict(value)